@@ -1,14 +1,15 @@
 from flask import Flask, flash, redirect, render_template, request, session, jsonify, url_for
 from sqlalchemy import select
-from werkzeug.security import check_password_hash, generate_password_hash
 from modules.models import User, UserProduct, Product, db
 from flask_sqlalchemy import SQLAlchemy
-from modules.helpers import login_required, log_to_file, validate_turnsrtile
-from waitress import serve
+from modules.helpers import login_required, log_to_file
+from modules.turnstile import validate_turnsrtile
 from modules import create_app
-from modules.functions import store_product, validate_URL, check_product_existence, standardise_URL
-from modules.tasks import add, request_API, scheduled_rescrape, scheduled_user_rescrape
+from modules.functions import validate_URL, check_product_existence, standardise_URL, get_cached_user_products, MAX_USER_PRODUCTS
 from modules.celery_utils import celery_init_app
+from modules.cache import single_flight, product_list_cache
+from modules.passwords import hash_password, verify_password, PasswordHasherBusy
+from celery.utils import uuid
 import os
 
 '''
@@ -37,70 +38,21 @@ log_to_file("App started", "INFO")
 # Set base URL for redirects, the URL is different in production.
 BASE_URL = os.getenv("BASE_URL", "")
 
-def process_product_data(URL):
-    
-    '''
-    This function fetches the product data from the scraper API, 
-    adds it to the products table and then to the userProducts table for current user.
-    This function does not get called if the product is already in the dB since that is
-    handeled in /add_product before this function gets called.
-    
-    I did this so that the database would not get bloated with the same data, but also to speed up the process
-    of adding products to the userProducts table and to prevent unnecessary requests to the scraper API incase of an already existing product.
-    This function is called from the /add_product route.
-    
-    '''
-    
-    try:
-                  
-        # Fetch the product data from the scraper API and store it in a dictionary, raise for HTTP errors
-        log_to_file("Fetching product data with scraper API", "INFO", session["user_id"])
-        
-        # request_API uses Redis/Celery to create a task queue to not overload the API
-        task_result = request_API.apply_async(args=[URL], queue='user_requests')
-        dict_values = task_result.get(timeout=30)
-        if dict_values.get("error"):
-            log_to_file(f"API request error: {dict_values}", "ERROR", session["user_id"])
-            return False, None
-            
-        log_to_file(f"Product data fetched: {dict_values}", "INFO", session["user_id"])
-
-        # Add the product to the Products table in the database
-        log_to_file("Adding product to products table", "INFO", session["user_id"])
-
-        store_product(dict_values, URL, session["user_id"])
-            
-        return True, dict_values
-    
-    except TypeError as e:
-        log_to_file(f"error processing data: {e}", "ERROR", session["user_id"])
-        return False, None
-    except KeyError as e:
-        log_to_file(f"KeyError while running function: {e}", "ERROR", session["user_id"])
-        return False, None
-    except Exception as e:
-        log_to_file(f"error while running function: {e}", "ERROR", session["user_id"])
-        return False, None
-
-
+# Production server, "waitress" or "asgi" for the async mode in modules/asgi.py
+SERVER_MODE = os.getenv("SERVER_MODE", "waitress")
 
 @app.route('/', methods=["GET", "POST"])
 @login_required
 def index():
     log_to_file(f"Loading index", "INFO", session["user_id"])
     # Uncomment to test Celery worker
+    #from modules.tasks import add
     #task = add.delay(5, 5)
     #print(task)
     
-    # Get all the product IDs of the products from the users userProducts table to get the product data from the products table
-    userProducts = db.session.query(UserProduct).filter_by(userID=session["user_id"]).all()
-    products = []
+    # Get the users products from the product list cache, or with a single JOIN over the userProducts and products tables
+    products = get_cached_user_products(session["user_id"])
     
-    # using userProducts, Get the users product objects from the products table to push it to the front end
-    for userProduct in userProducts:
-        product = db.session.query(Product).filter_by(id=userProduct.productID).first()
-        products.append(product)
-        
     return render_template("index.html", products=products)
 
 
@@ -110,23 +62,30 @@ def register():
     session.clear()
     log_to_file("Loading register page", "INFO")
     
-    token = request.form.get('cf-turnstile-response')
-    remoteip = request.headers.get('CF-connecting-IP') or \
-            request.headers.get('X-Forwarded-For') or \
-            request.remote_addr
-            
-    validation = validate_turnsrtile(
-                                token, 
-                                os.getenv('TURNSTILE_SECRET_KEY'),
-                                remoteip)
-    
     # Registers the user in the database and encrypt password,
     # checking if user already exists is done with JS in "register.html" and the check_username() function
     # authentication is done with JS in "register.html"
     if request.method == "POST":
+        
+        # Only a submitted form has a Turnstile token to verify, loading the page never waits on Cloudflare
+        token = request.form.get('cf-turnstile-response')
+        remoteip = request.headers.get('CF-connecting-IP') or \
+                request.headers.get('X-Forwarded-For') or \
+                request.remote_addr
+                
+        validation = validate_turnsrtile(
+                                    token, 
+                                    os.getenv('TURNSTILE_SECRET_KEY'),
+                                    remoteip)
+        
         if validation['success']:
             name = request.form.get("username")
-            passwordHash = generate_password_hash(request.form.get("password"), method='pbkdf2', salt_length=16)
+            
+            # Hashing runs in the password hashing pool, not on this Waitress thread
+            try:
+                passwordHash = hash_password(request.form.get("password"))
+            except PasswordHasherBusy:
+                return render_template("register.html"), 503
             user = User(username=name, passwordHash=passwordHash)
             
             db.session.add(user)
@@ -168,11 +127,25 @@ def login():
         username = data.get("username")
         user = db.session.query(User).filter_by(username=username).first()
         
-        # Check if user exists and if the password is correct
+        if user is None:
+            return jsonify({"success":False, "message":"Invalid username and/or password"})
+        
+        # Check if the password is correct, in the password hashing pool
         # Password comes directly from the form, as to never store it in a variable
-        if user is None or not check_password_hash(user.passwordHash, data.get("password")):
+        try:
+            valid, new_hash = verify_password(user.passwordHash, data.get("password"))
+        except PasswordHasherBusy:
+            return jsonify({"success":False, "message":"Too many login attempts right now, please try again in a moment"}), 503
+        
+        if not valid:
             return jsonify({"success":False, "message":"Invalid username and/or password"})
         else:
+            # The hash cost changed since the user registered, store the hash with the new cost
+            if new_hash:
+                user.passwordHash = new_hash
+                db.session.commit()
+                log_to_file(f"Password rehashed with the current cost: {username}", "INFO", user.id)
+            
             session["user_id"] = user.id
             log_to_file(f"User logged in: {username}", "INFO", session["user_id"])
             return jsonify({"success":True, "redirect": f"{BASE_URL}/"})
@@ -207,7 +180,7 @@ def add_product():
         
         # Check of user has 5 products in table, if so alert user that the maximum amount is 5
         query_result = db.session.query(UserProduct).filter_by(userID=session["user_id"]).all()
-        if len(query_result) >= 5:
+        if len(query_result) >= MAX_USER_PRODUCTS:
             return jsonify({"success": False, "message": "The maximum amount of items allowed at a time is 5. Please remove an item before adding a new one"})
         
         # Check if the requested product is already in the Products table
@@ -225,23 +198,109 @@ def add_product():
                                                                                                             "currentPrice": product.currentPrice,
                                                                                                             "ogPrice": product.ogPrice}})
         
-        # if the product does not exist in either tables, call process_propduct_data()
-        result, product_data = process_product_data(new_URL)
+        # The task modules are imported on first use, that keeps them out of the startup of every web process
+        from modules.tasks import scrape_and_store_product
         
-        # if it fails, pass the user a failure message
-        if result == False:
-            log_to_file(f"Error processing product data: {URL}", "ERROR", session["user_id"])
-            return jsonify({"success": False, 
-                            "message": "Error processing product data, please check if the URL you entered is an available product"})
+        # if the product does not exist in either tables, let the worker scrape and store it.
+        # If another user is already adding the same product, attach to that scrape instead of starting a second one
+        task_id = uuid()
+        owner_id = single_flight.claim(new_URL, task_id)
+        if owner_id == task_id:
+            scrape_and_store_product.apply_async(args=[new_URL, session["user_id"]], queue='user_requests', task_id=task_id)
+            log_to_file(f"Product scrape queued: {task_id}", "INFO", session["user_id"])
+        else:
+            log_to_file(f"Product scrape already in flight, attaching to: {owner_id}", "INFO", session["user_id"])
         
-        # if it succeeds, pass the user success message and send the product data to the script in "index.html"
-        product_data["URL"] = new_URL
-        log_to_file(f"Product added succesfully", "INFO", session["user_id"])
-        return jsonify({"success": True, "message": "Product added successfully.", "product_data": product_data})
+        # The task ID is returned right away and remembered in the session, so only this user can poll its result
+        session["pending_tasks"] = session.get("pending_tasks", []) + [owner_id]
+        return jsonify({"success": True, "pending": True, "task_id": owner_id, "message": "Getting product data..."})
             
     return redirect(f"{BASE_URL}/")
 
 
+# Used by the script in "index.html" to poll the result of a product scrape queued by /add_product
+@app.route('/add_product/status/<task_id>', methods=["GET"])
+@login_required
+def add_product_status(task_id):
+    from modules.tasks import scrape_and_store_product
+    
+    pending_tasks = session.get("pending_tasks", [])
+    if task_id not in pending_tasks:
+        return jsonify({"success": False, "message": "Unknown product request."})
+    
+    task_result = scrape_and_store_product.AsyncResult(task_id)
+    if not task_result.ready():
+        return jsonify({"success": True, "pending": True, "task_id": task_id})
+    
+    pending_tasks.remove(task_id)
+    session["pending_tasks"] = pending_tasks
+    
+    # if the task itself crashed, pass the user a failure message
+    if task_result.failed():
+        log_to_file(f"Product scrape task failed: {task_result.result}", "ERROR", session["user_id"])
+        return jsonify({"success": False, 
+                        "message": "Error processing product data, please check if the URL you entered is an available product"})
+    
+    # The task only added the product for the user that started the scrape,
+    # users that attached to it get the product added to their userProducts table here
+    result = task_result.result
+    if result.get("success"):
+        check_product_existence(result["product_data"]["URL"], result["product_data"]["id"], session["user_id"])
+    
+    # The task result holds the success flag, message and product data for the script in "index.html"
+    return jsonify(result)
+
+
+# Add many product URLs at once, as a JSON list, a text field or an uploaded CSV file
+@app.route('/bulk_import', methods=["POST"])
+@login_required
+def bulk_import():
+    from modules.bulk_import import read_urls, import_urls, import_summary
+    
+    if request.is_json:
+        # Anything but an object with a list of strings is bad input, like a list that is too long
+        data = request.get_json(silent=True)
+        raw_urls = data.get("urls", []) if isinstance(data, dict) else None
+        if not isinstance(raw_urls, list) or not all(isinstance(URL, str) for URL in raw_urls):
+            return jsonify({"success": False, "message": "Send the URLs as {\"urls\": [...]}."}), 400
+    elif "file" in request.files:
+        raw_urls = read_urls(request.files["file"].read().decode("utf-8", errors="replace"))
+    else:
+        raw_urls = read_urls(request.form.get("urls", ""))
+    
+    user_id = session["user_id"]
+    try:
+        result = import_urls(raw_urls, user_id)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    
+    # Answer right away instead of holding a thread until the scrapes finish, the client polls /bulk_import/status.
+    # The task IDs are remembered in the session like /add_product does, the product limit keeps the list short
+    task_ids = list(dict.fromkeys(result["queued"].values()))
+    session["pending_tasks"] = session.get("pending_tasks", []) + task_ids
+    return jsonify({"success": True, "summary": import_summary(result), **result})
+
+
+# Used to poll the scrapes of a bulk import, the task IDs are passed as ?task_id=...&task_id=...
+@app.route('/bulk_import/status', methods=["GET"])
+@login_required
+def bulk_import_status():
+    from modules.bulk_import import scrape_outcome
+    
+    pending_tasks = session.get("pending_tasks", [])
+    task_ids = [task_id for task_id in request.args.getlist("task_id") if task_id in pending_tasks]
+    
+    results = {}
+    for task_id in task_ids:
+        outcome = scrape_outcome(task_id, session["user_id"])
+        if outcome is not None:
+            results[task_id] = outcome
+            pending_tasks.remove(task_id)
+    
+    session["pending_tasks"] = pending_tasks
+    return jsonify({"success": True, "results": results, "pending": [task_id for task_id in task_ids if task_id not in results]})
+
+
 # Remove row from the database when user clicks 'remove' button
 @app.route('/remove_row', methods=["GET", "POST"])
 def remove_row():
@@ -257,9 +316,10 @@ def remove_row():
             print(product_data.id)
             db.session.query(UserProduct).filter_by(productID=product_data.id, userID=session['user_id']).delete()
             db.session.commit()
+            product_list_cache.invalidate_user(session['user_id'])
             
         except Exception as e:
-            log_to_file(f"Error removing product: {row_data["name"]} from userProducts table: {e}", "ERROR", session["user_id"])
+            log_to_file(f"Error removing product: {row_data['name']} from userProducts table: {e}", "ERROR", session["user_id"])
             return redirect(f"{BASE_URL}/")
         
         log_to_file(f"Product removed from userProducts table: {product_data}", "INFO", session["user_id"])
@@ -271,6 +331,8 @@ def remove_row():
 # Route used to test the 24H based scheduled rescrape of the Products table
 @app.route('/test_scheduler', methods=["GET", "POST"])
 def test_scheduler():
+    from modules.tasks import scheduled_rescrape
+    
     scheduled_rescrape()
     return redirect(f"{BASE_URL}/")
 
@@ -281,6 +343,12 @@ mode = "dev"
 if __name__ == '__main__':
     if mode == "dev":
         app.run(host='0.0.0.0', port=80, debug=True, use_reloader=True)
+    elif SERVER_MODE == "asgi":
+        # Requests that wait on a product scrape do not hold one of the threads in this mode
+        import uvicorn
+        from modules.asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(app, url_prefix="/DiscountChecker"), host='0.0.0.0', port=80)
     else:
+        from waitress import serve
         serve(app, host='0.0.0.0', port=80, threads=2,
               url_prefix="/DiscountChecker")
\ No newline at end of file
@@ -0,0 +1,177 @@
+from common import load_app, summarise_latencies, percentile, write_results
+from fake_scraper import start_fake_scraper
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import argparse
+import requests
+import socket
+import time
+import os
+
+'''
+
+Load test of the async serving mode against Waitress.
+
+Serves the real app with Waitress and with the ASGI app of modules/asgi.py on uvicorn, both with --threads threads
+for the Flask routes, while a Celery worker in this process scrapes from the local fake scraper. For every amount of
+--users, each user logs in and adds --products new products the way index.html does: with Waitress it polls
+/add_product/status every second, the async mode answers the POST once the product is stored. One more user keeps
+requesting "/" meanwhile. Records the time until each product is added, the requests it took and the "/" latency.
+
+Usage: python benchmarks/bench_async.py [--users 8 32 96] [--products 2] [--latency 2] [--threads 2]
+                                        [--modes waitress asgi] [--output results.json]
+
+'''
+
+PASSWORD = "benchmark-password"
+# Cheap hashes, logging in is not what this benchmark measures
+ITERATIONS = 1000
+
+
+def add_products(base_URL, username, prefix, products, latencies, sent):
+    http_session = requests.Session()
+    response = http_session.post(f"{base_URL}/login", json={"username": username, "password": PASSWORD})
+    assert response.json()["success"], response.text
+
+    for n in range(0, products):
+        started = time.perf_counter()
+        data = http_session.post(f"{base_URL}/add_product", data={"URL": f"https://www.bol.com/nl/nl/p/{prefix}-{username}-{n}"}).json()
+        sent.append(1)
+
+        # Same as pollProductStatus in main.js
+        while data.get("pending"):
+            time.sleep(1)
+            data = http_session.get(f"{base_URL}/add_product/status/{data['task_id']}").json()
+            sent.append(1)
+
+        assert data["success"], data
+        latencies.append(time.perf_counter() - started)
+
+
+
+def index_loop(base_URL, username, done, latencies):
+    http_session = requests.Session()
+    http_session.post(f"{base_URL}/login", json={"username": username, "password": PASSWORD})
+    while not done.is_set():
+        started = time.perf_counter()
+        response = http_session.get(f"{base_URL}/")
+        assert response.status_code == 200
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.1)
+
+
+
+def start_server(app, mode, threads):
+    '''
+    Serve app in a daemon thread, returns (base_URL, stop).
+
+    '''
+    if mode == "waitress":
+        from waitress import create_server
+        server = create_server(app, host="127.0.0.1", port=0, threads=threads)
+        threading.Thread(target=server.run, daemon=True).start()
+        return f"http://127.0.0.1:{server.effective_port}", server.close
+
+    import uvicorn
+    from modules.asgi import create_asgi_app
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(create_asgi_app(app, threads=threads), log_level="warning", lifespan="on"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+    return f"http://127.0.0.1:{sock.getsockname()[1]}", stop
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[8, 32, 96])
+    parser.add_argument("--products", type=int, default=2, help="Products each user adds, at most 5")
+    parser.add_argument("--latency", type=float, default=2, help="Seconds the fake scraper takes per scrape")
+    parser.add_argument("--threads", type=int, default=2, help="Threads for the Flask routes in both modes")
+    parser.add_argument("--modes", nargs="+", choices=["waitress", "asgi"], default=["waitress", "asgi"])
+    parser.add_argument("--worker-concurrency", type=int, default=None, help="Celery worker threads, defaults to the most users")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    scraper = start_fake_scraper(args.latency)
+    os.environ["API_IP"] = scraper.url
+    os.environ["BROKER_URL"] = "memory://"
+    os.environ["RESULT_BACKEND"] = "cache+memory://"
+    os.environ["SESSION_BACKEND"] = "cookie"
+    os.environ["PASSWORD_HASH_WORKERS"] = "0"
+    os.environ["PASSWORD_HASH_ITERATIONS"] = str(ITERATIONS)
+    os.environ["HTTP_POOL_SIZE"] = str(max(args.users))
+    app, work_dir = load_app()
+
+    from celery.contrib.testing.worker import start_worker
+    from modules.models import User, db
+    import modules.passwords as passwords
+    
+    # Registers the tasks with the worker, the web app only imports them on first use
+    celery_app = app.extensions["celery"]
+    celery_app.loader.import_task_module("modules.tasks")
+
+    with app.app_context():
+        password_hash = passwords.hash_job(PASSWORD, ITERATIONS)
+        db.session.bulk_insert_mappings(User, [{"username": f"bench-{mode}-{users}-{i}", "passwordHash": password_hash}
+                                               for mode in args.modes for users in args.users for i in range(0, users + 1)])
+        db.session.commit()
+
+    # The in-memory broker is polled once a second by default, which would add up to a second to every scrape
+    celery_app.conf.broker_transport_options = {"polling_interval": 0.05}
+    
+    # The worker has a thread for every user, so the scraper latency is the same in every run
+    worker_concurrency = args.worker_concurrency or max(args.users)
+    results = []
+    with start_worker(celery_app, concurrency=worker_concurrency, pool="threads",
+                      perform_ping_check=False, queues=["user_requests", "default"]):
+        for mode in args.modes:
+            base_URL, stop = start_server(app, mode, args.threads)
+
+            for users in args.users:
+                add_latencies = []
+                index_latencies = []
+                sent = []
+                done = threading.Event()
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=users + 1) as executor:
+                    probe = executor.submit(index_loop, base_URL, f"bench-{mode}-{users}-{users}", done, index_latencies)
+                    futures = [executor.submit(add_products, base_URL, f"bench-{mode}-{users}-{i}", f"{mode}-{users}",
+                                               args.products, add_latencies, sent) for i in range(0, users)]
+                    for future in futures:
+                        future.result()
+                    done.set()
+                    probe.result()
+                wall_time = time.perf_counter() - started
+
+                added = summarise_latencies(add_latencies, wall_time)
+                index = summarise_latencies(index_latencies, wall_time)
+                results.append({"mode": mode,
+                                "threads": args.threads,
+                                "users": users,
+                                "scraper_latency_s": args.latency,
+                                "products_added": added["requests"],
+                                "products_per_second": added["throughput"],
+                                "add_p50_ms": added["p50_ms"],
+                                "add_p99_ms": added["p99_ms"],
+                                "add_max_ms": round(percentile(add_latencies, 1) * 1000, 3),
+                                "requests_per_product": round(len(sent) / max(1, len(add_latencies)), 2),
+                                "index_p50_ms": index["p50_ms"],
+                                "index_p99_ms": index["p99_ms"],
+                                "wall_time_s": round(wall_time, 3)})
+            stop()
+
+    write_results("async", results, args.output)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from common import write_results
+import argparse
+import timeit
+import json
+import time
+
+'''
+
+Microbenchmark for decoding scraper responses.
+
+Compares the old path, response.json() into a dict followed by the key probes and float() conversions of the
+rescrape loop, with decode_scrape() on the response bytes into a typed ScrapeResult. The responses are real
+requests.Response objects with the body of the scraper API, so response.json() includes its encoding detection.
+Also compares reading a scrape cache entry with json.loads and with the typed decoder of the cache.
+
+Usage: python benchmarks/bench_decode.py [--number 100000] [--repeat 5] [--output results.json]
+
+'''
+
+SUCCESS_BODY = json.dumps({"name": "Apple iPhone 15 128GB Zwart", "currentPrice": "799.00", "ogPrice": "969.00"}).encode()
+ERROR_BODY = json.dumps({"error": 'Failed to find class "promo-price"'}).encode()
+
+
+def make_response(body):
+    import requests
+    response = requests.Response()
+    response._content = body
+    response.status_code = 200
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+
+def legacy_decode(response):
+    # What rescrape_once and queue_price_update did with a response
+    dict_values = response.json()
+    if not dict_values.get('currentPrice'):
+        return None
+    return round(float(dict_values["currentPrice"]), 2), round(float(dict_values["ogPrice"]), 2)
+
+
+
+def typed_decode(response, decode_scrape, ScrapeResult):
+    result = decode_scrape(response.content)
+    if not isinstance(result, ScrapeResult):
+        return None
+    return round(result.currentPrice, 2), round(result.ogPrice, 2)
+
+
+
+def best_of(call, number, repeat):
+    # Best time per call in microseconds, the minimum is the least disturbed by other processes
+    return round(min(timeit.repeat(call, number=number, repeat=repeat)) / number * 1e6, 3)
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100000, help="Calls per timing")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    import msgspec
+    from modules.scrape_result import ScrapeResult, decode_scrape
+    from modules.cache import CachedScrape, _cached_scrape_decoder
+
+    success = make_response(SUCCESS_BODY)
+    error = make_response(ERROR_BODY)
+    assert legacy_decode(success) == typed_decode(success, decode_scrape, ScrapeResult) == (799.0, 969.0)
+    assert legacy_decode(error) is typed_decode(error, decode_scrape, ScrapeResult) is None
+
+    cache_entry = msgspec.json.encode(CachedScrape(scraped_at=time.time(), data=decode_scrape(SUCCESS_BODY)))
+
+    results = []
+    cases = [("success_response", lambda: legacy_decode(success), lambda: typed_decode(success, decode_scrape, ScrapeResult)),
+             ("error_response", lambda: legacy_decode(error), lambda: typed_decode(error, decode_scrape, ScrapeResult)),
+             ("cache_entry", lambda: json.loads(cache_entry)["data"]["currentPrice"], lambda: _cached_scrape_decoder.decode(cache_entry).data.currentPrice)]
+
+    for name, legacy, typed in cases:
+        legacy_us = best_of(legacy, args.number, args.repeat)
+        typed_us = best_of(typed, args.number, args.repeat)
+        results.append({"case": name,
+                        "legacy_us": legacy_us,
+                        "msgspec_us": typed_us,
+                        "speedup": round(legacy_us / typed_us, 2)})
+
+    write_results("decode", results, args.output)
+
+
+
+if __name__ == "__main__":
+    main()
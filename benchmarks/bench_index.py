@@ -0,0 +1,113 @@
+from common import load_app, QueryCounter, write_results
+import argparse
+import time
+
+'''
+
+Benchmark for the index route.
+
+Measures the amount of SQL queries and the time it takes to render "/" as the amount of products
+in the users list grows, for the single JOIN used by the route, the route with the users list in the
+product list cache and the old query per product. The cache runs in-process here, in production it lives in Redis.
+
+Usage: python benchmarks/bench_index.py [--sizes 5 50 500] [--requests 50] [--output results.json]
+
+'''
+
+
+def seed(db, User, Product, UserProduct, product_count):
+    user = User(username="bench", passwordHash="not-a-real-hash")
+    db.session.add(user)
+    db.session.flush()
+    
+    products = [Product(URL=f"https://www.bol.com/nl/nl/p/bench-product-{i}", name=f"Bench product {i}",
+                        ogPrice=100, currentPrice=80) for i in range(0, product_count)]
+    db.session.add_all(products)
+    db.session.flush()
+    
+    db.session.add_all([UserProduct(userID=user.id, productID=product.id) for product in products])
+    db.session.commit()
+    return user.id
+
+
+
+def legacy_index(db, Product, UserProduct, render_template, user_id):
+    # The index route before the JOIN, kept here to compare against
+    userProducts = db.session.query(UserProduct).filter_by(userID=user_id).all()
+    products = []
+    for userProduct in userProducts:
+        products.append(db.session.query(Product).filter_by(id=userProduct.productID).first())
+    return render_template("index.html", products=products)
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 50, 500])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    
+    app, work_dir = load_app()
+    
+    from flask import render_template
+    from modules.models import User, Product, UserProduct, db
+    from modules.cache import product_list_cache, LRUCache
+    
+    results = []
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+        
+        for size in args.sizes:
+            db.drop_all()
+            db.create_all()
+            user_id = seed(db, User, Product, UserProduct, size)
+            
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session["user_id"] = user_id
+            
+            # Route as it is now
+            counter.reset()
+            started = time.perf_counter()
+            for i in range(0, args.requests):
+                response = client.get("/")
+                assert response.status_code == 200
+            route_time = (time.perf_counter() - started) / args.requests
+            route_queries = counter.reset() / args.requests
+            
+            # Route with the product list cache, the first request fills it
+            product_list_cache.local = LRUCache(10)
+            client.get("/")
+            counter.reset()
+            started = time.perf_counter()
+            for i in range(0, args.requests):
+                response = client.get("/")
+                assert response.status_code == 200
+            cached_time = (time.perf_counter() - started) / args.requests
+            cached_queries = counter.reset() / args.requests
+            product_list_cache.local = None
+            
+            # Old query per product
+            started = time.perf_counter()
+            for i in range(0, args.requests):
+                with app.test_request_context("/"):
+                    legacy_index(db, Product, UserProduct, render_template, user_id)
+                    db.session.remove()
+            legacy_time = (time.perf_counter() - started) / args.requests
+            legacy_queries = counter.reset() / args.requests
+            
+            results.append({"products": size,
+                            "queries_per_request": route_queries,
+                            "render_ms": round(route_time * 1000, 3),
+                            "cached_queries_per_request": cached_queries,
+                            "cached_render_ms": round(cached_time * 1000, 3),
+                            "legacy_queries_per_request": legacy_queries,
+                            "legacy_render_ms": round(legacy_time * 1000, 3)})
+    
+    write_results("index", results, args.output)
+
+
+
+if __name__ == "__main__":
+    main()
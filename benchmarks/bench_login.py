@@ -0,0 +1,119 @@
+from common import load_app, summarise_latencies, write_results
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import argparse
+import requests
+import time
+import os
+
+'''
+
+Benchmark for /login under concurrent load.
+
+Serves the real app with Waitress and the same amount of threads as production, then lets --clients
+threads log in over and over for --duration seconds while one more client keeps requesting "/".
+This is run with the password hashing on the Waitress threads (PASSWORD_HASH_WORKERS=0) and in the hashing pool,
+and records the login throughput, the latency of both routes and how many logins were turned away as busy.
+
+Usage: python benchmarks/bench_login.py [--clients 8] [--duration 10] [--threads 2] [--workers 0 2] [--queue 1]
+                                        [--iterations 1000000] [--output results.json]
+
+'''
+
+PASSWORD = "benchmark-password"
+
+
+def login_loop(base_URL, username, deadline, latencies, busy):
+    http_session = requests.Session()
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        response = http_session.post(f"{base_URL}/login", json={"username": username, "password": PASSWORD})
+        if response.status_code == 503:
+            busy.append(1)
+            time.sleep(0.05)
+            continue
+        assert response.json()["success"], response.text
+        latencies.append(time.perf_counter() - started)
+
+
+
+def index_loop(base_URL, username, deadline, latencies):
+    http_session = requests.Session()
+    http_session.post(f"{base_URL}/login", json={"username": username, "password": PASSWORD})
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        response = http_session.get(f"{base_URL}/")
+        assert response.status_code == 200
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.05)
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=2, help="Waitress threads")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2], help="Hashing pool sizes, 0 hashes on the Waitress threads")
+    parser.add_argument("--queue", type=int, default=1, help="Max hashes running or waiting in the pool")
+    parser.add_argument("--iterations", type=int, default=1000000, help="pbkdf2 cost of the benchmark users")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    
+    os.environ["SESSION_BACKEND"] = "cookie"
+    os.environ["PASSWORD_HASH_ITERATIONS"] = str(args.iterations)
+    app, work_dir = load_app()
+    
+    from waitress import create_server
+    from modules.models import User, db
+    import modules.passwords as passwords
+    
+    with app.app_context():
+        password_hash = passwords.hash_job(PASSWORD, args.iterations)
+        db.session.bulk_insert_mappings(User, [{"username": f"bench-user-{i}", "passwordHash": password_hash}
+                                               for i in range(0, args.clients + 1)])
+        db.session.commit()
+    
+    server = create_server(app, host="127.0.0.1", port=0, threads=args.threads)
+    threading.Thread(target=server.run, daemon=True).start()
+    base_URL = f"http://127.0.0.1:{server.effective_port}"
+    
+    results = []
+    for workers in args.workers:
+        passwords.shutdown_pool()
+        passwords.PASSWORD_HASH_WORKERS = workers
+        passwords._slots = threading.BoundedSemaphore(args.queue)
+        
+        login_latencies = []
+        index_latencies = []
+        busy = []
+        deadline = time.monotonic() + args.duration
+        
+        with ThreadPoolExecutor(max_workers=args.clients + 1) as executor:
+            futures = [executor.submit(index_loop, base_URL, f"bench-user-{args.clients}", deadline, index_latencies)]
+            futures += [executor.submit(login_loop, base_URL, f"bench-user-{i}", deadline, login_latencies, busy)
+                        for i in range(0, args.clients)]
+            for future in futures:
+                future.result()
+        
+        login = summarise_latencies(login_latencies, args.duration)
+        index = summarise_latencies(index_latencies, args.duration)
+        results.append({"hash_workers": workers,
+                        "waitress_threads": args.threads,
+                        "hash_queue": args.queue if workers else None,
+                        "clients": args.clients,
+                        "iterations": args.iterations,
+                        "logins_per_second": login["throughput"],
+                        "login_p50_ms": login["p50_ms"],
+                        "login_p99_ms": login["p99_ms"],
+                        "busy_responses": len(busy),
+                        "index_p50_ms": index["p50_ms"],
+                        "index_p99_ms": index["p99_ms"]})
+    
+    passwords.shutdown_pool()
+    write_results("login", results, args.output)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from common import load_app, write_results
+import subprocess
+import threading
+import argparse
+import resource
+import json
+import time
+import sys
+import os
+
+'''
+
+Memory benchmark for the rescrape tasks.
+
+Runs a full rescrape over 1k to 1M products in a SQLite stand-in database with the scraper replaced by
+an in-process stub, and records how much the resident memory grows during the run. Every size runs in
+its own process so the numbers dont influence each other. The "chunked" mode is run_rescrape as used by
+the tasks, "legacy" loads the whole products table with query(Product).all() like the tasks used to.
+
+Usage: python benchmarks/bench_memory.py [--sizes 1000 10000 100000 1000000] [--modes chunked legacy] [--output results.json]
+
+'''
+
+
+def current_rss():
+    # Linux only, fall back to the peak RSS elsewhere
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+
+class RSSSampler(threading.Thread):
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss()
+        self.running = True
+    
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, current_rss())
+            time.sleep(0.01)
+
+
+
+def seed(database_path, size):
+    import sqlite3
+    connection = sqlite3.connect(database_path)
+    connection.executemany(
+        'INSERT INTO products (URL, name, ogPrice, currentPrice, scrapeCount, changeCount) VALUES (?, ?, 10, 10, 0, 0)',
+        ((f"https://www.bol.com/nl/nl/p/bench-product-{i}", f"Bench product {i}") for i in range(0, size))
+    )
+    connection.commit()
+    connection.close()
+
+
+
+def child(size, mode):
+    app, work_dir = load_app()
+    database_path = os.path.join(work_dir, "bench.db")
+    seed(database_path, size)
+    
+    import modules.tasks as tasks
+    from modules.models import Product, db
+    from modules.helpers import flush_logs
+    from modules.scrape_result import ScrapeResult
+    
+    # Stand-in scraper that answers instantly with an unchanged price
+    tasks.scrape_with_breaker = lambda URL, product_id: ScrapeResult(name="Product", currentPrice=10.0, ogPrice=10.0)
+    
+    with app.app_context():
+        baseline = current_rss()
+        sampler = RSSSampler()
+        sampler.start()
+        
+        started = time.perf_counter()
+        if mode == "legacy":
+            tasks.rescrape_products(db.session.query(Product).all())
+        else:
+            tasks.run_rescrape("full", db.session.query(Product))
+        wall_time = time.perf_counter() - started
+        
+        sampler.running = False
+        sampler.join()
+        flush_logs()
+    
+    print(json.dumps({"products": size,
+                      "mode": mode,
+                      "wall_time": round(wall_time, 3),
+                      "rss_growth_mb": round((sampler.peak - baseline) / 1024 / 1024, 2)}))
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--modes", nargs="+", default=["chunked", "legacy"])
+    parser.add_argument("--output")
+    parser.add_argument("--child", nargs=2)
+    args = parser.parse_args()
+    
+    if args.child:
+        child(int(args.child[0]), args.child[1])
+        return
+    
+    results = []
+    for mode in args.modes:
+        for size in args.sizes:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", str(size), mode],
+                                    check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    
+    write_results("memory", results, args.output)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+from common import load_app, summarise_latencies, write_results
+from fake_scraper import start_fake_scraper
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import time
+import os
+
+'''
+
+Benchmark for the Flask routes.
+
+Runs "/", "/login", "/add_product" and "/remove_row" of the real app against a seeded SQLite database
+(or the database given with --database-url) and the local fake scraper, and records the throughput and the
+p50/p99 latency per route. Celery runs its tasks eagerly, so the /add_product numbers include the scrape
+of the new product by scrape_and_store_product. Every worker thread logs in as its own user and adds
+and removes its own products, that way the workers never run into the 5 product limit of another worker.
+The time spent loading and saving sessions is recorded separately for the backend picked with --session-backend.
+
+Usage: python benchmarks/bench_routes.py [--requests 100] [--concurrency 1 4] [--latency 0.05]
+                                         [--failure-rate 0.0] [--products 1000] [--session-backend filesystem cookie redis]
+                                         [--redis-url URL] [--database-url URL] [--output results.json]
+
+'''
+
+PASSWORD = "benchmark-password"
+# Cheap hashes, the login route is measured without the pbkdf2 cost
+ITERATIONS = 1000
+
+
+def seed(db, User, Product, UserProduct, hash_password, users, product_count):
+    '''
+    Seed the catalog with product_count products and create the users, every user tracks 3 of the products.
+    Returns the usernames.
+    
+    '''
+    db.session.bulk_insert_mappings(Product, [{"URL": f"https://www.bol.com/nl/nl/p/seeded-product-{i}",
+                                               "name": f"Seeded product {i}",
+                                               "ogPrice": 100,
+                                               "currentPrice": 80} for i in range(0, product_count)])
+    
+    # Hashing is slow on purpose, every benchmark user shares the same hash
+    password_hash = hash_password(PASSWORD)
+    usernames = [f"bench-user-{i}" for i in range(0, users)]
+    db.session.bulk_insert_mappings(User, [{"username": username, "passwordHash": password_hash} for username in usernames])
+    db.session.commit()
+    
+    product_ids = [id for (id,) in db.session.query(Product.id).order_by(Product.id)]
+    user_ids = [id for (id,) in db.session.query(User.id).filter(User.username.in_(usernames)).order_by(User.id)]
+    db.session.bulk_insert_mappings(UserProduct, [{"userID": user_id, "productID": product_ids[(i * 3 + n) % len(product_ids)]}
+                                                  for i, user_id in enumerate(user_ids) for n in range(0, 3)])
+    db.session.commit()
+    return usernames
+
+
+
+class RecordingSessionInterface:
+    # Keeps every session load and save latency, the percentiles need the raw numbers
+    
+    def __init__(self, interface, latencies):
+        self.interface = interface
+        self.latencies = latencies
+        
+    def open_session(self, app, request):
+        return timed(self.latencies["open"], lambda: self.interface.open_session(app, request))
+    
+    def save_session(self, app, session, response):
+        return timed(self.latencies["save"], lambda: self.interface.save_session(app, session, response))
+    
+    def __getattr__(self, name):
+        return getattr(self.interface, name)
+
+
+
+def timed(latencies, call):
+    started = time.perf_counter()
+    response = call()
+    latencies.append(time.perf_counter() - started)
+    return response
+
+
+
+def run_worker(app, username, worker, requests):
+    '''
+    Run the request mix for one user, returns the latencies per route.
+    
+    '''
+    client = app.test_client()
+    latencies = {"/login": [], "/": [], "/add_product": [], "/remove_row": []}
+    
+    for i in range(0, requests):
+        response = timed(latencies["/login"], lambda: client.post("/login", json={"username": username, "password": PASSWORD}))
+        assert response.get_json()["success"], response.get_json()
+        
+        response = timed(latencies["/"], lambda: client.get("/"))
+        assert response.status_code == 200
+        
+        # A new product every time, so every add goes through the scraper
+        URL = f"https://www.bol.com/nl/nl/p/bench-{worker}-{i}"
+        response = timed(latencies["/add_product"], lambda: client.post("/add_product", data={"URL": URL}))
+        data = response.get_json()
+        if data.get("pending"):
+            data = client.get(f"/add_product/status/{data['task_id']}").get_json()
+        
+        # Failed scrapes from the fake scraper have nothing to remove
+        if data.get("success"):
+            response = timed(latencies["/remove_row"], lambda: client.post("/remove_row", json={"name": data["product_data"]["name"]}))
+            assert response.status_code == 302
+    
+    return latencies
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100, help="Request rounds per worker")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--session-backend", choices=["filesystem", "cookie", "redis"], default="filesystem")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0", help="Used by the redis session backend")
+    parser.add_argument("--database-url")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    
+    scraper = start_fake_scraper(args.latency, args.failure_rate)
+    os.environ["API_IP"] = scraper.url
+    os.environ["BROKER_URL"] = "memory://"
+    os.environ["RESULT_BACKEND"] = "cache+memory://"
+    os.environ["SESSION_BACKEND"] = args.session_backend
+    os.environ["PASSWORD_HASH_ITERATIONS"] = str(ITERATIONS)
+    # The test client has no Waitress threads to protect, every worker thread gets a hashing slot
+    os.environ["PASSWORD_HASH_QUEUE"] = str(max(args.concurrency))
+    if args.session_backend == "redis":
+        os.environ["CACHE_URL"] = args.redis_url
+    
+    app, work_dir = load_app(args.database_url)
+    
+    session_latencies = {"open": [], "save": []}
+    app.session_interface = RecordingSessionInterface(app.session_interface, session_latencies)
+    
+    # Run the Celery tasks in the request itself and keep their results for /add_product/status
+    app.extensions["celery"].conf.update(task_always_eager=True, task_store_eager_result=True)
+    
+    from modules.passwords import hash_password
+    from modules.models import User, Product, UserProduct, db
+    
+    with app.app_context():
+        usernames = seed(db, User, Product, UserProduct, hash_password, max(args.concurrency), args.products)
+    
+    results = []
+    for concurrency in args.concurrency:
+        session_latencies["open"].clear()
+        session_latencies["save"].clear()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(run_worker, app, usernames[worker], f"{concurrency}-{worker}", args.requests)
+                       for worker in range(0, concurrency)]
+            worker_latencies = [future.result() for future in futures]
+        wall_time = time.perf_counter() - started
+        
+        for route in worker_latencies[0]:
+            latencies = [latency for latencies in worker_latencies for latency in latencies[route]]
+            # Throughput over the time spent in this route, summed over the workers running side by side
+            route_time = sum(latencies) / concurrency
+            result = {"route": route, "concurrency": concurrency}
+            result.update(summarise_latencies(latencies, route_time))
+            results.append(result)
+        
+        for operation in ("open", "save"):
+            result = {"session": f"{args.session_backend} {operation}", "concurrency": concurrency}
+            result.update(summarise_latencies(session_latencies[operation], sum(session_latencies[operation]) / concurrency))
+            results.append(result)
+        
+        results.append({"route": "total", "concurrency": concurrency, "wall_time": round(wall_time, 3)})
+    
+    results.append({"scraper": {"latency": args.latency, "failure_rate": args.failure_rate,
+                                "requests": scraper.requests, "failures": scraper.failures}})
+    write_results("routes", results, args.output)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+from common import ROOT_DIR, load_app, percentile, write_results
+import subprocess
+import importlib
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+'''
+
+Startup benchmark for the web and worker processes.
+
+Imports app.py (the Waitress process) and modules/celery_app.py (the Celery worker and beat process) in fresh
+Python processes against an already migrated SQLite database, and records how long the import takes,
+how many SQL queries ran during startup and how many modules got loaded.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--targets app modules.celery_app] [--output results.json]
+
+'''
+
+
+def child(target, database_url):
+    work_dir = tempfile.mkdtemp(prefix="discountchecker-bench-")
+    os.chdir(work_dir)
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    sys.path.insert(0, ROOT_DIR)
+    
+    started = time.perf_counter()
+    import modules
+    modules.load_dotenv = lambda *args, **kwargs: None
+    importlib.import_module(target)
+    startup_time = time.perf_counter() - started
+    
+    from modules.metrics import db_queries
+    print(json.dumps({"startup_s": startup_time, "queries": db_queries.get(), "modules": len(sys.modules)}))
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--targets", nargs="+", default=["app", "modules.celery_app"])
+    parser.add_argument("--output")
+    parser.add_argument("--child", nargs=2)
+    args = parser.parse_args()
+    
+    if args.child:
+        child(*args.child)
+        return
+    
+    # Migrate the database once up front, like a deploy does
+    app, work_dir = load_app()
+    database_url = app.config["SQLALCHEMY_DATABASE_URI"]
+    
+    results = []
+    for target in args.targets:
+        runs = []
+        for i in range(0, args.runs):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", target, database_url],
+                                    check=True, capture_output=True, text=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        
+        startup_times = [run["startup_s"] for run in runs]
+        results.append({"target": target,
+                        "runs": args.runs,
+                        "startup_p50_ms": round(percentile(startup_times, 0.5) * 1000, 1),
+                        "startup_max_ms": round(max(startup_times) * 1000, 1),
+                        "queries": runs[-1]["queries"],
+                        "modules": runs[-1]["modules"]})
+    
+    write_results("startup", results, args.output)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from common import load_app, write_results
+from fake_scraper import start_fake_scraper
+import argparse
+import time
+import os
+
+'''
+
+Benchmark for the rescrape tasks.
+
+Seeds the products and userProducts tables and runs scheduled_rescrape and scheduled_user_rescrape against
+the local fake scraper, recording the wall time and the summary each task returns. Failed scrapes are
+re-enqueued on an in-memory broker that no worker reads from, so retries are counted but never run.
+
+Usage: python benchmarks/bench_tasks.py [--sizes 100 1000] [--users 50] [--latency 0.05]
+                                        [--failure-rate 0.02] [--change-rate 0.1] [--database-url URL] [--output results.json]
+
+'''
+
+
+def seed(db, User, Product, UserProduct, product_count, users):
+    # Every user tracks 5 products, the users overlap so the user rescrape has duplicates to skip
+    db.session.bulk_insert_mappings(Product, [{"URL": f"https://www.bol.com/nl/nl/p/seeded-product-{i}",
+                                               "name": f"Seeded product {i}",
+                                               "ogPrice": 100,
+                                               "currentPrice": 80} for i in range(0, product_count)])
+    db.session.bulk_insert_mappings(User, [{"username": f"bench-user-{i}", "passwordHash": "not-a-real-hash"}
+                                           for i in range(0, users)])
+    db.session.commit()
+    
+    product_ids = [id for (id,) in db.session.query(Product.id).order_by(Product.id)]
+    user_ids = [id for (id,) in db.session.query(User.id).order_by(User.id)]
+    db.session.bulk_insert_mappings(UserProduct, [{"userID": user_id, "productID": product_ids[(i * 2 + n) % len(product_ids)]}
+                                                  for i, user_id in enumerate(user_ids) for n in range(0, 5)])
+    db.session.commit()
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--change-rate", type=float, default=0.1)
+    parser.add_argument("--database-url")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    
+    scraper = start_fake_scraper(args.latency, args.failure_rate, args.change_rate)
+    os.environ["API_IP"] = scraper.url
+    os.environ["BROKER_URL"] = "memory://"
+    os.environ["RESULT_BACKEND"] = "cache+memory://"
+    
+    app, work_dir = load_app(args.database_url)
+    
+    from modules.models import User, Product, UserProduct, RescrapeRun, db
+    from modules.tasks import scheduled_rescrape, scheduled_user_rescrape
+    from modules.cache import scrape_cache
+    from modules.retry import scraper_breaker
+    
+    results = []
+    with app.app_context():
+        for size in args.sizes:
+            db.drop_all()
+            db.create_all()
+            seed(db, User, Product, UserProduct, size, args.users)
+            
+            for name, task in (("scheduled_rescrape", scheduled_rescrape), ("scheduled_user_rescrape", scheduled_user_rescrape)):
+                # Every task starts cold, without cached scrapes or a tripped breaker from the previous one
+                scrape_cache.local.entries.clear()
+                scraper_breaker.record_success()
+                scraper_requests = scraper.requests
+                
+                started = time.perf_counter()
+                summary = task()
+                wall_time = time.perf_counter() - started
+                
+                results.append({"task": name,
+                                "products": size,
+                                "wall_time": round(wall_time, 3),
+                                "scraper_requests": scraper.requests - scraper_requests,
+                                "summary": summary})
+            
+            db.session.query(RescrapeRun).delete()
+            db.session.commit()
+    
+    write_results("tasks", results, args.output)
+
+
+
+if __name__ == "__main__":
+    main()
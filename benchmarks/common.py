@@ -0,0 +1,107 @@
+import subprocess
+import datetime
+import json
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+'''
+
+Shared helpers for the benchmark scripts in this folder.
+
+The benchmarks run the real Flask app against a throwaway SQLite database inside a temporary
+working directory, so the session files and scraper_logs.txt they produce never end up in the repo.
+The .env file is not loaded, that way a benchmark can never touch the production database.
+
+'''
+
+
+def load_app(database_url=None):
+    '''
+    Import app.py against a SQLite database in a temporary working directory, migrate the database
+    like "flask --app app migrate" does and return (app, work_dir).
+    
+    '''
+    work_dir = tempfile.mkdtemp(prefix="discountchecker-bench-")
+    os.chdir(work_dir)
+    
+    os.environ["DATABASE_URL"] = database_url or f"sqlite:///{os.path.join(work_dir, 'bench.db')}"
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    
+    # Skip the .env file, create_app loads it with override=True which would replace DATABASE_URL
+    import modules
+    modules.load_dotenv = lambda *args, **kwargs: None
+    
+    import app as app_module
+    from modules.migrations import run_migrations
+    with app_module.app.app_context():
+        run_migrations()
+    return app_module.app, work_dir
+
+
+
+class QueryCounter:
+    '''
+    Counts the SQL statements executed on an engine while the counter is active.
+    
+    '''
+    
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        self.engine = engine
+        event.listen(engine, "before_cursor_execute", self._count)
+        
+    def _count(self, *args, **kwargs):
+        self.count += 1
+        
+    def reset(self):
+        count, self.count = self.count, 0
+        return count
+
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[int(fraction * (len(values) - 1))]
+
+
+
+def summarise_latencies(latencies, wall_time):
+    # Throughput and latency percentiles of a batch of requests, latencies in seconds
+    return {"requests": len(latencies),
+            "throughput": round(len(latencies) / wall_time, 2) if wall_time else 0.0,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3)}
+
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+def write_results(name, results, output=None):
+    '''
+    Print the results as JSON and write them to the output file if one is given.
+    The commit the results were measured on is recorded with them, so runs of different commits can be compared.
+    
+    '''
+    document = json.dumps({"benchmark": name,
+                           "commit": git_commit(),
+                           "recorded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                           "results": results}, indent=4, default=str)
+    print(document)
+    
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            file.write(document)
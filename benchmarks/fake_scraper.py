@@ -0,0 +1,116 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import threading
+import argparse
+import random
+import zlib
+import json
+import time
+
+'''
+
+Local stand-in for the scraper API.
+
+Answers /user_scrape/scrape and /scheduled_scrape/scrape like the real scraper does, after a configurable
+latency and with a configurable share of failed scrapes. Every URL gets its own product name and a stable
+price, a share of the rescrapes returns a lower price so the rescrape tasks also have price updates to write.
+The benchmarks start it in a thread with start_fake_scraper(), it can also run on its own
+to point a local deployment at it with API_IP.
+
+Usage: python benchmarks/fake_scraper.py [--port 8000] [--latency 0.2] [--failure-rate 0.05] [--change-rate 0.1]
+
+'''
+
+
+class FakeScraperHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, without this delayed ACKs add 40ms to every keep-alive request
+    disable_nagle_algorithm = True
+    
+    def do_GET(self):
+        server = self.server
+        parsed = urlparse(self.path)
+        URL = parse_qs(parsed.query).get("url", [""])[0]
+        
+        if parsed.path not in ("/user_scrape/scrape", "/scheduled_scrape/scrape") or not URL:
+            return self.respond(404, {"error": "Not found"})
+        
+        if server.latency:
+            time.sleep(server.latency)
+        
+        with server.lock:
+            server.requests += 1
+        
+        if random.random() < server.failure_rate:
+            with server.lock:
+                server.failures += 1
+            return self.respond(500, {"error": "Fake scraper failure"})
+        
+        # Stable price per URL, rescrapes lower it now and then
+        price = 10 + zlib.crc32(URL.encode()) % 9000 / 10
+        current_price = price
+        if parsed.path.startswith("/scheduled_scrape") and random.random() < server.change_rate:
+            current_price = round(price * 0.9, 2)
+        
+        self.respond(200, {"name": f"Fake product {zlib.crc32(URL.encode()):08x}",
+                           "currentPrice": f"{current_price:.2f}",
+                           "ogPrice": f"{price:.2f}"})
+    
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+
+class FakeScraperServer(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, address, latency=0.0, failure_rate=0.0, change_rate=0.0):
+        super().__init__(address, FakeScraperHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.change_rate = change_rate
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+
+def start_fake_scraper(latency=0.0, failure_rate=0.0, change_rate=0.0, port=0):
+    '''
+    Start the fake scraper in a daemon thread and return the server, its base URL is server.url.
+    
+    '''
+    server = FakeScraperServer(("127.0.0.1", port), latency, failure_rate, change_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--change-rate", type=float, default=0.1)
+    args = parser.parse_args()
+    
+    server = FakeScraperServer(("127.0.0.1", args.port), args.latency, args.failure_rate, args.change_rate)
+    print(f"Fake scraper listening on {server.url}")
+    server.serve_forever()
+
+
+
+if __name__ == "__main__":
+    main()
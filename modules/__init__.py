@@ -1,9 +1,11 @@
 from flask import Flask, flash, redirect, render_template, request, session, jsonify, url_for
-from flask_session import Session
 from werkzeug.middleware.proxy_fix import ProxyFix
 from modules.models import User, UserProduct, Product, db
-from modules.celery_utils import celery_init_app
+from modules.metrics import init_metrics
+from modules.sessions import init_sessions
 from dotenv import load_dotenv
+import click
+import json
 import os
 
 
@@ -17,7 +19,6 @@ def create_app():
     app = Flask(__name__, template_folder=template_dir, static_folder=static_dir)
     app.secret_key = os.getenv("SECRET_KEY")
     app.config["SESSION_PERMANENT"] = False
-    app.config["SESSION_TYPE"] = "filesystem"
     app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["--no-reload"] = False
@@ -28,11 +29,40 @@ def create_app():
                             "timezone": "Europe/Amsterdam",
                             "enable_utc": False}
 
-    Session(app)
+    # Redis, signed cookie or filesystem sessions, see modules/sessions.py
+    init_sessions(app)
     db.init_app(app)
+    
+    # Route latency and SQL query metrics, served on /metrics
+    init_metrics(app)
 
-    with app.app_context():
-        db.create_all()
+    # The schema is not created or checked on startup, every web and worker process would hit the database at once on deploy.
+    # "flask --app app migrate" creates the tables and applies pending schema migrations, run it once per deploy
+    @app.cli.command("migrate")
+    def migrate():
+        from modules.migrations import run_migrations
+        applied = run_migrations()
+        click.echo(f"Applied migrations: {applied}" if applied else "Database is up to date")
+    
+    # "flask --app app import-products urls.csv [--username name]" imports a list or CSV of product URLs
+    @app.cli.command("import-products")
+    @click.argument("file", type=click.File("r", encoding="utf-8"))
+    @click.option("--username", help="Add the products to the list of this user, otherwise they are only stored")
+    def import_products(file, username):
+        from modules.bulk_import import read_urls, import_urls, stream_import_progress, BULK_IMPORT_MAX_URLS
+        
+        user_id = None
+        if username:
+            user = db.session.query(User).filter_by(username=username).first()
+            if user is None:
+                raise click.ClickException(f"Unknown user: {username}")
+            user_id = user.id
+        
+        raw_urls = read_urls(file.read())
+        for start in range(0, len(raw_urls), BULK_IMPORT_MAX_URLS):
+            result = import_urls(raw_urls[start:start + BULK_IMPORT_MAX_URLS], user_id)
+            for event in stream_import_progress(result, user_id):
+                click.echo(json.dumps(event, default=str))
 
     if os.getenv("USE_PROXY_FIX") == "true":
         app.wsgi_app = ProxyFix(
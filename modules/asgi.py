@@ -0,0 +1,254 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from modules.helpers import log_to_file
+import asyncio
+import json
+import sys
+import io
+import os
+
+'''
+
+Async serving mode.
+
+Waitress serves the app with 2 threads, so at most 2 requests are in flight and a request that waits on
+a scrape holds one of them. create_asgi_app() wraps the Flask app in an ASGI app for uvicorn
+(SERVER_MODE=asgi in app.py). The Flask routes still run as they are, on a pool of ASGI_WSGI_THREADS threads,
+but a POST to /add_product that queues a scrape is finished on the event loop: the connection waits for the
+Celery result without holding a thread, then the status route runs once to hand the product to the user.
+The result backend is still checked with the blocking Celery client, those checks run on a separate pool of
+ASGI_STATUS_THREADS threads so they neither stall the event loop nor wait behind the Flask routes.
+The client gets the product in one response instead of polling /add_product/status every second.
+
+If the scrape takes longer than ASYNC_PRODUCT_WAIT_TIMEOUT seconds the pending response is returned
+and the client polls the status route like it does with Waitress.
+
+'''
+
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "2"))
+ASGI_STATUS_THREADS = int(os.getenv("ASGI_STATUS_THREADS", "2"))
+ASYNC_PRODUCT_WAIT_TIMEOUT = float(os.getenv("ASYNC_PRODUCT_WAIT_TIMEOUT", "50"))
+ASYNC_PRODUCT_POLL_INTERVAL = float(os.getenv("ASYNC_PRODUCT_POLL_INTERVAL", "0.2"))
+
+
+def build_environ(scope, body, url_prefix=""):
+    '''
+    Return the WSGI environ of an ASGI http scope, the url_prefix is moved to SCRIPT_NAME like Waitress does.
+
+    '''
+    path = scope["path"]
+    script_name = scope.get("root_path", "") or url_prefix
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+
+    environ = {"REQUEST_METHOD": scope["method"],
+               "SCRIPT_NAME": script_name.encode("utf-8").decode("latin1"),
+               "PATH_INFO": path.encode("utf-8").decode("latin1"),
+               "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+               "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+               "SERVER_NAME": (scope.get("server") or ("localhost", 80))[0],
+               "SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+               "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+               "wsgi.version": (1, 0),
+               "wsgi.url_scheme": scope.get("scheme", "http"),
+               "wsgi.input": io.BytesIO(body),
+               # The whole body is read before the app runs, so chunked requests without a Content-Length work too
+               "wsgi.input_terminated": True,
+               "wsgi.errors": sys.stderr,
+               "wsgi.multithread": True,
+               "wsgi.multiprocess": True,
+               "wsgi.run_once": False}
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        value = value.decode("latin1")
+        # Repeated headers are joined, cookies with a semicolon like browsers send them
+        if name in environ:
+            value = environ[name] + ("; " if name == "HTTP_COOKIE" else ",") + value
+        environ[name] = value
+    return environ
+
+
+
+def merge_cookies(headers, response_headers):
+    '''
+    Return the request headers with the cookies of response_headers applied, so a second request
+    sees the session the first response saved.
+
+    '''
+    cookies = SimpleCookie()
+    for name, value in headers:
+        if name == b"cookie":
+            cookies.load(value.decode("latin1"))
+    for name, value in response_headers:
+        if name == b"set-cookie":
+            cookies.load(value.decode("latin1"))
+
+    merged = [(name, value) for name, value in headers if name != b"cookie"]
+    if cookies:
+        merged.append((b"cookie", "; ".join(f"{key}={morsel.coded_value}" for key, morsel in cookies.items()).encode("latin1")))
+    return merged
+
+
+
+def scrape_ready(task_id):
+    # A single GET on the result backend, it blocks so AsyncApp runs it on its status threads
+    from modules.tasks import scrape_and_store_product
+    return scrape_and_store_product.AsyncResult(task_id).ready()
+
+
+
+class AsyncApp:
+    '''
+    ASGI app that runs the Flask app on a thread pool and waits on product scrapes on the event loop.
+
+    '''
+
+    def __init__(self, wsgi_app, url_prefix="", threads=None, is_ready=scrape_ready):
+        self.wsgi_app = wsgi_app
+        self.url_prefix = url_prefix.rstrip("/")
+        self.executor = ThreadPoolExecutor(max_workers=threads or ASGI_WSGI_THREADS, thread_name_prefix="asgi-wsgi")
+        self.status_executor = ThreadPoolExecutor(max_workers=ASGI_STATUS_THREADS, thread_name_prefix="asgi-status")
+        self.is_ready = is_ready
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        # Same as the url_prefix of Waitress, requests outside the prefix are not for this app
+        if self.url_prefix and not scope["path"].startswith(self.url_prefix):
+            return await self.send_response(send, 404, [(b"content-type", b"text/plain")], b"Not Found")
+
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        path = scope["path"][len(self.url_prefix):]
+        if scope["method"] == "POST" and path == "/add_product":
+            return await self.add_product(scope, body, send)
+        await self.call_wsgi(scope, body, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                self.status_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def call_wsgi(self, scope, body, send):
+        '''
+        Run the Flask app for one request on the thread pool, the response is streamed to send as it is produced.
+
+        '''
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, body, self.url_prefix)
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        await loop.run_in_executor(self.executor, self.run_wsgi, environ, send_from_thread)
+
+    def run_wsgi(self, environ, send):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get("started"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["start"] = {"type": "http.response.start",
+                                 "status": int(status.split(" ", 1)[0]),
+                                 "headers": [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers]}
+
+        chunks = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if not response.get("started"):
+                    response["started"] = True
+                    send(response["start"])
+                send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            # Runs the teardown of streamed responses
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+        if not response.get("started"):
+            send(response["start"])
+        send({"type": "http.response.body", "body": b""})
+
+    async def call_flask(self, scope, body):
+        # Run a request through the Flask app and return (status, headers, body) instead of sending it
+        messages = []
+
+        async def capture(message):
+            messages.append(message)
+
+        await self.call_wsgi(scope, body, capture)
+        return messages[0]["status"], messages[0]["headers"], b"".join(message.get("body", b"") for message in messages[1:])
+
+    async def send_response(self, send, status, headers, body):
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def add_product(self, scope, body, send):
+        '''
+        Run /add_product, if it queued a scrape wait for it here and answer with the result of the status route.
+
+        '''
+        status, headers, content = await self.call_flask(scope, body)
+
+        result = None
+        if status == 200 and (dict(headers).get(b"content-type") or b"").startswith(b"application/json"):
+            result = json.loads(content)
+        if not (result and result.get("pending")):
+            return await self.send_response(send, status, headers, content)
+
+        task_id = result["task_id"]
+        if not await self.wait_for_task(task_id):
+            log_to_file(f"Product scrape not done within {ASYNC_PRODUCT_WAIT_TIMEOUT}s, client polls: {task_id}", "INFO")
+            return await self.send_response(send, status, headers, content)
+
+        # The status route needs the session the add_product response saved, the task ID is stored in it
+        status_scope = dict(scope,
+                            method="GET",
+                            path=f"{self.url_prefix}/add_product/status/{task_id}",
+                            raw_path=f"{self.url_prefix}/add_product/status/{task_id}".encode("latin1"),
+                            query_string=b"",
+                            headers=merge_cookies([(name, value) for name, value in scope.get("headers", [])
+                                                   if name not in (b"content-type", b"content-length")], headers))
+        status, final_headers, content = await self.call_flask(status_scope, b"")
+
+        # Cookies of both responses are passed on, the ones of the status route come last and win
+        cookies = [(name, value) for name, value in headers if name == b"set-cookie"]
+        await self.send_response(send, status, cookies + final_headers, content)
+
+    async def wait_for_task(self, task_id):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ASYNC_PRODUCT_WAIT_TIMEOUT
+        while not await loop.run_in_executor(self.status_executor, self.is_ready, task_id):
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(ASYNC_PRODUCT_POLL_INTERVAL)
+        return True
+
+
+
+def create_asgi_app(app, url_prefix="", threads=None):
+    '''
+    Return the ASGI app that serves app, run it with uvicorn.
+
+    '''
+    return AsyncApp(app, url_prefix, threads)
@@ -0,0 +1,217 @@
+from celery import group
+from celery.utils import uuid
+from modules.models import UserProduct, Product, db
+from modules.functions import standardise_URL, validate_URL, check_product_existence, MAX_USER_PRODUCTS
+from modules.cache import single_flight, product_list_cache
+from modules.helpers import log_to_file
+from modules.tasks import scrape_and_store_product
+from sqlalchemy.exc import IntegrityError
+import time
+import csv
+import io
+import os
+
+'''
+
+Bulk import of product URLs.
+
+Used by the /bulk_import route and the "flask --app app import-products" command. All URLs are standardised,
+validated and deduplicated in one pass, the ones that are already in the products table are looked up with a
+single IN query and linked to the user in one insert. Only the unknown URLs go to the scraper, as one Celery group
+on the user_requests queue. The route answers right away with the task ID of every scrape and the client polls
+/bulk_import/status, which calls scrape_outcome(). The import-products command runs in its own process, it follows
+the scrapes with stream_import_progress() instead.
+
+'''
+
+BULK_IMPORT_MAX_URLS = int(os.getenv("BULK_IMPORT_MAX_URLS", "500"))
+BULK_IMPORT_POLL_INTERVAL = float(os.getenv("BULK_IMPORT_POLL_INTERVAL", "1"))
+BULK_IMPORT_TIMEOUT = float(os.getenv("BULK_IMPORT_TIMEOUT", "120"))
+
+
+def read_urls(text):
+    '''
+    Return the URLs in text, one URL per line or the cells of a CSV file separated by commas, semicolons or tabs.
+    Header cells and other text are returned as well, they end up as invalid URLs.
+
+    '''
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+
+    return [cell.strip() for row in csv.reader(io.StringIO(text), dialect) for cell in row if cell.strip()]
+
+
+
+def prepare_urls(raw_urls):
+    '''
+    Standardise, validate and deduplicate raw_urls in a single pass, keeping the original order.
+    Returns (urls, invalid, duplicates) with the amount of duplicates that were dropped.
+
+    '''
+    seen = set()
+    urls = []
+    invalid = []
+    duplicates = 0
+
+    for raw_URL in raw_urls:
+        URL = standardise_URL(raw_URL)
+        if not validate_URL(URL):
+            invalid.append(raw_URL)
+        elif URL in seen:
+            duplicates += 1
+        else:
+            seen.add(URL)
+            urls.append(URL)
+
+    return urls, invalid, duplicates
+
+
+
+def link_products(user_id, product_ids):
+    # One insert for every link, if another request linked one of them in the meantime fall back to one at a time
+    try:
+        db.session.bulk_insert_mappings(UserProduct, [{"userID": user_id, "productID": id} for id in product_ids])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        for product_id in product_ids:
+            check_product_existence(None, product_id, user_id)
+
+    product_list_cache.invalidate_user(user_id)
+
+
+
+def import_urls(raw_urls, user_id=None):
+    '''
+    Import raw_urls for the user, or only into the products table when user_id is None.
+    A user can not go over MAX_USER_PRODUCTS, URLs past the limit are reported in over_limit.
+
+    Returns a dict with:
+        queued: {URL: task_id} of the scrapes that were dispatched, or that were already in flight
+        existing: URLs that were already in the products table, linked to the user
+        already_tracked: URLs the user already has in their list
+        over_limit: URLs that would take the user over MAX_USER_PRODUCTS
+        invalid: URLs that did not validate
+        duplicates: Amount of duplicate URLs that were dropped
+
+    '''
+    if len(raw_urls) > BULK_IMPORT_MAX_URLS:
+        raise ValueError(f"At most {BULK_IMPORT_MAX_URLS} URLs can be imported at once.")
+
+    urls, invalid, duplicates = prepare_urls(raw_urls)
+    result = {"queued": {}, "existing": [], "already_tracked": [], "over_limit": [], "invalid": invalid, "duplicates": duplicates}
+
+    known = dict(db.session.query(Product.URL, Product.id).filter(Product.URL.in_(urls)).all()) if urls else {}
+
+    tracked = set()
+    room = None
+    if user_id is not None:
+        tracked = {product_id for (product_id,) in db.session.query(UserProduct.productID).filter_by(userID=user_id)}
+        room = MAX_USER_PRODUCTS - len(tracked)
+
+    new_links = []
+    unknown = []
+    for URL in urls:
+        product_id = known.get(URL)
+        if product_id in tracked:
+            result["already_tracked"].append(URL)
+            continue
+
+        if room is not None:
+            if room <= 0:
+                result["over_limit"].append(URL)
+                continue
+            room -= 1
+
+        if product_id is None:
+            unknown.append(URL)
+        else:
+            result["existing"].append(URL)
+            new_links.append(product_id)
+
+    if user_id is not None and new_links:
+        link_products(user_id, new_links)
+
+    # URLs that another request is already scraping attach to that scrape, like /add_product does
+    signatures = []
+    for URL in unknown:
+        task_id = uuid()
+        owner_id = single_flight.claim(URL, task_id)
+        if owner_id == task_id:
+            signatures.append(scrape_and_store_product.s(URL, user_id).set(task_id=task_id, queue='user_requests'))
+        result["queued"][URL] = owner_id
+
+    if signatures:
+        group(signatures).apply_async()
+
+    log_to_file(f"Bulk import: {len(result['queued'])} scrapes, {len(result['existing'])} existing products, "
+                f"{len(invalid)} invalid, {duplicates} duplicates", "INFO", user_id)
+    return result
+
+
+
+def import_summary(result):
+    # The amount of URLs of an import_urls result per outcome
+    return {"queued": len(result["queued"]),
+            "existing": len(result["existing"]),
+            "already_tracked": len(result["already_tracked"]),
+            "over_limit": len(result["over_limit"]),
+            "invalid": len(result["invalid"]),
+            "duplicates": result["duplicates"]}
+
+
+
+def scrape_outcome(task_id, user_id=None):
+    '''
+    Return the result of a finished product scrape, or None while it is still running.
+    Scrapes started by another request only linked the product for that requests user, it is linked for user_id here.
+
+    '''
+    task_result = scrape_and_store_product.AsyncResult(task_id)
+    if not task_result.ready():
+        return None
+
+    if task_result.failed():
+        return {"success": False, "message": "Error processing product data"}
+
+    outcome = task_result.result
+    if outcome.get("success") and user_id is not None:
+        check_product_existence(outcome["product_data"]["URL"], outcome["product_data"]["id"], user_id)
+    return outcome
+
+
+
+def stream_import_progress(result, user_id=None, timeout=None):
+    '''
+    Yield progress events of an import_urls result: a summary first, then one event per scrape as it finishes
+    and a final event with the task IDs that did not finish within timeout seconds.
+    Blocks until every scrape finished or timed out, only meant for the import-products command.
+
+    '''
+    timeout = timeout or BULK_IMPORT_TIMEOUT
+    pending = dict(result["queued"])
+    total = len(pending)
+    done = 0
+
+    yield dict(event="summary", **import_summary(result))
+
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        for URL, task_id in list(pending.items()):
+            outcome = scrape_outcome(task_id, user_id)
+            if outcome is None:
+                continue
+
+            del pending[URL]
+            done += 1
+
+            event = {"event": "product", "URL": URL, "done": done, "total": total}
+            event.update(outcome)
+            yield event
+
+        if pending:
+            time.sleep(BULK_IMPORT_POLL_INTERVAL)
+
+    yield {"event": "finished", "done": done, "total": total, "pending": list(pending.values())}
@@ -0,0 +1,374 @@
+from collections import OrderedDict
+from modules.helpers import log_to_file
+from modules.scrape_result import ScrapeResult
+from modules.metrics import scrape_cache_lookups
+import msgspec
+import threading
+import json
+import time
+import os
+
+'''
+
+Result cache for the scraper API.
+
+Responses are cached per standardised product URL, so a product that was scraped minutes ago
+by another user or by the previous retry does not hit the scraper again. The cache lives in Redis
+since Redis is already the Celery broker, that way every worker process shares the same entries.
+Without Redis, or when Redis can not be reached, an in-process LRU cache is used instead.
+
+Every entry stores when it was scraped and every call path passes its own max age,
+that way the same entry can be fresh enough for one path but too old for another.
+Entries hold the ScrapeResult itself and are read back from Redis with a typed msgspec decoder.
+
+The same Redis client backs SingleFlight, which coalesces concurrent adds of the same new product into one scrape,
+and ProductListCache, which keeps the product table of every user for the index route.
+
+'''
+
+CACHE_URL = os.getenv("CACHE_URL") or os.getenv("BROKER_URL") or ""
+SCRAPE_CACHE_TTL_USER = int(os.getenv("SCRAPE_CACHE_TTL_USER", "900"))
+SCRAPE_CACHE_TTL_RESCRAPE = int(os.getenv("SCRAPE_CACHE_TTL_RESCRAPE", "300"))
+SCRAPE_CACHE_SIZE = int(os.getenv("SCRAPE_CACHE_SIZE", "1024"))
+SINGLE_FLIGHT_TTL = int(os.getenv("SINGLE_FLIGHT_TTL", "120"))
+PRODUCT_LIST_CACHE_TTL = int(os.getenv("PRODUCT_LIST_CACHE_TTL", "300"))
+
+
+_redis_client = None
+_redis_lock = threading.Lock()
+
+
+def get_redis():
+    '''
+    Return the shared Redis client, or None if no Redis URL is configured.
+
+    '''
+    global _redis_client
+
+    if not CACHE_URL.startswith(("redis://", "rediss://", "unix://")):
+        return None
+
+    if _redis_client is None:
+        with _redis_lock:
+            if _redis_client is None:
+                import redis
+                _redis_client = redis.Redis.from_url(CACHE_URL, socket_timeout=1, socket_connect_timeout=1)
+    return _redis_client
+
+
+
+class LRUCache:
+    '''
+    Thread safe in-process cache that drops the least recently used entry once it is full
+    and treats entries older than their TTL as missing.
+
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+
+class CachedScrape(msgspec.Struct):
+    scraped_at: float
+    data: ScrapeResult
+
+
+
+# Not strict, entries written before the prices were typed still hold them as strings
+_cached_scrape_decoder = msgspec.json.Decoder(CachedScrape, strict=False)
+
+
+class ScrapeCache:
+    '''
+    Cache of successful scraper responses keyed by standardised URL, with hit and miss counters per call path.
+    The counters are also on /metrics as scrape_cache_lookups_total.
+
+    '''
+
+    def __init__(self, prefix="scrape", max_size=None):
+        self.prefix = prefix
+        self.local = LRUCache(max_size or SCRAPE_CACHE_SIZE)
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    def key(self, URL):
+        return f"{self.prefix}:{URL}"
+
+    def read(self, key):
+        client = get_redis()
+        if client is not None:
+            try:
+                raw = client.get(key)
+                return _cached_scrape_decoder.decode(raw) if raw else None
+            except Exception as e:
+                log_to_file(f"Scrape cache unavailable, using local cache: {e}", "ERROR")
+        return self.local.get(key)
+
+    def write(self, key, entry, ttl):
+        client = get_redis()
+        if client is not None:
+            try:
+                client.set(key, msgspec.json.encode(entry), ex=ttl)
+                return
+            except Exception as e:
+                log_to_file(f"Scrape cache unavailable, using local cache: {e}", "ERROR")
+        self.local.set(key, entry, ttl)
+
+    def count(self, counter, path):
+        with self.lock:
+            counter[path] = counter.get(path, 0) + 1
+        scrape_cache_lookups.inc(cache=self.prefix, path=path, outcome="hit" if counter is self.hits else "miss")
+
+    def get(self, URL, max_age, path):
+        '''
+        Return the cached response for URL if it was scraped less than max_age seconds ago, otherwise None.
+
+        '''
+        entry = self.read(self.key(URL))
+
+        if entry is None or time.time() - entry.scraped_at > max_age:
+            self.count(self.misses, path)
+            return None
+
+        self.count(self.hits, path)
+        return entry.data
+
+    def set(self, URL, result):
+        # Only successful scrapes are cached, errors should be retried right away
+        if not isinstance(result, ScrapeResult):
+            return
+
+        entry = CachedScrape(scraped_at=time.time(), data=result)
+        self.write(self.key(URL), entry, max(SCRAPE_CACHE_TTL_USER, SCRAPE_CACHE_TTL_RESCRAPE))
+
+    def stats(self):
+        with self.lock:
+            return {"hits": dict(self.hits), "misses": dict(self.misses)}
+
+
+
+scrape_cache = ScrapeCache()
+
+
+
+class SingleFlight:
+    '''
+    Makes sure only one scrape per standardised URL is in flight at a time.
+    The first request claims the URL with its Celery task ID, every request for the same URL
+    that comes in while that task runs gets the ID of the owning task back and attaches to its result.
+    Claims expire after SINGLE_FLIGHT_TTL seconds in case the owning task never releases it.
+
+    '''
+
+    def __init__(self, prefix="inflight", ttl=None):
+        self.prefix = prefix
+        self.ttl = ttl or SINGLE_FLIGHT_TTL
+        self.local = {}
+        self.lock = threading.Lock()
+
+    def key(self, URL):
+        return f"{self.prefix}:{URL}"
+
+    def claim(self, URL, task_id):
+        '''
+        Claim URL for task_id. Returns task_id if the claim succeeded, otherwise the ID of the task that owns the URL.
+
+        '''
+        key = self.key(URL)
+
+        client = get_redis()
+        if client is not None:
+            try:
+                # SET NX only succeeds for the first request, the loop covers a claim that expires in between
+                while True:
+                    if client.set(key, task_id, nx=True, ex=self.ttl):
+                        return task_id
+                    owner = client.get(key)
+                    if owner:
+                        return owner.decode()
+            except Exception as e:
+                log_to_file(f"Single flight store unavailable, using local claims: {e}", "ERROR")
+
+        with self.lock:
+            owner, expires_at = self.local.get(key, (None, 0))
+            if owner is None or expires_at < time.monotonic():
+                self.local[key] = (task_id, time.monotonic() + self.ttl)
+                return task_id
+            return owner
+
+    def release(self, URL, task_id):
+        # Only the owning task may release its claim, a newer claim by another task stays untouched
+        key = self.key(URL)
+
+        client = get_redis()
+        if client is not None:
+            try:
+                client.eval(RELEASE_SCRIPT, 1, key, task_id)
+                return
+            except Exception as e:
+                log_to_file(f"Single flight store unavailable, using local claims: {e}", "ERROR")
+
+        with self.lock:
+            if key in self.local and self.local[key][0] == task_id:
+                del self.local[key]
+
+
+
+# Deletes the claim only if it still belongs to the releasing task, in one atomic step
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+single_flight = SingleFlight()
+
+
+
+class ProductListCache:
+    '''
+    Cached product rows per user, the index route only queries the database when the list of a user changed.
+    Every cached list also adds its user to the watchers set of each of its products, that reverse
+    product -> users index lets a price update invalidate only the users that have the product in their list.
+
+    Only Redis is used by default, a rescrape in a worker process could not invalidate a list that is cached
+    in the memory of the web process. Entries expire after PRODUCT_LIST_CACHE_TTL seconds in any case,
+    which also bounds how long a list read just before an invalidation can stay cached.
+
+    '''
+
+    def __init__(self, prefix="products", ttl=None, local=False):
+        self.prefix = prefix
+        self.ttl = ttl or PRODUCT_LIST_CACHE_TTL
+        self.local = LRUCache(SCRAPE_CACHE_SIZE) if local else None
+        self.local_watchers = {}
+        self.lock = threading.Lock()
+
+    def user_key(self, user_id):
+        return f"{self.prefix}:user:{user_id}"
+
+    def watchers_key(self, product_id):
+        return f"{self.prefix}:watchers:{product_id}"
+
+    def get(self, user_id):
+        '''
+        Return the cached rows of the user as lists, or None if the list is not cached.
+
+        '''
+        client = get_redis()
+        if client is not None:
+            try:
+                raw = client.get(self.user_key(user_id))
+                return json.loads(raw) if raw else None
+            except Exception as e:
+                log_to_file(f"Product list cache unavailable: {e}", "ERROR")
+                return None
+
+        if self.local is not None:
+            return self.local.get(self.user_key(user_id))
+        return None
+
+    def set(self, user_id, rows):
+        # rows are lists that start with the product id
+        client = get_redis()
+        if client is not None:
+            try:
+                pipeline = client.pipeline(transaction=False)
+                pipeline.set(self.user_key(user_id), json.dumps(rows), ex=self.ttl)
+                for row in rows:
+                    pipeline.sadd(self.watchers_key(row[0]), user_id)
+                    # The watchers set has to outlive the newest list it points to
+                    pipeline.expire(self.watchers_key(row[0]), self.ttl)
+                pipeline.execute()
+            except Exception as e:
+                log_to_file(f"Product list cache unavailable: {e}", "ERROR")
+            return
+
+        if self.local is not None:
+            self.local.set(self.user_key(user_id), rows, self.ttl)
+            with self.lock:
+                for row in rows:
+                    self.local_watchers.setdefault(row[0], set()).add(user_id)
+
+    def invalidate_user(self, user_id):
+        client = get_redis()
+        if client is not None:
+            try:
+                client.delete(self.user_key(user_id))
+            except Exception as e:
+                log_to_file(f"Product list cache unavailable: {e}", "ERROR")
+            return
+
+        if self.local is not None:
+            self.local.delete(self.user_key(user_id))
+
+    def invalidate_products(self, product_ids):
+        '''
+        Drop the cached lists of every user that has one of product_ids in their list.
+        Returns the amount of users whose list was dropped.
+
+        '''
+        product_ids = list(product_ids)
+        if not product_ids:
+            return 0
+
+        client = get_redis()
+        if client is not None:
+            try:
+                pipeline = client.pipeline(transaction=False)
+                for product_id in product_ids:
+                    pipeline.smembers(self.watchers_key(product_id))
+                user_ids = {int(user_id) for members in pipeline.execute() for user_id in members}
+
+                keys = [self.user_key(user_id) for user_id in user_ids] + [self.watchers_key(id) for id in product_ids]
+                client.delete(*keys)
+                return len(user_ids)
+            except Exception as e:
+                log_to_file(f"Product list cache unavailable: {e}", "ERROR")
+                return 0
+
+        if self.local is None:
+            return 0
+
+        with self.lock:
+            user_ids = set()
+            for product_id in product_ids:
+                user_ids.update(self.local_watchers.pop(product_id, ()))
+        for user_id in user_ids:
+            self.local.delete(self.user_key(user_id))
+        return len(user_ids)
+
+
+
+product_list_cache = ProductListCache()
@@ -1,5 +1,6 @@
 from modules import create_app
-from modules.tasks import scheduled_rescrape
+from modules.tasks import scheduled_rescrape, scheduled_priority_rescrape
+from modules.scheduler import SCHEDULER_TICK_MINUTES
 from modules.celery_utils import celery_init_app
 from celery.schedules import crontab
 import time
@@ -8,15 +9,12 @@ import time
 app = create_app()
 celery = celery_init_app(app)
 
+# The priority scheduler spreads the rescrapes over the day within the hourly scraper budget,
+# scheduled_rescrape and scheduled_user_rescrape can still be run by hand for a full sweep
 celery.conf.beat_schedule = {
-    'run-every-tuesday-at-3am': {
-        'task': 'scheduled_rescrape',
-        'schedule': crontab(hour=3, minute=0, day_of_week=2),
-        'options': {'queue': 'scheduled_task'}
-    },
-    'run-every-day-besides-tuesday-at-3am': {
-        'task': 'scheduled_user_rescrape',
-        'schedule': crontab(hour=3, minute=0, day_of_week='0, 1, 3, 4, 5, 6'),
+    'priority-rescrape': {
+        'task': 'scheduled_priority_rescrape',
+        'schedule': crontab(minute=f'*/{SCHEDULER_TICK_MINUTES}'),
         'options': {'queue': 'scheduled_task'}
     }
 }
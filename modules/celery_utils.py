@@ -1,14 +1,20 @@
 from celery import Celery, Task
+from celery.signals import before_task_publish
 from flask import Flask
+from modules.metrics import run_task_with_metrics, stamp_published_at
 
 def celery_init_app(app: Flask) -> Celery:
     class FlaskTask(Task):
         def __call__(self, *args: object, **kwargs: object) -> object:
             with app.app_context():
-                return self.run(*args, **kwargs)
+                # Records the duration, queue wait and SQL queries of every task
+                return run_task_with_metrics(self, lambda: self.run(*args, **kwargs))
 
     celery_app = Celery(app.name, task_cls=FlaskTask)
     celery_app.config_from_object(app.config["CELERY"])
     celery_app.set_default()
+    
+    # Stamps every published task with its publish time for the queue wait metric
+    before_task_publish.connect(stamp_published_at, weak=False)
     app.extensions["celery"] = celery_app
     return celery_app
\ No newline at end of file
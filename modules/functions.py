@@ -1,50 +1,79 @@
-from modules.models import User, UserProduct, Product, db
+from modules.models import User, UserProduct, Product, PriceHistory, db
 from modules.helpers import log_to_file
+from modules.cache import scrape_cache, product_list_cache, SCRAPE_CACHE_TTL_RESCRAPE
+from modules.history import price_history_row
+from modules.http_client import http_get
+from modules.retry import scraper_breaker
+from modules.metrics import scraper_latency
+from modules.scrape_result import ScrapeResult, ScrapeError, decode_scrape
 from flask import jsonify
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from collections import namedtuple
 import requests
 import time
 import os
 
 
+# Maximum amount of products a user can track at a time
+MAX_USER_PRODUCTS = 5
 
-def store_product(dict_values, URL, user_id):
+# Lightweight read-only row used to render the product table, avoids building full ORM objects
+ProductRow = namedtuple("ProductRow", ["id", "URL", "name", "currentPrice", "ogPrice"])
+
+
+def store_product(result, URL, user_id):
     '''
     Function to store the newly scraped product into both the products table 
     and the userProducts table
     
     Args:
-        dictValues: Holds the data received from the scraper API
+        result: The ScrapeResult received from the scraper API
         URL: Holds the URL of the product that was scraped
-        user_id: Holds the user_id of the current users session
+        user_id: Holds the user_id of the user that requested the product, None to only store the product
+    
+    Returns the newly stored Product object
     
     '''
     try: 
         # Create product object to store it in the products table
         product = Product(
             URL=URL,
-            name=dict_values["name"],
-            ogPrice=dict_values["ogPrice"],
-            currentPrice=dict_values["currentPrice"]
+            name=result.name,
+            ogPrice=result.ogPrice,
+            currentPrice=result.currentPrice
         )
         db.session.add(product)
-        db.session.commit()
+        db.session.flush()
         
-        log_to_file(f"Product added to products table: {dict_values}", "INFO", user_id)
-        
-        # create a userProduct object using the user_id and the product_id to store it to the userProducts table
-        log_to_file("Adding product to userProducts table", "INFO", user_id)
-        
-        userProduct = UserProduct(userID=user_id, productID=product.id)
-        db.session.add(userProduct)
+        # The first scraped price starts the price history of the product
+        db.session.add(PriceHistory(**price_history_row(product.id, product.currentPrice, product.ogPrice)))
         db.session.commit()
         
-        log_to_file(f"Product added to userProducts table: {product.name}", "INFO", user_id)
+        log_to_file(f"Product added to products table: {result}", "INFO", user_id)
+        
+    except IntegrityError:
+        # The unique URL index means another request stored this product first, use that product instead
+        db.session.rollback()
+        product = db.session.query(Product).filter_by(URL=URL).first()
+        log_to_file(f"Product already in products table, using existing product: {product.id}", "INFO", user_id)
         
     except Exception as e:
         log_to_file(f"Error storing product in database: {e}", "ERROR", user_id)
         db.session.rollback()
         raise e
     
+    # Products imported without a user, by the import-products command, are only stored in the products table
+    if user_id is None:
+        return product
+    
+    # create a userProduct object using the user_id and the product_id to store it to the userProducts table
+    log_to_file("Adding product to userProducts table", "INFO", user_id)
+    check_product_existence(URL, product.id, user_id)
+    
+    log_to_file(f"Product added to userProducts table: {product.name}", "INFO", user_id)
+    return product
+    
     
     
     
@@ -104,20 +133,73 @@ def check_product_existence(URL, product_id, user_id):
     also exists in the users userProducts table.
     
     '''
-    userProduct = db.session.query(UserProduct).filter_by(productID=product_id, userID=user_id).first()
-    if userProduct:
-        # Returns True if product already exists in userProducts table
+    # The unique (userID, productID) index does the check, so two requests at the same time cant both add the product
+    try:
+        userProduct = UserProduct(userID=user_id, productID=product_id)
+        db.session.add(userProduct)
+        db.session.commit()
+        
+    # Returns True if product already exists in userProducts table
+    except IntegrityError:
+        db.session.rollback()
         log_to_file(f"Product already exists in userProducts table: {URL}", "INFO", user_id)
         return True
+    
+    # The users list changed, the index route has to read it again
+    product_list_cache.invalidate_user(user_id)
             
     # If product does exist in the Products table but not in the userProducts table
-    # Add product to userProducts table without requesting the API to avoid duplicates
-    else:
-        userProduct = UserProduct(userID=user_id, productID=product_id)
-        db.session.add(userProduct)
-        db.session.commit()
-        log_to_file(f"Product already in products table, added to userProducts table: {product_id}", "INFO", user_id)
-        return False
+    # it has now been added to the userProducts table without requesting the API to avoid duplicates
+    log_to_file(f"Product already in products table, added to userProducts table: {product_id}", "INFO", user_id)
+    return False
+    
+    
+    
+def get_user_products(user_id):
+    '''
+    Function that returns the products in the users userProducts table as ProductRow tuples,
+    fetched with a single JOIN instead of one products query per userProducts row.
+    
+    '''
+    rows = db.session.query(Product.id, Product.URL, Product.name, Product.currentPrice, Product.ogPrice)\
+        .join(UserProduct, UserProduct.productID == Product.id)\
+        .filter(UserProduct.userID == user_id)\
+        .order_by(UserProduct.id)\
+        .all()
+    
+    return [ProductRow(*row) for row in rows]
+    
+    
+    
+def get_cached_user_products(user_id):
+    '''
+    Function that returns the products of the user like get_user_products, from product_list_cache if the list is cached.
+    add_product, remove_row and the rescrape price updates invalidate the cached list when it changes.
+    
+    '''
+    rows = product_list_cache.get(user_id)
+    if rows is not None:
+        return [ProductRow(*row) for row in rows]
+    
+    products = get_user_products(user_id)
+    product_list_cache.set(user_id, [list(product) for product in products])
+    return products
+    
+    
+    
+def get_tracked_products():
+    '''
+    Function that returns a query of every product that is in at least one users userProducts table,
+    each product only once, together with the amount of duplicate scrapes this avoids.
+    
+    The products are selected with a single IN query instead of one query per userProducts row,
+    the rescrape tasks read the query in chunks.
+    
+    '''
+    tracked_rows = db.session.query(func.count(UserProduct.id)).scalar()
+    products = db.session.query(Product).filter(Product.id.in_(select(UserProduct.productID)))
+    
+    return products, tracked_rows - products.count()
     
     
     
@@ -128,39 +210,54 @@ SCRAPER MODULES
 '''
 
 def rescrape_once(URL, product_id):
+    # Use the cached response if the product was scraped recently enough, by another user or a previous retry
+    cache_URL = standardise_URL(URL)
+    result = scrape_cache.get(cache_URL, SCRAPE_CACHE_TTL_RESCRAPE, "rescrape")
+    if result:
+        log_to_file(f"Using cached scrape of product: {product_id}")
+        return result
+    
     log_to_file(f"Requesting rescrape of product: {product_id}")
     
+    started = time.perf_counter()
     try:
-        response = requests.get(f"{os.getenv('API_IP')}/scheduled_scrape/scrape?url={URL}")
+        response = http_get(f"{os.getenv('API_IP')}/scheduled_scrape/scrape?url={URL}")
         response.raise_for_status()
-        dict_values = response.json()
-        return dict_values
+        # Decoded and validated straight from the response bytes, the prices are floats from here on
+        result = decode_scrape(response.content)
+        scraper_latency.observe(time.perf_counter() - started, path="rescrape", outcome="success")
+        scrape_cache.set(cache_URL, result)
+        return result
         
     except requests.exceptions.RequestException as e:
-        log_to_file(f"Error while rescraping product, trying again: {e}", "ERROR")
-        return {'error': e}
+        scraper_latency.observe(time.perf_counter() - started, path="rescrape", outcome="error")
+        log_to_file(f"Error while rescraping product: {e}", "ERROR")
+        # A 4xx is about this product, no response or a 5xx means the scraper itself is in trouble
+        response = getattr(e, "response", None)
+        return ScrapeError(error=str(e), transport=response is None or response.status_code >= 500)
 
 
 
-def retry_scrape(URL, product_id):
+def scrape_with_breaker(URL, product_id):
+    '''
+    Scrape a product once through the scraper circuit breaker.
+    While the breaker is open the scrape is skipped right away. Only transport errors and 5xx responses count
+    as breaker failures, a product the scraper answered with an error still proves the scraper is up.
+    Failed scrapes are not retried here, the rescrape tasks re-enqueue them with a Celery countdown instead of sleeping in the worker.
+    This is the function the rescrape engine runs in its worker threads.
     
-    # Request API in loop to retry the scrape twice
-    for i in range (0, 2):
-        if i == 0:
-            log_to_file(f"1st retry on product: {product_id}")
-        else:
-            log_to_file(f"2nd retry on product: {product_id}")
-        
-        dict_values = rescrape_once(URL, product_id)
-        
-        # if dict_values contains the key 'currentPrice' it was successful,
-        # return dict_values that contains product data
-        if dict_values.get('currentPrice'):
-            return dict_values
+    '''
+    if not scraper_breaker.allow():
+        return ScrapeError(error="Scraper circuit breaker is open", skipped=True)
+    
+    result = rescrape_once(URL, product_id)
+    
+    if isinstance(result, ScrapeError) and result.transport:
+        scraper_breaker.record_failure()
+    else:
+        scraper_breaker.record_success()
+    
+    if not isinstance(result, ScrapeResult):
+        log_to_file(f"Requested rescrape failed: {result}", "ERROR")
         
-        # if the loop is on the second try and doesnt contain the key 'currentPrice',
-        # the scraping failed twice, return dict_values that contains error message
-        if i == 1:
-            return dict_values
-            
-        time.sleep(2)
\ No newline at end of file
+    return result
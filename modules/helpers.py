@@ -1,9 +1,19 @@
 from functools import wraps
+from contextlib import contextmanager
 from flask import session, redirect, url_for, render_template
 import datetime
-import requests
+import threading
+import atexit
+import queue
+import time
 import os
 
+try:
+    import fcntl
+except ImportError:
+    # Windows, where a log file that is open can not be renamed by another process anyway
+    fcntl = None
+
 BASE_URL = os.getenv("BASE_URL", "")
 
 def login_required(f):
@@ -20,13 +30,194 @@ def login_required(f):
     return decorated_function
 
 
+'''
+
+Buffered logging.
+
+log_to_file used to open, write and close the log files on every call, which the request handlers and
+rescrape loops paid for several times per product. Log lines now go onto a queue that a background
+thread drains, it writes them in batches of LOG_BATCH_SIZE lines or every LOG_FLUSH_INTERVAL seconds,
+whichever comes first, and rotates a log file once it grows past LOG_MAX_BYTES.
+The web process and every Celery worker process write the same files, so before writing or rotating the writer
+checks that its handle still points at the file on disk and reopens it if another process rotated it,
+the same way logging.handlers.WatchedFileHandler does. Rotating happens under a lock on a .lock file next to the log,
+so two processes that pass the size limit at the same time rotate it once.
+
+'''
+
+LOG_FILE = "scraper_logs.txt"
+ERROR_LOG_FILE = "scraper_errors.txt"
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+
+
+class LogWriter(threading.Thread):
+    '''
+    Background thread that writes the queued (path, line) entries to their log files in batches.
+    
+    '''
+    
+    def __init__(self):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = queue.Queue()
+        self.files = {}
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            
+            # Keep collecting lines until the batch is full, the flush interval passed or a flush was requested
+            while len(batch) < LOG_BATCH_SIZE and not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            self.write(batch)
+    
+    def write(self, batch):
+        lines = {}
+        flush_requests = []
+        
+        for entry in batch:
+            if isinstance(entry, threading.Event):
+                flush_requests.append(entry)
+            else:
+                path, line = entry
+                lines.setdefault(path, []).append(line)
+        
+        for path, path_lines in lines.items():
+            try:
+                file = self.open(path)
+                file.write("".join(path_lines))
+                file.flush()
+                
+                # The size of the file itself, other processes append to it as well
+                if os.fstat(file.fileno()).st_size >= LOG_MAX_BYTES:
+                    self.rotate(path)
+            except OSError as e:
+                print(f"Failed to write to {path}: {e}")
+        
+        for flushed in flush_requests:
+            flushed.set()
+    
+    def open(self, path):
+        file = self.files.get(path)
+        if file is not None and not is_current(path, file):
+            self.files.pop(path).close()
+            file = None
+        
+        if file is None:
+            file = self.files[path] = open(path, "a", encoding="utf-8")
+        return file
+    
+    def rotate(self, path):
+        # scraper_logs.txt becomes scraper_logs.txt.1, scraper_logs.txt.1 becomes scraper_logs.txt.2 and so on
+        with rotation_lock(path):
+            file = self.files.pop(path)
+            current = is_current(path, file)
+            file.close()
+            
+            # Another process rotated the file in the meantime, the next write opens the new one
+            if not current:
+                return
+            
+            for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
+                if os.path.exists(f"{path}.{i}"):
+                    os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+            os.replace(path, f"{path}.1")
+
+
+def is_current(path, file):
+    # True if file is still open on the file at path, not on a rotated backup or a deleted file
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    
+    file_stat = os.fstat(file.fileno())
+    return (path_stat.st_dev, path_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino)
+
+
+@contextmanager
+def rotation_lock(path):
+    # Exclusive lock between the processes that write path
+    if fcntl is None:
+        yield
+        return
+    
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+_log_writer = None
+_log_writer_pid = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    '''
+    Return the log writer of this process, starting it on first use.
+    Celery forks its worker processes and threads dont survive a fork, so every process gets its own writer.
+    
+    '''
+    global _log_writer, _log_writer_pid
+    
+    if _log_writer_pid != os.getpid():
+        with _log_writer_lock:
+            if _log_writer_pid != os.getpid():
+                _log_writer = LogWriter()
+                _log_writer.start()
+                _log_writer_pid = os.getpid()
+    return _log_writer
+
+
+def flush_logs(timeout=5):
+    '''
+    Block until every log line queued so far has been written to disk.
+    
+    '''
+    flushed = threading.Event()
+    get_log_writer().queue.put(flushed)
+    return flushed.wait(timeout)
+
+
+atexit.register(flush_logs)
+
+
+_timestamp_cache = (None, "")
+
+
+def log_timestamp():
+    # strftime only runs once per second, every other log line in the same second reuses the cached timestamp
+    global _timestamp_cache
+    
+    second = int(time.time())
+    cached_second, timestamp = _timestamp_cache
+    if cached_second != second:
+        timestamp = datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+        _timestamp_cache = (second, timestamp)
+    return timestamp
+
+
 def log_to_file(message, level="INFO", user_id=None):
     '''
     Log a message to a file with timestamps and log levels.
+    The line is queued for the log writer thread, so the caller never waits on file I/O.
     
     '''
 
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = log_timestamp()
 
     # Use user_id if available to identify specific users in logs
     if user_id:
@@ -35,32 +226,11 @@ def log_to_file(message, level="INFO", user_id=None):
         user_string = f"User ID: None -"
     
     log_entry = f"{timestamp} - {level} - {user_string} {message}\n"
+    log_queue = get_log_writer().queue
     
     # If log level is error, write error to both files for easier debugging.
     # Otherwise write only to the regular usage logs
     if level == "ERROR":
-        with open("scraper_errors.txt", "a", encoding="utf-8") as file:
-            file.write(log_entry)
-    
-    with open("scraper_logs.txt", "a", encoding="utf-8") as file:
-        file.write(log_entry)
-            
-            
-def validate_turnsrtile(token, secret, remoteip=None):
-    url = 'https://challenges.cloudflare.com/turnstile/v0/siteverify'
+        log_queue.put((ERROR_LOG_FILE, log_entry))
     
-    data = {
-        'secret': secret,
-        'response': token
-    }
-    
-    if remoteip:
-        data['remoteip'] = remoteip
-        
-    try:
-        response = requests.post(url, data=data, timeout=10)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        log_to_file(f"Turnstile validation error: {e}")
-        return {'success': False, 'error-codes': ['internal-error']}
\ No newline at end of file
+    log_queue.put((LOG_FILE, log_entry))
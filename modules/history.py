@@ -0,0 +1,72 @@
+from modules.models import PriceHistory, db
+from sqlalchemy import func
+from decimal import Decimal, ROUND_HALF_UP
+import datetime
+
+'''
+
+Price history of the products.
+
+The rescrape tasks only append a row to the priceHistory table when the price of a product changed,
+a price is therefore in effect from its scrapedAt until the next row of the same product.
+Prices are stored in whole cents, these helpers convert them back to euros for the charts and checks.
+
+'''
+
+
+def to_cents(price):
+    # Through Decimal so a price like 19.99 never turns into 1998 cents due to float rounding
+    return int((Decimal(str(price)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+
+def price_history_row(product_id, current_price, og_price, scraped_at=None):
+    '''
+    Build a priceHistory mapping for bulk_insert_mappings.
+
+    '''
+    return {"productID": product_id,
+            "scrapedAt": scraped_at or datetime.datetime.now(),
+            "currentPriceCents": to_cents(current_price),
+            "ogPriceCents": to_cents(og_price)}
+
+
+
+def get_price_history(product_id, start=None, end=None):
+    '''
+    Return the price changes of a product between start and end as (scrapedAt, currentPrice, ogPrice) tuples, oldest first.
+    Reads a single range of the (productID, scrapedAt) index.
+
+    '''
+    query = db.session.query(PriceHistory.scrapedAt, PriceHistory.currentPriceCents, PriceHistory.ogPriceCents)\
+        .filter(PriceHistory.productID == product_id)
+
+    if start:
+        query = query.filter(PriceHistory.scrapedAt >= start)
+    if end:
+        query = query.filter(PriceHistory.scrapedAt <= end)
+
+    return [(scraped_at, current / 100, og / 100) for scraped_at, current, og in query.order_by(PriceHistory.scrapedAt)]
+
+
+
+def get_lowest_price(product_id, days):
+    '''
+    Return the lowest price of a product in the last N days, or None if the product has no history.
+    The price that was already in effect when the period started counts as well.
+
+    '''
+    since = datetime.datetime.now() - datetime.timedelta(days=days)
+
+    lowest_in_period = db.session.query(func.min(PriceHistory.currentPriceCents))\
+        .filter(PriceHistory.productID == product_id, PriceHistory.scrapedAt >= since)\
+        .scalar()
+
+    price_at_start = db.session.query(PriceHistory.currentPriceCents)\
+        .filter(PriceHistory.productID == product_id, PriceHistory.scrapedAt < since)\
+        .order_by(PriceHistory.scrapedAt.desc())\
+        .limit(1)\
+        .scalar()
+
+    prices = [price for price in (lowest_in_period, price_at_start) if price is not None]
+    return min(prices) / 100 if prices else None
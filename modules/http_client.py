@@ -0,0 +1,102 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import requests
+import os
+
+'''
+
+Shared HTTP client for the scraper API and Cloudflare Turnstile.
+
+Every call used to go through a bare requests.get/post, which opens a new TCP and TLS connection each time.
+This module keeps one requests.Session per process with a sized connection pool per host, so connections
+are kept alive and reused. Every request gets explicit connect/read timeouts, and failed connections and
+502/503/504 responses of GET requests are retried with backoff. POST requests are never retried since a
+Turnstile token can only be verified once.
+
+'''
+
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))
+
+
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+
+def create_http_session():
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,
+        status=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+
+    http_session = requests.Session()
+    http_session.mount("http://", adapter)
+    http_session.mount("https://", adapter)
+    return http_session
+
+
+
+def get_http_session():
+    '''
+    Return the pooled session of this process, a forked Celery worker creates its own
+    so it never shares sockets with its parent.
+
+    '''
+    global _http_session, _http_session_pid
+
+    if _http_session_pid != os.getpid():
+        with _http_session_lock:
+            if _http_session_pid != os.getpid():
+                _http_session = create_http_session()
+                _http_session_pid = os.getpid()
+    return _http_session
+
+
+
+def http_get(url, timeout=None, **kwargs):
+    return get_http_session().get(url, timeout=timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **kwargs)
+
+
+
+def http_post(url, timeout=None, **kwargs):
+    return get_http_session().post(url, timeout=timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **kwargs)
+
+
+
+def pool_stats():
+    '''
+    Return the connection and request counts per host, the reuse rate is the share of requests
+    that went over an already open connection.
+
+    '''
+    stats = {}
+    if _http_session is None or _http_session_pid != os.getpid():
+        return stats
+
+    for adapter in set(_http_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+
+            requests_made = pool.num_requests
+            stats[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections": pool.num_connections,
+                "requests": requests_made,
+                "reuse_rate": round(1 - pool.num_connections / requests_made, 3) if requests_made else 0.0
+            }
+    return stats
@@ -0,0 +1,285 @@
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from modules.helpers import log_to_file
+import threading
+import datetime
+import bisect
+import json
+import time
+import os
+
+'''
+
+In-process metrics for the web app and the Celery tasks.
+
+Every request and every task runs inside a MetricsScope that counts the SQL queries and the time spent in them,
+through SQLAlchemy engine events. create_app records the latency, status and query counts of every route,
+the FlaskTask wrapper in celery_utils.py records the duration and Celery queue wait of every task, and the
+scraper calls record their latency. render_metrics() returns everything in the Prometheus text format,
+create_app serves it on /metrics to requests with "Authorization: Bearer <METRICS_TOKEN>".
+Without METRICS_TOKEN /metrics answers 404, the query counts and timings are not for the public.
+
+Metrics live in the memory of the process that recorded them, the Celery workers therefore also log
+a structured line per task that can be collected from the log files.
+
+'''
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+
+
+class Counter:
+    '''
+    Thread safe counter with labels, rendered as a Prometheus counter.
+
+    '''
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+
+class Histogram:
+    '''
+    Thread safe histogram with labels, rendered as a Prometheus histogram with cumulative buckets.
+
+    '''
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, total = self.values.get(tuple(labels.get(name, "") for name in self.labelnames), ([], 0.0))
+        return sum(counts)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {round(total, 6)}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+
+REGISTRY = []
+
+request_latency = Histogram("http_request_duration_seconds", "Latency of the Flask routes", ("route", "method", "status"))
+request_queries = Histogram("http_request_db_queries", "SQL queries per request", ("route",), QUERY_COUNT_BUCKETS)
+request_query_time = Histogram("http_request_db_seconds", "Time spent in SQL queries per request", ("route",))
+db_queries = Counter("db_queries_total", "SQL queries executed by this process")
+scraper_latency = Histogram("scraper_request_duration_seconds", "Latency of the scraper API calls", ("path", "outcome"))
+task_duration = Histogram("celery_task_duration_seconds", "Run time of the Celery tasks", ("task", "state"))
+task_queue_wait = Histogram("celery_task_queue_wait_seconds", "Time between publishing a Celery task and a worker starting it", ("task",))
+task_queries = Histogram("celery_task_db_queries", "SQL queries per Celery task", ("task",), QUERY_COUNT_BUCKETS)
+rescrape_duration = Histogram("rescrape_run_duration_seconds", "Wall time of the rescrape runs", ("kind",))
+rescrape_products_scraped = Counter("rescrape_products_total", "Products scraped by the rescrape runs", ("kind",))
+scrape_cache_lookups = Counter("scrape_cache_lookups_total", "Scrape cache lookups per call path", ("cache", "path", "outcome"))
+
+
+def render_metrics():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+
+class MetricsScope:
+    '''
+    Counts the SQL queries of a request, task or rescrape run. Scopes nest,
+    the counts of a scope are added to the scope it was opened in when it closes.
+
+    '''
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.started = time.perf_counter()
+        self.parent = None
+        self.token = None
+
+    def __enter__(self):
+        self.parent = _current_scope.get()
+        self.token = _current_scope.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current_scope.reset(self.token)
+        if self.parent is not None:
+            self.parent.queries += self.queries
+            self.parent.query_time += self.query_time
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+
+_current_scope = ContextVar("metrics_scope", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_started", []).append(time.perf_counter())
+
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_query_started"].pop()
+    db_queries.inc()
+
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.queries += 1
+        scope.query_time += elapsed
+
+
+
+def stamp_published_at(headers=None, **kwargs):
+    # Connected to before_task_publish by celery_init_app, the worker subtracts this from its start time to get the queue wait
+    if headers is not None:
+        headers.setdefault("published_at", time.time())
+
+
+
+def queue_wait(task_request):
+    '''
+    Return the seconds task_request spent on the queue, or None if the task was called directly.
+
+    '''
+    published_at = getattr(task_request, "published_at", None)
+    if published_at is None:
+        published_at = (getattr(task_request, "headers", None) or {}).get("published_at")
+    if published_at is None:
+        return None
+
+    # A countdown is part of the plan, not time spent waiting on a busy worker
+    eta = getattr(task_request, "eta", None)
+    if eta:
+        try:
+            published_at = max(published_at, datetime.datetime.fromisoformat(eta).timestamp())
+        except (TypeError, ValueError):
+            pass
+    return max(0.0, time.time() - published_at)
+
+
+
+def run_task_with_metrics(task, run):
+    '''
+    Run a Celery task through run() while recording its duration, queue wait and SQL queries,
+    then log them as a structured line.
+
+    '''
+    wait = queue_wait(task.request)
+    if wait is not None:
+        task_queue_wait.observe(wait, task=task.name)
+
+    state = "failure"
+    with MetricsScope() as scope:
+        try:
+            result = run()
+            state = "success"
+            return result
+        finally:
+            task_duration.observe(scope.elapsed, task=task.name, state=state)
+            task_queries.observe(scope.queries, task=task.name)
+            log_to_file("Task metrics: " + json.dumps({"task": task.name,
+                                                       "task_id": task.request.id,
+                                                       "state": state,
+                                                       "duration": round(scope.elapsed, 4),
+                                                       "queue_wait": round(wait, 4) if wait is not None else None,
+                                                       "queries": scope.queries,
+                                                       "query_time": round(scope.query_time, 4)}))
+
+
+
+def init_metrics(app):
+    '''
+    Record the latency and SQL queries of every request of app and serve the metrics on /metrics.
+
+    '''
+    from flask import g, request, abort, Response
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_scope = MetricsScope().__enter__()
+        g.metrics_status = 500
+
+    @app.after_request
+    def record_response_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    # Teardown also runs when the route raised, so the scope is always closed
+    @app.teardown_request
+    def record_request_metrics(exception=None):
+        scope = g.pop("metrics_scope", None)
+        if scope is None:
+            return
+        scope.__exit__(None, None, None)
+
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        if route == "/metrics":
+            return
+        request_latency.observe(scope.elapsed, route=route, method=request.method, status=g.get("metrics_status", 500))
+        request_queries.observe(scope.queries, route=route)
+        request_query_time.observe(scope.query_time, route=route)
+
+    def metrics():
+        if not METRICS_TOKEN:
+            abort(404)
+        if request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            abort(403)
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule("/metrics", "metrics", metrics)
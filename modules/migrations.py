@@ -0,0 +1,190 @@
+from modules.models import User, UserProduct, Product, PriceHistory, RescrapeRun, SchemaMigration, db
+from modules.history import price_history_row
+from modules.helpers import log_to_file
+from sqlalchemy import func, text, inspect, DateTime, Integer
+
+'''
+
+Versioned schema migrations.
+
+db.create_all() only creates missing tables, it never changes a table that already exists.
+Every schema change to an existing table gets a numbered migration function in MIGRATIONS,
+the applied versions are stored in the schemaMigrations table so each migration runs exactly once.
+Run them with "flask --app app migrate".
+
+'''
+
+
+def create_indexes(model, *names):
+    '''
+    Create the indexes of model with the given names. A migration only names the indexes it introduced,
+    the model may have indexes on columns that a later migration adds.
+    checkfirst skips indexes that db.create_all() already created on a fresh database.
+
+    '''
+    indexes = {index.name: index for index in model.__table__.indexes}
+    for name in names:
+        indexes[name].create(bind=db.engine, checkfirst=True)
+
+
+
+def merge_duplicate_products():
+    '''
+    Merge products that were stored more than once under the same URL into the one with the lowest id,
+    the userProducts rows of the duplicates are moved over to the product that is kept.
+
+    '''
+    duplicates = db.session.query(Product.URL, func.min(Product.id))\
+        .group_by(Product.URL)\
+        .having(func.count(Product.id) > 1)\
+        .all()
+
+    for URL, keep_id in duplicates:
+        duplicate_ids = [id for (id,) in db.session.query(Product.id).filter(Product.URL == URL, Product.id != keep_id)]
+
+        db.session.query(UserProduct).filter(UserProduct.productID.in_(duplicate_ids))\
+            .update({UserProduct.productID: keep_id}, synchronize_session=False)
+        db.session.query(Product).filter(Product.id.in_(duplicate_ids)).delete(synchronize_session=False)
+        log_to_file(f"Merged duplicate products {duplicate_ids} into product {keep_id}")
+
+    db.session.commit()
+
+
+
+def remove_duplicate_user_products():
+    '''
+    Remove userProducts rows that link the same user to the same product more than once, keeping the oldest row.
+
+    '''
+    duplicates = db.session.query(UserProduct.userID, UserProduct.productID, func.min(UserProduct.id))\
+        .group_by(UserProduct.userID, UserProduct.productID)\
+        .having(func.count(UserProduct.id) > 1)\
+        .all()
+
+    for user_id, product_id, keep_id in duplicates:
+        db.session.query(UserProduct)\
+            .filter(UserProduct.userID == user_id, UserProduct.productID == product_id, UserProduct.id != keep_id)\
+            .delete(synchronize_session=False)
+        log_to_file(f"Removed duplicate userProducts rows of user {user_id} for product {product_id}")
+
+    db.session.commit()
+
+
+
+def migration_001():
+    # Existing duplicates have to go before the unique indexes can be created
+    merge_duplicate_products()
+    remove_duplicate_user_products()
+
+    create_indexes(User, "ix_users_username")
+    create_indexes(Product, "uq_products_URL", "ix_products_name")
+    create_indexes(UserProduct, "uq_userProducts_userID_productID", "ix_userProducts_productID")
+
+
+
+def migration_002():
+    # Prices used to be Integer columns which cut off the cents.
+    # SQLite keeps the decimals in the existing columns, so only MySQL and PostgreSQL need the column type changed
+    dialect = db.engine.dialect.name
+    if dialect == "mysql":
+        db.session.execute(text("ALTER TABLE products MODIFY ogPrice DECIMAL(10, 2) NOT NULL, MODIFY currentPrice DECIMAL(10, 2) NOT NULL"))
+    elif dialect == "postgresql":
+        db.session.execute(text('ALTER TABLE products ALTER COLUMN "ogPrice" TYPE NUMERIC(10, 2), ALTER COLUMN "currentPrice" TYPE NUMERIC(10, 2)'))
+
+    create_indexes(PriceHistory, "ix_priceHistory_productID_scrapedAt")
+
+    # Start the history of every existing product with its current price, 1000 products at a time
+    last_id = 0
+    while True:
+        products = db.session.query(Product.id, Product.currentPrice, Product.ogPrice)\
+            .filter(Product.id > last_id)\
+            .order_by(Product.id)\
+            .limit(1000)\
+            .all()
+        if not products:
+            break
+
+        db.session.bulk_insert_mappings(PriceHistory, [price_history_row(*product) for product in products])
+        last_id = products[-1][0]
+
+    db.session.commit()
+
+
+
+def migration_003():
+    # The rescrapeRuns table itself is new, db.create_all() already created it with its index
+    create_indexes(RescrapeRun, "ix_rescrapeRuns_kind_status")
+
+
+
+def add_column(table, name, column_type, nullable=True, default=None):
+    # Skips columns that db.create_all() already created on a fresh database
+    if name in {column["name"] for column in inspect(db.engine).get_columns(table)}:
+        return
+
+    dialect = db.engine.dialect
+    definition = f"{dialect.identifier_preparer.quote(name)} {column_type.compile(dialect=dialect)}"
+    if default is not None:
+        definition += f" DEFAULT {default}"
+    definition += " NULL" if nullable else " NOT NULL"
+
+    db.session.execute(text(f"ALTER TABLE {dialect.identifier_preparer.quote(table)} ADD COLUMN {definition}"))
+    db.session.commit()
+
+
+
+def migration_004():
+    add_column("products", "lastScrapedAt", DateTime())
+    add_column("products", "scrapeCount", Integer(), nullable=False, default=0)
+    add_column("products", "changeCount", Integer(), nullable=False, default=0)
+
+    create_indexes(Product, "ix_products_lastScrapedAt")
+
+
+
+def migration_005():
+    add_column("products", "lastAttemptAt", DateTime())
+    add_column("products", "failureCount", Integer(), nullable=False, default=0)
+
+    # Products scraped before this migration were last attempted when they were last scraped
+    db.session.query(Product).filter(Product.lastAttemptAt.is_(None))\
+        .update({Product.lastAttemptAt: Product.lastScrapedAt}, synchronize_session=False)
+    db.session.commit()
+
+    create_indexes(Product, "ix_products_lastAttemptAt")
+
+
+
+MIGRATIONS = [
+    (1, "Indexes and unique constraints for the hot lookups", migration_001),
+    (2, "Decimal prices and price history", migration_002),
+    (3, "Resumable rescrape runs", migration_003),
+    (4, "Scrape statistics for the priority scheduler", migration_004),
+    (5, "Failed scrape attempts for the priority scheduler", migration_005),
+]
+
+
+
+def run_migrations():
+    '''
+    Create missing tables and apply every migration that has not been applied yet, in order.
+    Must be called inside an app context. Returns the versions that were applied.
+
+    '''
+    db.create_all()
+
+    applied_versions = {version for (version,) in db.session.query(SchemaMigration.version)}
+    applied_now = []
+
+    for version, description, migration in MIGRATIONS:
+        if version in applied_versions:
+            continue
+
+        log_to_file(f"Applying migration {version}: {description}")
+        migration()
+
+        db.session.add(SchemaMigration(version=version, description=description))
+        db.session.commit()
+        applied_now.append(version)
+
+    return applied_now
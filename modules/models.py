@@ -1,6 +1,7 @@
-from sqlalchemy import create_engine, Column, Integer, String, Table, MetaData
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Numeric, Table, MetaData, Index
 from sqlalchemy.orm import declarative_base
 from flask_sqlalchemy import SQLAlchemy
+import datetime
 
 db = SQLAlchemy()
 
@@ -11,6 +12,11 @@ class User(db.Model):
     username = Column(String(100), nullable=False)
     passwordHash = Column(String(200), nullable=False)
     
+    # login and check_username look users up by username
+    __table_args__ = (
+        Index("ix_users_username", "username"),
+    )
+    
     def __repr__(self):
         return f"User {self.username}"
     
@@ -21,8 +27,25 @@ class Product(db.Model):
     id = Column(Integer, primary_key=True, autoincrement=True)
     URL = Column(String(500), nullable=False)
     name = Column(String(300), nullable=False)
-    ogPrice = Column(Integer, nullable=False)
-    currentPrice = Column(Integer, nullable=False)
+    ogPrice = Column(Numeric(10, 2, asdecimal=False), nullable=False)
+    currentPrice = Column(Numeric(10, 2, asdecimal=False), nullable=False)
+    
+    # Used by the priority scheduler to decide how often a product gets rescraped
+    lastScrapedAt = Column(DateTime, nullable=True)
+    scrapeCount = Column(Integer, nullable=False, default=0)
+    changeCount = Column(Integer, nullable=False, default=0)
+    # Failed scrapes only move lastAttemptAt, failureCount counts the failures since the last successful scrape
+    lastAttemptAt = Column(DateTime, nullable=True)
+    failureCount = Column(Integer, nullable=False, default=0)
+    
+    # add_product looks products up by URL and remove_row by name,
+    # the unique URL index also makes sure the same product can never be stored twice
+    __table_args__ = (
+        Index("uq_products_URL", "URL", unique=True),
+        Index("ix_products_name", "name"),
+        Index("ix_products_lastScrapedAt", "lastScrapedAt"),
+        Index("ix_products_lastAttemptAt", "lastAttemptAt"),
+    )
     
     def __repr__(self):
         return f"Product {self.name}"
@@ -35,5 +58,65 @@ class UserProduct(db.Model):
     userID = Column(Integer, nullable=False)
     productID = Column(Integer, nullable=False)
     
+    # The unique (userID, productID) index keeps a user from tracking a product twice
+    # and also serves every lookup by userID, productID lookups get their own index
+    __table_args__ = (
+        Index("uq_userProducts_userID_productID", "userID", "productID", unique=True),
+        Index("ix_userProducts_productID", "productID"),
+    )
+    
+    def __repr__(self):
+        return f"UserProduct {self.id}"
+    
+    
+class PriceHistory(db.Model):
+    __tablename__ = "priceHistory"
+    
+    # Append-only, a row is only written when the price of a product changes.
+    # Prices are stored in cents to keep the rows small and exact
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    productID = Column(Integer, nullable=False)
+    scrapedAt = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    currentPriceCents = Column(Integer, nullable=False)
+    ogPriceCents = Column(Integer, nullable=False)
+    
+    # Chart and lowest price queries read a time range of a single product
+    __table_args__ = (
+        Index("ix_priceHistory_productID_scrapedAt", "productID", "scrapedAt"),
+    )
+    
+    def __repr__(self):
+        return f"PriceHistory {self.productID} {self.scrapedAt}"
+    
+    
+class RescrapeRun(db.Model):
+    __tablename__ = "rescrapeRuns"
+    
+    # cursor holds the id of the last product of the last finished chunk,
+    # a run that got interrupted continues after it instead of starting over
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(20), nullable=False)
+    status = Column(String(20), nullable=False, default="running")
+    cursor = Column(Integer, nullable=False, default=0)
+    productsDone = Column(Integer, nullable=False, default=0)
+    startedAt = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    updatedAt = Column(DateTime, nullable=False, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+    finishedAt = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_rescrapeRuns_kind_status", "kind", "status"),
+    )
+    
+    def __repr__(self):
+        return f"RescrapeRun {self.kind} {self.id}"
+    
+    
+class SchemaMigration(db.Model):
+    __tablename__ = "schemaMigrations"
+    
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(200), nullable=False)
+    appliedAt = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    
     def __repr__(self):
-        return f"UserProduct {self.id}"
\ No newline at end of file
+        return f"SchemaMigration {self.version}"
@@ -0,0 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+import threading
+import os
+
+'''
+
+Password hashing off the request threads.
+
+pbkdf2 hashing and verification take long on purpose, running them on one of the two Waitress threads
+stalled every other route during a burst of logins. They now run in a process pool of PASSWORD_HASH_WORKERS
+processes. At most PASSWORD_HASH_QUEUE hashes can be running or waiting at a time, by default one per worker.
+A hash past that waits up to PASSWORD_HASH_WAIT seconds for a slot, after which PasswordHasherBusy is raised
+so the route answers with a 503 instead of holding its Waitress thread for the whole burst of logins.
+
+PASSWORD_HASH_ITERATIONS sets the pbkdf2 cost of new hashes. When it changes, the hash of a user
+is replaced with one of the new cost the next time they log in with the right password.
+With PASSWORD_HASH_WORKERS set to 0 the hashing runs in the calling thread.
+
+'''
+
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", "1000000"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# Fewer slots than workers would leave a worker idle while simultaneous logins get a 503
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", str(max(1, PASSWORD_HASH_WORKERS))))
+PASSWORD_HASH_WAIT = float(os.getenv("PASSWORD_HASH_WAIT", "0.5"))
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "30"))
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+
+def hash_method(iterations=None):
+    return f"pbkdf2:sha256:{iterations or PASSWORD_HASH_ITERATIONS}"
+
+
+
+def needs_rehash(password_hash, iterations=None):
+    # Stored hashes start with their method, "pbkdf2:sha256:<iterations>$salt$hash"
+    return password_hash.split("$", 1)[0] != hash_method(iterations)
+
+
+
+def hash_job(password, iterations):
+    return generate_password_hash(password, method=hash_method(iterations), salt_length=16)
+
+
+
+def verify_job(password_hash, password, iterations):
+    '''
+    Return (valid, new_hash), new_hash is a hash with the current cost if the stored hash has another cost.
+    Runs in the pool, so the rehash does not need a second round trip.
+
+    '''
+    if not check_password_hash(password_hash, password):
+        return False, None
+
+    if needs_rehash(password_hash, iterations):
+        return True, hash_job(password, iterations)
+    return True, None
+
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE)
+
+
+def get_pool():
+    '''
+    Return the hashing pool of this process, created on first use.
+
+    '''
+    global _pool, _pool_pid
+
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+
+def shutdown_pool():
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown()
+        _pool = None
+        _pool_pid = None
+
+
+
+def submit(job, *args):
+    '''
+    Submit job to the hashing pool and return its future,
+    raises PasswordHasherBusy if the queue stays full for PASSWORD_HASH_WAIT seconds.
+
+    '''
+    if not _slots.acquire(timeout=PASSWORD_HASH_WAIT):
+        raise PasswordHasherBusy("Too many password hashes in progress")
+
+    try:
+        try:
+            future = get_pool().submit(job, *args)
+        except BrokenProcessPool:
+            # A worker process died, start a new pool
+            shutdown_pool()
+            future = get_pool().submit(job, *args)
+    except Exception:
+        _slots.release()
+        raise
+
+    future.add_done_callback(lambda future: _slots.release())
+    return future
+
+
+
+def submit_verify(password_hash, password):
+    # Future of verify_job, for callers that wait on it themselves
+    return submit(verify_job, password_hash, password, PASSWORD_HASH_ITERATIONS)
+
+
+
+def hash_password(password):
+    '''
+    Return a new hash of password with the current cost.
+
+    '''
+    if PASSWORD_HASH_WORKERS <= 0:
+        return hash_job(password, PASSWORD_HASH_ITERATIONS)
+    return submit(hash_job, password, PASSWORD_HASH_ITERATIONS).result(timeout=PASSWORD_HASH_TIMEOUT)
+
+
+
+def verify_password(password_hash, password):
+    '''
+    Check password against password_hash. Returns (valid, new_hash),
+    new_hash is set if the stored hash should be replaced because the cost changed.
+
+    '''
+    if PASSWORD_HASH_WORKERS <= 0:
+        return verify_job(password_hash, password, PASSWORD_HASH_ITERATIONS)
+    return submit_verify(password_hash, password).result(timeout=PASSWORD_HASH_TIMEOUT)
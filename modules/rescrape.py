@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from modules.models import Product, PriceHistory, db
+from modules.history import price_history_row
+from modules.cache import product_list_cache
+import threading
+import datetime
+import time
+import os
+
+'''
+
+Concurrent rescrape engine used by the scheduled rescrape tasks.
+
+The scheduled tasks used to scrape every product one after another with a fixed 2 second sleep in between.
+This module fans the products out over a thread pool instead, while a semaphore per webshop host makes sure
+a single webshop never gets more than RESCRAPE_PER_HOST requests at the same time.
+Only the HTTP requests run in the worker threads, the database work stays in the calling thread
+since the SQLAlchemy session is not thread safe.
+
+'''
+
+RESCRAPE_WORKERS = int(os.getenv("RESCRAPE_WORKERS", "4"))
+RESCRAPE_PER_HOST = int(os.getenv("RESCRAPE_PER_HOST", "2"))
+RESCRAPE_COMMIT_CHUNK = int(os.getenv("RESCRAPE_COMMIT_CHUNK", "100"))
+RESCRAPE_CHUNK_SIZE = int(os.getenv("RESCRAPE_CHUNK_SIZE", "500"))
+
+
+def rescrape_concurrently(work, scrape, max_workers=None, per_host=None):
+    '''
+    Scrape every (product_id, URL) pair in work using a thread pool and yield
+    (product_id, result, latency) tuples in the order the scrapes finish.
+
+    Args:
+        work: List of (product_id, URL) tuples to scrape
+        scrape: Function that takes (URL, product_id) and returns a ScrapeResult or ScrapeError
+        max_workers: Size of the thread pool, defaults to RESCRAPE_WORKERS
+        per_host: Max concurrent requests per webshop host, defaults to RESCRAPE_PER_HOST
+
+    '''
+    max_workers = max_workers or RESCRAPE_WORKERS
+    per_host = per_host or RESCRAPE_PER_HOST
+
+    # One semaphore per webshop host, created up front so the worker threads only ever read the dict
+    host_limits = {}
+    for product_id, URL in work:
+        host = urlparse(URL).netloc
+        if host not in host_limits:
+            host_limits[host] = threading.BoundedSemaphore(per_host)
+
+    def timed_scrape(product_id, URL):
+        with host_limits[urlparse(URL).netloc]:
+            started = time.perf_counter()
+            result = scrape(URL, product_id)
+            return product_id, result, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rescrape") as executor:
+        futures = [executor.submit(timed_scrape, product_id, URL) for product_id, URL in work]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+
+class PriceUpdateBatch:
+    '''
+    Collects the results of a rescrape run and writes them to the products table in bulk,
+    with one commit per chunk instead of a commit per product.
+    Every scraped product gets its lastScrapedAt and scrapeCount updated with a single UPDATE ... WHERE id IN,
+    products whose price changed also get their new prices, a changeCount increment and a priceHistory row.
+    Products that failed to scrape get their lastAttemptAt and failureCount updated, so the scheduler backs off on them.
+
+    '''
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or RESCRAPE_COMMIT_CHUNK
+        self.pending = []
+        self.history = []
+        self.scraped_ids = []
+        self.failed_ids = []
+        self.updated = 0
+        self.written = 0
+        self.commits = 0
+        self.update_commits = 0
+
+    def add(self, product_id, current_price, og_price):
+        # A changed product was scraped as well
+        self.pending.append({"id": product_id, "currentPrice": current_price, "ogPrice": og_price})
+        self.history.append(price_history_row(product_id, current_price, og_price))
+        self.scraped(product_id)
+
+    def scraped(self, product_id):
+        self.scraped_ids.append(product_id)
+        if len(self.scraped_ids) + len(self.failed_ids) >= self.chunk_size:
+            self.flush()
+
+    def failed(self, product_id):
+        self.failed_ids.append(product_id)
+        if len(self.scraped_ids) + len(self.failed_ids) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.scraped_ids and not self.failed_ids:
+            return
+
+        now = datetime.datetime.now()
+
+        if self.pending:
+            changed_ids = [mapping["id"] for mapping in self.pending]
+            db.session.bulk_update_mappings(Product, self.pending)
+            db.session.bulk_insert_mappings(PriceHistory, self.history)
+            db.session.query(Product).filter(Product.id.in_(changed_ids))\
+                .update({Product.changeCount: Product.changeCount + 1}, synchronize_session=False)
+
+        if self.scraped_ids:
+            db.session.query(Product).filter(Product.id.in_(self.scraped_ids))\
+                .update({Product.scrapeCount: Product.scrapeCount + 1,
+                         Product.lastScrapedAt: now,
+                         Product.lastAttemptAt: now,
+                         Product.failureCount: 0}, synchronize_session=False)
+
+        if self.failed_ids:
+            db.session.query(Product).filter(Product.id.in_(self.failed_ids))\
+                .update({Product.failureCount: Product.failureCount + 1,
+                         Product.lastAttemptAt: now}, synchronize_session=False)
+        db.session.commit()
+
+        # Only the users that have one of the changed products in their list see a different list
+        if self.pending:
+            product_list_cache.invalidate_products(changed_ids)
+            self.update_commits += 1
+
+        self.updated += len(self.pending)
+        self.written += len(self.scraped_ids) + len(self.failed_ids)
+        self.commits += 1
+        self.pending = []
+        self.history = []
+        self.scraped_ids = []
+        self.failed_ids = []
+
+    @property
+    def commits_saved(self):
+        # The rescrape used to commit every changed product on its own, unchanged and failed products were not committed
+        return self.updated - self.update_commits
+
+
+
+def summarise_run(latencies, wall_time):
+    '''
+    Build the summary of a rescrape run from the per-product latencies and the total wall time.
+
+    '''
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    summary = {
+        "products": count,
+        "wall_time": round(wall_time, 3),
+        "latency_mean": 0.0,
+        "latency_p50": 0.0,
+        "latency_p99": 0.0,
+        "latency_max": 0.0
+    }
+
+    if count:
+        summary["latency_mean"] = round(sum(latencies) / count, 3)
+        summary["latency_p50"] = round(latencies[int(0.50 * (count - 1))], 3)
+        summary["latency_p99"] = round(latencies[int(0.99 * (count - 1))], 3)
+        summary["latency_max"] = round(latencies[-1], 3)
+
+    return summary
@@ -0,0 +1,90 @@
+import threading
+import random
+import time
+import os
+
+'''
+
+Retry policy and circuit breaker for the scraper API.
+
+A failed scrape is no longer retried in place with a fixed sleep that blocks the Celery worker,
+the product gets re-enqueued with a Celery countdown that grows exponentially with every attempt.
+The circuit breaker trips after SCRAPER_BREAKER_THRESHOLD consecutive failures, while it is open
+every scrape is skipped right away instead of waiting on a scraper that is down. After
+SCRAPER_BREAKER_RESET seconds a single trial scrape is let through, if it succeeds the breaker closes again.
+
+'''
+
+SCRAPE_MAX_ATTEMPTS = int(os.getenv("SCRAPE_MAX_ATTEMPTS", "3"))
+SCRAPE_BACKOFF_BASE = float(os.getenv("SCRAPE_BACKOFF_BASE", "30"))
+SCRAPE_BACKOFF_CAP = float(os.getenv("SCRAPE_BACKOFF_CAP", "900"))
+SCRAPER_BREAKER_THRESHOLD = int(os.getenv("SCRAPER_BREAKER_THRESHOLD", "5"))
+SCRAPER_BREAKER_RESET = float(os.getenv("SCRAPER_BREAKER_RESET", "300"))
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    '''
+    Return the countdown in seconds before retry number attempt (1 for the first retry).
+    The delay doubles with every attempt up to cap, half of it is random so retries of
+    products that failed at the same time dont all hit the scraper at the same moment.
+
+    '''
+    base = base or SCRAPE_BACKOFF_BASE
+    cap = cap or SCRAPE_BACKOFF_CAP
+
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+
+class CircuitBreaker:
+    '''
+    Thread safe circuit breaker, the rescrape engine's worker threads share one breaker.
+
+    '''
+
+    def __init__(self, threshold=None, reset_timeout=None):
+        self.threshold = threshold or SCRAPER_BREAKER_THRESHOLD
+        self.reset_timeout = reset_timeout or SCRAPER_BREAKER_RESET
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        '''
+        Return True if a scrape may go ahead.
+
+        '''
+        with self.lock:
+            if self.opened_at is None:
+                return True
+
+            # Half open: let a single trial scrape through once the reset timeout passed
+            if not self.trial_running and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+            # A failed trial opens the breaker for another reset timeout
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+
+
+
+scraper_breaker = CircuitBreaker()
@@ -0,0 +1,79 @@
+from modules.models import UserProduct, Product, db
+from sqlalchemy import func, select, or_
+import datetime
+import heapq
+import math
+import os
+
+'''
+
+Staleness-priority rescrape scheduler.
+
+Instead of rescraping everything at 03:00, Celery beat runs scheduled_priority_rescrape every
+SCHEDULER_TICK_MINUTES minutes. Every tick picks the products with the highest priority within
+its share of the SCRAPER_HOURLY_BUDGET, which spreads the scraper load over the whole day.
+
+The priority of a product grows with the time since it was last scraped, and is multiplied by how often
+its price changed in the past and by how many users track it. Volatile, popular products are therefore
+rescraped the most often, while a product nobody tracks still gets its turn once it is stale enough.
+Every failed scrape in a row halves the priority, so products that keep failing back off instead of
+staying on top of the heap.
+
+'''
+
+SCRAPER_HOURLY_BUDGET = int(os.getenv("SCRAPER_HOURLY_BUDGET", "120"))
+SCHEDULER_TICK_MINUTES = int(os.getenv("SCHEDULER_TICK_MINUTES", "10"))
+SCHEDULER_MIN_INTERVAL = float(os.getenv("SCHEDULER_MIN_INTERVAL", "1"))
+
+# Staleness used for products that were never scraped by a rescrape, in hours
+NEVER_SCRAPED_HOURS = 24 * 30
+
+
+def tick_budget():
+    # Share of the hourly budget for a single tick, at least one product per tick
+    return max(1, SCRAPER_HOURLY_BUDGET * SCHEDULER_TICK_MINUTES // 60)
+
+
+
+def priority(now, last_scraped_at, scrape_count, change_count, watchers, failure_count=0):
+    '''
+    Return the rescrape priority of a product, higher goes first.
+
+    '''
+    if last_scraped_at is None:
+        staleness = NEVER_SCRAPED_HOURS
+    else:
+        staleness = (now - last_scraped_at).total_seconds() / 3600
+
+    # Share of scrapes that found a new price, smoothed so a product with few scrapes starts at 0.5
+    volatility = (change_count + 1) / (scrape_count + 2)
+
+    return staleness * volatility * (1 + math.log2(1 + watchers)) * 0.5 ** failure_count
+
+
+
+def pick_due_products(budget, now=None):
+    '''
+    Return the budget products with the highest priority as Product objects.
+    Products scraped or attempted less than SCHEDULER_MIN_INTERVAL hours ago are never picked.
+
+    '''
+    now = now or datetime.datetime.now()
+    recent = now - datetime.timedelta(hours=SCHEDULER_MIN_INTERVAL)
+
+    watchers = select(UserProduct.productID, func.count(UserProduct.id).label("watchers"))\
+        .group_by(UserProduct.productID)\
+        .subquery()
+
+    candidates = db.session.query(Product.id, Product.lastScrapedAt, Product.scrapeCount, Product.changeCount,
+                                  func.coalesce(watchers.c.watchers, 0), Product.failureCount)\
+        .outerjoin(watchers, watchers.c.productID == Product.id)\
+        .filter(or_(Product.lastAttemptAt.is_(None), Product.lastAttemptAt < recent))\
+        .yield_per(1000)
+
+    # Only the top of the heap is kept in memory, not every candidate
+    due = heapq.nlargest(budget, candidates, key=lambda row: priority(now, *row[1:]))
+    due_ids = [row[0] for row in due]
+
+    products = {product.id: product for product in db.session.query(Product).filter(Product.id.in_(due_ids))}
+    return [products[id] for id in due_ids if id in products]
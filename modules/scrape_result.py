@@ -0,0 +1,61 @@
+from kombu.utils.json import register_type
+from typing import Annotated
+import msgspec
+
+'''
+
+Typed scraper responses.
+
+The scraper API answers with {"name", "currentPrice", "ogPrice"}, prices as strings, or with {"error"}.
+Those used to be parsed with response.json() into a dict, after which every caller probed the keys
+and converted the prices with float() again. decode_scrape() decodes the response bytes straight into
+a ScrapeResult with validated float prices, or a ScrapeError, and that object is what the scrape cache,
+the rescrape tasks and store_product work with.
+
+Both types are registered with kombu's JSON serializer, so they also pass through Celery task
+arguments and results as themselves instead of as dicts.
+
+'''
+
+
+class ScrapeResult(msgspec.Struct, frozen=True):
+    name: str
+    # A price of 0 is what the scraper returns for a product that is out of stock, the list shows it as N/A
+    currentPrice: Annotated[float, msgspec.Meta(ge=0)]
+    ogPrice: Annotated[float, msgspec.Meta(ge=0)]
+
+
+class ScrapeError(msgspec.Struct, frozen=True):
+    error: str
+    # Set when the scrape was not attempted because the scraper circuit breaker is open
+    skipped: bool = False
+    # Set when the scraper could not be reached or answered with a server error, only these trip the circuit breaker
+    transport: bool = False
+
+
+
+# Non strict decoders accept the prices as numeric strings
+_result_decoder = msgspec.json.Decoder(ScrapeResult, strict=False)
+_error_decoder = msgspec.json.Decoder(ScrapeError, strict=False)
+
+
+def decode_scrape(raw):
+    '''
+    Decode a scraper response body into a ScrapeResult, or into a ScrapeError if the scraper
+    reported an error or the body does not validate.
+
+    '''
+    try:
+        return _result_decoder.decode(raw)
+    except msgspec.ValidationError as e:
+        try:
+            return _error_decoder.decode(raw)
+        except msgspec.DecodeError:
+            return ScrapeError(error=f"Invalid scraper response: {e}")
+    except msgspec.DecodeError as e:
+        return ScrapeError(error=f"Invalid scraper response: {e}")
+
+
+
+register_type(ScrapeResult, "scrape_result", msgspec.to_builtins, lambda value: msgspec.convert(value, ScrapeResult))
+register_type(ScrapeError, "scrape_error", msgspec.to_builtins, lambda value: msgspec.convert(value, ScrapeError))
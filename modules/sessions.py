@@ -0,0 +1,88 @@
+from modules.cache import get_redis
+from modules.helpers import log_to_file
+from modules.metrics import Histogram
+import time
+import os
+
+'''
+
+Session storage.
+
+Sessions used to be files on the local disk of the web container, every request read and wrote one
+and a second container could not see the sessions of the first. SESSION_BACKEND picks the store:
+
+    redis       Server side sessions in Redis, on the same server as the Celery broker and the scrape cache
+    cookie      Flask's signed cookie sessions, nothing is stored server side so any container can serve any user
+    filesystem  The old session files, for a single container without Redis
+
+Without SESSION_BACKEND the session files are used. Redis has to be picked explicitly, creating the app
+never connects to Redis to find out whether it is there.
+
+'''
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "filesystem").lower()
+
+session_latency = Histogram("session_duration_seconds", "Time spent loading and saving sessions", ("backend", "operation"))
+
+
+class TimedSessionInterface:
+    '''
+    Wraps a session interface and records how long loading and saving the session takes.
+    Every other attribute is passed on to the wrapped interface.
+
+    '''
+
+    def __init__(self, interface, backend):
+        self.interface = interface
+        self.backend = backend
+
+    def open_session(self, app, request):
+        started = time.perf_counter()
+        try:
+            return self.interface.open_session(app, request)
+        finally:
+            session_latency.observe(time.perf_counter() - started, backend=self.backend, operation="open")
+
+    def save_session(self, app, session, response):
+        started = time.perf_counter()
+        try:
+            return self.interface.save_session(app, session, response)
+        finally:
+            session_latency.observe(time.perf_counter() - started, backend=self.backend, operation="save")
+
+    def __getattr__(self, name):
+        return getattr(self.interface, name)
+
+
+
+def init_sessions(app, backend=None):
+    '''
+    Configure the session store of app, returns the backend that is used.
+
+    '''
+    backend = backend or SESSION_BACKEND
+
+    if backend == "redis" and get_redis() is None:
+        log_to_file("SESSION_BACKEND is redis but no Redis URL is configured, using session files", "ERROR")
+        backend = "filesystem"
+
+    # Flask-Session is only imported when a server side backend is used
+    if backend != "cookie":
+        from flask_session import Session
+
+    if backend == "redis":
+        app.config["SESSION_TYPE"] = "redis"
+        app.config["SESSION_REDIS"] = get_redis()
+        app.config["SESSION_KEY_PREFIX"] = "session:"
+        Session(app)
+    elif backend == "cookie":
+        # Flask's default session interface already signs the cookie with the secret key
+        app.config["SESSION_COOKIE_HTTPONLY"] = True
+        app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+    else:
+        backend = "filesystem"
+        app.config["SESSION_TYPE"] = "filesystem"
+        Session(app)
+
+    app.session_interface = TimedSessionInterface(app.session_interface, backend)
+    return backend
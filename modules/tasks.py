@@ -1,11 +1,19 @@
 from celery import shared_task
 from sqlalchemy import select, ScalarResult
-from modules.models import User, UserProduct, Product, db
+from modules.models import User, UserProduct, Product, RescrapeRun, db
 from flask import jsonify, session
 from modules.helpers import log_to_file
-from modules.functions import rescrape_once, retry_scrape
-import re
+from modules.functions import scrape_with_breaker, get_tracked_products, store_product, standardise_URL
+from modules.cache import scrape_cache, single_flight, SCRAPE_CACHE_TTL_USER
+from modules.rescrape import rescrape_concurrently, summarise_run, PriceUpdateBatch, RESCRAPE_CHUNK_SIZE
+from modules.http_client import http_get, pool_stats
+from modules.retry import backoff_delay, scraper_breaker, SCRAPE_MAX_ATTEMPTS
+from modules.scheduler import pick_due_products, tick_budget
+from modules.metrics import MetricsScope, scraper_latency, rescrape_duration, rescrape_products_scraped
+from modules.scrape_result import ScrapeResult, ScrapeError, decode_scrape
+import datetime
 import requests
+import json
 import time
 import os
 
@@ -26,103 +34,327 @@ def request_API(URL):
     This task is purely reserved for requesting the API, it has a concurrency of 1
     So no matter the amount of requests, my API will only handle 1 at a time.
     If i increase the resources on my VPS i will increase the concurrency.
+    Returns a ScrapeResult, or a ScrapeError if the scrape failed.
     
     '''
+    # A product that was scraped recently does not need to wait on the scraper again
+    cache_URL = standardise_URL(URL)
+    result = scrape_cache.get(cache_URL, SCRAPE_CACHE_TTL_USER, "user")
+    if result:
+        return result
+    
+    started = time.perf_counter()
     try:
-        response = requests.get(f"{os.getenv('API_IP')}/user_scrape/scrape?url={URL}")
+        response = http_get(f"{os.getenv('API_IP')}/user_scrape/scrape?url={URL}")
         response.raise_for_status()
-        dictValues = response.json()
-        return dictValues
+        result = decode_scrape(response.content)
+        scraper_latency.observe(time.perf_counter() - started, path="user", outcome="success")
+        scrape_cache.set(cache_URL, result)
+        return result
     
     except requests.exceptions.RequestException as e:
-        return None
+        scraper_latency.observe(time.perf_counter() - started, path="user", outcome="error")
+        return ScrapeError(error=str(e))
 
 
-@shared_task(name="scheduled_rescrape")
-def scheduled_rescrape():
+@shared_task(bind=True)
+def scrape_and_store_product(self, URL, user_id):
+    '''
     
-    log_to_file("Starting Weekly Products rescrape")
+    This task fetches the product data from the scraper API and stores it in the products table
+    and the users userProducts table. It runs on the user_requests queue so the web tier never waits
+    on the scraper, /add_product returns the task ID and the front end polls /add_product/status for the result.
+    This task does not get called if the product is already in the dB since that is handeled in /add_product.
+    /add_product claims the URL in single_flight before queueing this task, the claim is released once the task is done.
+    
+    '''
+    try:
+        return store_scraped_product(URL, user_id)
+    finally:
+        single_flight.release(URL, self.request.id)
+
+
+def store_scraped_product(URL, user_id):
+    '''
+    Scrape the product and store it for the user, returns the result that /add_product/status passes to the front end.
     
-    products = db.session.query(Product).all()
-    for product in products:
-        # Request API per product and catch errors
-        dict_values = rescrape_once(product.URL, product.id)
+    '''
+    failure = {"success": False, 
+               "message": "Error processing product data, please check if the URL you entered is an available product"}
+    
+    try:
+        log_to_file("Fetching product data with scraper API", "INFO", user_id)
         
-        if dict_values.get('error'):
-            log_to_file(f"Requested rescrape failed, retrying: {dict_values}", "ERROR")
-            
-            # Store retry response in variable, check if variable contains an error message
-            # If so, skip product. If not, store response in dict_values and continue the task
-            retry_response = retry_scrape(product.URL, product.id)
+        # request_API gets called directly, this task already runs on the rate limited user_requests queue
+        result = request_API(URL)
+        if not isinstance(result, ScrapeResult):
+            log_to_file(f"API request error: {result}", "ERROR", user_id)
+            return failure
             
-            if retry_response.get('currentPrice'):
-                dict_values = retry_response
-            else:
-                log_to_file(f"Product cant be scraped successfully, skipping product: {product.id}", "ERROR")
-                continue
+        log_to_file(f"Product data fetched: {result}", "INFO", user_id)
+
+        # Add the product to the Products table in the database
+        log_to_file("Adding product to products table", "INFO", user_id)
+        product = store_product(result, URL, user_id)
         
-        log_to_file(f"Requested product succesfully rescraped: {dict_values}")
+        log_to_file(f"Product added succesfully", "INFO", user_id)
+        return {"success": True, "message": "Product added successfully.", "product_data": {"URL": URL,
+                                                                                           "id": product.id,
+                                                                                           "name": product.name,
+                                                                                           "currentPrice": product.currentPrice,
+                                                                                           "ogPrice": product.ogPrice}}
+    
+    except TypeError as e:
+        log_to_file(f"error processing data: {e}", "ERROR", user_id)
+        return failure
+    except KeyError as e:
+        log_to_file(f"KeyError while running function: {e}", "ERROR", user_id)
+        return failure
+    except Exception as e:
+        log_to_file(f"error while running function: {e}", "ERROR", user_id)
+        return failure
+
+
+def queue_price_update(product_id, result, stored_price, updates):
+    '''
+    Queue the scraped prices of a product in updates if either currentPrice or ogPrice changed,
+    otherwise only record that the product was scraped.
+    
+    '''
+    # The ScrapeResult prices are already floats, rounded to cents like the price columns
+    new_current_price = round(result.currentPrice, 2)
+    new_og_price = round(result.ogPrice, 2)
+    
+    # if either currentPrice or ogPrice has changed, queue the new data and its price history for the next bulk update
+    current_price, og_price = stored_price
+    if current_price != new_current_price or og_price != new_og_price:
+        log_to_file(f"Queueing price update for product: {product_id}")
+        updates.add(product_id, new_current_price, new_og_price)
+    else:
+        updates.scraped(product_id)
+
+
+def schedule_retry(product_id, attempt):
+    '''
+    Re-enqueue the scrape of a product as attempt number attempt, with an exponential backoff countdown
+    so the worker is free for other tasks in the meantime.
+    
+    '''
+    if attempt > SCRAPE_MAX_ATTEMPTS:
+        log_to_file(f"Product cant be scraped successfully after {SCRAPE_MAX_ATTEMPTS} attempts, skipping product: {product_id}", "ERROR")
+        return False
+    
+    countdown = backoff_delay(attempt - 1)
+    log_to_file(f"Retrying product {product_id} in {countdown:.0f}s, attempt {attempt}")
+    retry_rescrape.apply_async(args=[product_id, attempt], countdown=countdown, queue='scheduled_task')
+    return True
+
+
+@shared_task(name="retry_rescrape")
+def retry_rescrape(product_id, attempt):
+    
+    product = db.session.get(Product, product_id)
+    if product is None:
+        return
+    
+    result = scrape_with_breaker(product.URL, product.id)
+    
+    # While the scraper is down the retry waits for the next backoff without recording a failed scrape,
+    # it still uses up an attempt so a breaker that stays open does not re-enqueue the product forever
+    if isinstance(result, ScrapeError) and result.skipped:
+        schedule_retry(product_id, attempt + 1)
+        return
+    
+    updates = PriceUpdateBatch()
+    if not isinstance(result, ScrapeResult):
+        updates.failed(product_id)
+        updates.flush()
+        schedule_retry(product_id, attempt + 1)
+        return
+    
+    queue_price_update(product_id, result, (product.currentPrice, product.ogPrice), updates)
+    updates.flush()
+    log_to_file(f"Requested product succesfully rescraped on attempt {attempt}: {result}")
+
+
+def rescrape_products(products, latencies=None):
+    '''
+    Rescrape the given products concurrently and update the ones whose price changed.
+    Products can be Product objects or rows with the id, URL, currentPrice and ogPrice columns.
+    The scrapes run in the rescrape engine's thread pool, the database updates happen here
+    in the task's own thread and are written in bulk by PriceUpdateBatch.
+    Failed products are recorded as failed attempts and re-enqueued with a backoff, once the scraper circuit breaker trips the rest is skipped.
+    Returns the summary with wall time, per-product latency, the amount of commits saved and the scrape cache
+    hits and misses of the rescrapes, the latencies are also appended to latencies if a list is given.
+    
+    '''
+    # Read the stored prices up front, committing a batch expires the ORM objects
+    # and reading them again afterwards would cost a query per product
+    stored_prices = {product.id: (product.currentPrice, product.ogPrice) for product in products}
+    work = [(product.id, product.URL) for product in products]
+    updates = PriceUpdateBatch()
+    chunk_latencies = []
+    retries = 0
+    skipped = 0
+    # The cache counters are per process, the difference is what this chunk used
+    cache_before = scrape_cache.stats()
+    
+    started = time.perf_counter()
+    for product_id, result, latency in rescrape_concurrently(work, scrape_with_breaker):
         
-        #Convert dictValues from string to float to allow comparison
-        new_current_price = float(dict_values["currentPrice"])
-        new_og_price = float(dict_values["ogPrice"])
+        # The circuit breaker is open, the scraper is not even requested
+        if isinstance(result, ScrapeError) and result.skipped:
+            skipped += 1
+            continue
         
-        # if either currentPrice or ogPrice has changed, update the product in the dB with the new data
-        if product.currentPrice != new_current_price or product.ogPrice != new_og_price:
-            log_to_file("Updating product data")
-            
-            product.currentPrice = new_current_price
-            product.ogPrice = new_og_price
-            db.session.commit()
-            
-            log_to_file("Successfully updated product data")
-            
-        # Sleep for 2 seconds to not overload the API
-        time.sleep(2)
+        chunk_latencies.append(latency)
+        
+        if not isinstance(result, ScrapeResult):
+            # The failed attempt is recorded too, otherwise the scheduler would pick the product again every tick
+            updates.failed(product_id)
+            if schedule_retry(product_id, 2):
+                retries += 1
+            continue
         
+        log_to_file(f"Requested product succesfully rescraped in {latency:.2f}s: {result}")
+        queue_price_update(product_id, result, stored_prices[product_id], updates)
+    
+    updates.flush()
+    log_to_file(f"Successfully updated product data of {updates.updated} products in {updates.commits} commits")
+    
+    if skipped:
+        log_to_file(f"Scraper circuit breaker is open, skipped {skipped} products", "ERROR")
+    
+    if latencies is not None:
+        latencies.extend(chunk_latencies)
+    
+    summary = summarise_run(chunk_latencies, time.perf_counter() - started)
+    summary["price_updates"] = updates.updated
+    summary["commits"] = updates.commits
+    summary["commits_saved"] = updates.commits_saved
+    summary["retries_scheduled"] = retries
+    summary["skipped_by_breaker"] = skipped
+    
+    cache_after = scrape_cache.stats()
+    summary["scrape_cache_hits"] = cache_after["hits"].get("rescrape", 0) - cache_before["hits"].get("rescrape", 0)
+    summary["scrape_cache_misses"] = cache_after["misses"].get("rescrape", 0) - cache_before["misses"].get("rescrape", 0)
+    return summary
 
-@shared_task(name="scheduled_user_rescrape")
-def scheduled_user_rescrape():
+
+def start_or_resume_run(kind):
+    '''
+    Return the unfinished run of this kind if there is one, so it continues after its cursor,
+    otherwise start a new run from the first product.
     
-    log_to_file("Starting Daily UserProducts rescrape")
+    '''
+    run = db.session.query(RescrapeRun).filter_by(kind=kind, status="running").order_by(RescrapeRun.id.desc()).first()
+    if run:
+        log_to_file(f"Resuming {kind} rescrape run {run.id} after product {run.cursor}")
+        return run
     
-    userProducts_id = db.session.query(UserProduct.productID).all()
+    run = RescrapeRun(kind=kind, status="running", cursor=0, productsDone=0)
+    db.session.add(run)
+    db.session.commit()
+    return run
+
+
+def run_rescrape(kind, products_query):
+    '''
+    Rescrape every product of products_query in keyset paginated chunks of RESCRAPE_CHUNK_SIZE products,
+    only one chunk is held in memory at a time so memory use stays flat no matter how big the catalog is.
+    After every chunk the run record gets the id of the last product as its checkpoint,
+    if the worker restarts the next run of the same kind resumes from there.
+    Returns the summary of the whole run.
     
-    for id in userProducts_id:
-        # Extract and clean up the product IDs from the UserProducts table
-        id = re.sub("[^0-9]", "", str(id[0]))
-        product = db.session.query(Product).filter_by(id=id).first()
+    '''
+    # The scope counts the SQL queries of the whole run for the summary
+    with MetricsScope() as scope:
+        run = start_or_resume_run(kind)
+        run_id = run.id
+        cursor = run.cursor
+        latencies = []
+        totals = {"price_updates": 0, "commits": 0, "commits_saved": 0, "retries_scheduled": 0, "skipped_by_breaker": 0,
+                  "scrape_cache_hits": 0, "scrape_cache_misses": 0}
         
-        #Request rescrape with cleaned up product ID
-        dict_values = rescrape_once(product.URL, product.id)
-        if dict_values.get('error'):
-            log_to_file(f"Requested rescrape failed, retrying: {dict_values}", "ERROR")
+        started = time.perf_counter()
+        while True:
+            # Plain rows of the columns the rescrape needs, no ORM objects pile up in the session's identity map
+            products = products_query.with_entities(Product.id, Product.URL, Product.currentPrice, Product.ogPrice)\
+                .filter(Product.id > cursor)\
+                .order_by(Product.id)\
+                .limit(RESCRAPE_CHUNK_SIZE)\
+                .all()
+            if not products:
+                break
             
-            # Store retry response in variable, check if variable contains an error message
-            # If so, skip product. If not, store response in dict_values and continue the task
-            retry_response = retry_scrape(product.URL, product.id)
+            last_id = products[-1].id
+            chunk_summary = rescrape_products(products, latencies)
+            for key in totals:
+                totals[key] += chunk_summary[key]
             
-            if retry_response.get('currentPrice'):
-                dict_values = retry_response
-            else:
-                log_to_file(f"Product cant be scraped successfully, skipping product: {product.id}", "ERROR")
-                continue
+            # Stop without moving the checkpoint when the scraper is down, the next run redoes this chunk
+            if scraper_breaker.is_open:
+                log_to_file(f"Pausing {kind} rescrape run {run_id} at product {cursor}, scraper circuit breaker is open", "ERROR")
+                break
             
-        log_to_file(f"Requested product succesfully rescraped: {dict_values}")
-        
-        #Convert dictValues from string to float to allow comparison
-        new_current_price = float(dict_values["currentPrice"])
-        new_og_price = float(dict_values["ogPrice"])
+            cursor = last_id
+            db.session.query(RescrapeRun).filter_by(id=run_id).update({RescrapeRun.cursor: cursor,
+                                                                       RescrapeRun.productsDone: RescrapeRun.productsDone + len(products)})
+            db.session.commit()
         
-        # if either currentPrice or ogPrice has changed, update the product in the dB with the new data
-        if product.currentPrice != new_current_price or product.ogPrice != new_og_price:
-            log_to_file("Updating product data")
-            
-            product.currentPrice = new_current_price
-            product.ogPrice = new_og_price
+        if not scraper_breaker.is_open:
+            db.session.query(RescrapeRun).filter_by(id=run_id).update({RescrapeRun.status: "finished",
+                                                                       RescrapeRun.finishedAt: datetime.datetime.now()})
             db.session.commit()
-            
-            log_to_file("Successfully updated product data")
-            
-        # Sleep for 2 seconds to not overload the API
-        time.sleep(2)
\ No newline at end of file
+    
+    summary = summarise_run(latencies, time.perf_counter() - started)
+    summary.update(totals)
+    summary["run_id"] = run_id
+    summary["kind"] = kind
+    summary["queries"] = scope.queries
+    summary["query_time"] = round(scope.query_time, 3)
+    summary["http_pools"] = pool_stats()
+    
+    rescrape_duration.observe(summary["wall_time"], kind=kind)
+    rescrape_products_scraped.inc(summary["products"], kind=kind)
+    log_to_file(f"Rescrape finished: {json.dumps(summary, default=str)}")
+    return summary
+
+
+@shared_task(name="scheduled_rescrape")
+def scheduled_rescrape():
+    
+    log_to_file("Starting Weekly Products rescrape")
+    
+    return run_rescrape("full", db.session.query(Product))
+        
+
+@shared_task(name="scheduled_user_rescrape")
+def scheduled_user_rescrape():
+    
+    log_to_file("Starting Daily UserProducts rescrape")
+    
+    # Every tracked product is scraped once, no matter how many users track it
+    products, duplicates_skipped = get_tracked_products()
+    log_to_file(f"Skipping {duplicates_skipped} duplicate scrapes of products tracked by multiple users")
+    
+    summary = run_rescrape("user", products)
+    summary["duplicates_skipped"] = duplicates_skipped
+    return summary
+
+
+@shared_task(name="scheduled_priority_rescrape")
+def scheduled_priority_rescrape():
+    
+    # Runs every SCHEDULER_TICK_MINUTES, rescrapes the most stale, volatile and watched products within the budget of this tick
+    budget = tick_budget()
+    products = pick_due_products(budget)
+    log_to_file(f"Starting priority rescrape of {len(products)} products, budget {budget}")
+    
+    if not products:
+        return {"products": 0, "budget": budget}
+    
+    summary = rescrape_products(products)
+    summary["budget"] = budget
+    log_to_file(f"Priority rescrape finished: {summary}")
+    return summary
@@ -0,0 +1,76 @@
+from modules.http_client import http_post
+from modules.helpers import log_to_file
+from modules.cache import LRUCache
+import requests
+import hashlib
+import os
+
+'''
+
+Cloudflare Turnstile verification for the register route.
+
+The register route only verifies a token when the form is submitted, loading the page never waits on Cloudflare.
+Rejected tokens are kept for TURNSTILE_CACHE_TTL seconds keyed by a hash of the token, submitting one again
+is turned away without asking Cloudflare. Accepted tokens are never cached, Cloudflare only accepts a token once
+and a cached success would let one solved challenge register any number of accounts.
+
+TURNSTILE_VERIFIER=local replaces Cloudflare with a stand-in for tests and local development,
+it accepts every token except empty ones and ones that start with "fail".
+
+'''
+
+TURNSTILE_VERIFY_URL = 'https://challenges.cloudflare.com/turnstile/v0/siteverify'
+TURNSTILE_VERIFIER = os.getenv("TURNSTILE_VERIFIER", "cloudflare").lower()
+TURNSTILE_CACHE_TTL = int(os.getenv("TURNSTILE_CACHE_TTL", "300"))
+
+verdict_cache = LRUCache(1024)
+
+
+def cloudflare_verify(token, secret, remoteip=None):
+    data = {
+        'secret': secret,
+        'response': token
+    }
+    
+    if remoteip:
+        data['remoteip'] = remoteip
+        
+    try:
+        response = http_post(TURNSTILE_VERIFY_URL, data=data, timeout=10)
+        response.raise_for_status()
+        return response.json()
+    except requests.RequestException as e:
+        log_to_file(f"Turnstile validation error: {e}")
+        return {'success': False, 'error-codes': ['internal-error']}
+
+
+
+def local_verify(token, secret=None, remoteip=None):
+    # Stand-in for Cloudflare that never leaves the machine
+    if token.startswith("fail"):
+        return {'success': False, 'error-codes': ['invalid-input-response']}
+    return {'success': True, 'error-codes': []}
+
+
+
+def validate_turnsrtile(token, secret, remoteip=None):
+    '''
+    Verify a Turnstile token, returns the verdict in the same format as Cloudflare's siteverify.
+    
+    '''
+    # Cloudflare would reject a missing token as well, there is no need to ask
+    if not token:
+        return {'success': False, 'error-codes': ['missing-input-response']}
+    
+    key = hashlib.sha256(token.encode()).hexdigest()
+    verdict = verdict_cache.get(key)
+    if verdict is not None:
+        return verdict
+    
+    verify = local_verify if TURNSTILE_VERIFIER == "local" else cloudflare_verify
+    verdict = verify(token, secret, remoteip)
+    
+    # Errors on our side are not a verdict on the token, those are verified again on the next submit
+    if not verdict.get('success') and 'internal-error' not in verdict.get('error-codes', []):
+        verdict_cache.set(key, verdict, TURNSTILE_CACHE_TTL)
+    return verdict
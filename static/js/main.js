@@ -182,4 +182,35 @@ function emptyTableMessage(tableBody) {
     tableBody.appendChild(emptyTableRow);
 }
 
-window.emptyTableMessage = emptyTableMessage
\ No newline at end of file
+window.emptyTableMessage = emptyTableMessage
+
+
+function pollProductStatus(taskId) {
+    // Poll the result of a product scrape queued by /add_product every second
+    // until the worker is done, gives up after 60 seconds
+    return new Promise((resolve, reject) => {
+        let attempts = 0;
+
+        function poll() {
+            attempts++;
+            fetch(`${window.urlPrefix}/add_product/status/${taskId}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.pending !== true) {
+                    resolve(data);
+                }
+                else if (attempts >= 60) {
+                    reject(new Error("Timed out waiting for product data"));
+                }
+                else {
+                    setTimeout(poll, 1000);
+                }
+            })
+            .catch(reject);
+        }
+
+        poll();
+    });
+}
+
+window.pollProductStatus = pollProductStatus
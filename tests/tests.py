@@ -4,27 +4,52 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from modules.functions import validate_URL
+from flask import Flask, session, request
+from modules.models import User, UserProduct, Product, PriceHistory, RescrapeRun, db
+from modules.history import to_cents, get_price_history, get_lowest_price
+import datetime
+from modules.functions import validate_URL, get_tracked_products, get_user_products, get_cached_user_products, store_product, check_product_existence
+from modules.migrations import run_migrations, migration_001
+import modules.helpers as helpers
+import modules.metrics as metrics_module
+import modules.http_client as http_client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from modules.cache import LRUCache, ScrapeCache, SingleFlight, ProductListCache, product_list_cache
+from modules.retry import backoff_delay, CircuitBreaker, SCRAPE_BACKOFF_BASE
+from modules.scheduler import priority, pick_due_products
+from modules.metrics import Histogram, MetricsScope, init_metrics, queue_wait, scrape_cache_lookups, render_metrics
+from modules.sessions import init_sessions, session_latency
+import tempfile
+import re
+from sqlalchemy import text
+from modules.rescrape import rescrape_concurrently, summarise_run, PriceUpdateBatch
+from modules.scrape_result import ScrapeResult, ScrapeError, decode_scrape
+from kombu.utils.json import dumps as kombu_dumps, loads as kombu_loads
+import modules.tasks as tasks
+import modules.functions as functions
+import requests
+import modules.bulk_import as bulk_import
+import modules.passwords as passwords
+import modules.turnstile as turnstile
+import modules.asgi as asgi
+import asyncio
+import threading
+import json
+import time
     
 
     
-# Test the retry functionality of the 24H based scheduled scraper
-def mock_retry_scrape(mock_responses):
-        
-    # Loop through mock_responses to test functionality
-    for i in range (0, 2):
-        dict_values = mock_responses[i]
-        
-        # if dict_values contains the key 'currentPrice' it was successful,
-        # return dict_values that contains product data and the amount of attempts for testing
-        if dict_values.get('currentPrice'):
-            return dict_values, (i + 1)
-        
-        # if loop is on second try and doesnt contain the key 'currentPrice',
-        # the scraping failed twice, return dict_values that contains error message and the amount of attempts for testing
-        if i == 1:
-            return dict_values, (i + 1)
+# Create a minimal app with an in-memory SQLite database to test the database logic against
+def make_test_app():
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
     
+    with app.app_context():
+        db.create_all()
+    return app
+
 
 
 # This mock function combines the product checking logic from add_product and check_product_existence into one testing function
@@ -46,38 +71,11 @@ def mock_product_check_logic_test(product_exists_in_products_table, user_already
         else:  
             return {"success": True, "message": "Product added successfully."}
     else:
-        # Product doesn't exist in Products table, would call process_product_data
+        # Product doesn't exist in Products table, would queue scrape_and_store_product
         return {"success": True, "message": "Will process new product"}
         
     
 
-# Test if the core functionality and error handling of process_product_data is correct
-def mock_process_product_data(mock_response=None, raise_exception=None):
-    
-    try:
-        if raise_exception:
-            raise raise_exception
-        
-        dict_values = mock_response
-        
-        if dict_values.get("error"):
-            return False, None
-            
-        return True, dict_values
-    
-    except TypeError as e:
-        return False, None
-    except KeyError as e:
-        return False, None
-    except Exception as e:
-        return False, None
-    
-    
-
-
-
-
-
 # TESTS
 
 def test_validate_URL():
@@ -95,38 +93,75 @@ def test_validate_URL():
 
 
 
-def test_retry_scrape():
-    """Test different retry scenarios"""
+def test_schedule_retry():
+    queued = []
     
-    # Test 1: Success on first try
-    mock_responses = [{'currentPrice': 29.99, 'name': 'Test Product'}]
-    result, attempts = mock_retry_scrape(mock_responses)
-    assert result.get('currentPrice') == 29.99
-    assert attempts == 1
-    print("Retry test 1 passed: Success on first try")
+    # Record the queued retries instead of sending them to the broker
+    class MockRetryTask:
+        def apply_async(self, args, countdown, queue):
+            queued.append((args, countdown, queue))
     
-    # Test 2: Fail first, succeed second (this is the important one!)
-    mock_responses = [
-        {'error': 'scraping failed'}, 
-        {'currentPrice': 19.99, 'name': 'Test Product'}
-    ]
-    result, attempts = mock_retry_scrape(mock_responses)
-    assert result.get('currentPrice') == 19.99
-    assert attempts == 2
-    print("Retry test 2 passed: Failed first, succeeded second")
+    original_retry_rescrape = tasks.retry_rescrape
+    tasks.retry_rescrape = MockRetryTask()
+    try:
+        # Every retry is queued with a backoff countdown on the scheduled_task queue, up to SCRAPE_MAX_ATTEMPTS attempts
+        for attempt in range(2, tasks.SCRAPE_MAX_ATTEMPTS + 1):
+            assert tasks.schedule_retry(1, attempt) == True
+        assert [args for args, countdown, queue in queued] == [[1, attempt] for attempt in range(2, tasks.SCRAPE_MAX_ATTEMPTS + 1)]
+        assert all(queue == "scheduled_task" for args, countdown, queue in queued)
+        assert SCRAPE_BACKOFF_BASE / 2 <= queued[0][1] <= SCRAPE_BACKOFF_BASE
+        
+        # After the last attempt the product is skipped
+        queued.clear()
+        assert tasks.schedule_retry(1, tasks.SCRAPE_MAX_ATTEMPTS + 1) == False
+        assert queued == []
+    finally:
+        tasks.retry_rescrape = original_retry_rescrape
     
-    # Test 3: Fail both attempts
-    mock_responses = [
-        {'error': 'scraping failed'}, 
-        {'error': 'scraping failed again'}
-    ]
-    result, attempts = mock_retry_scrape(mock_responses)
-    assert result.get('currentPrice') is None
-    assert 'error' in result
-    assert attempts == 2
-    print("Retry test passed: Failed both attempts")
+    print("All schedule retry tests passed!")
+
+
+
+def test_retry_rescrape():
+    app = make_test_app()
+    results = {1: ScrapeError(error="scraping failed"),
+               2: ScrapeResult(name="Product 2", currentPrice=7.0, ogPrice=10.0),
+               3: ScrapeError(error="Scraper circuit breaker is open", skipped=True)}
+    
+    retried = []
+    def mock_schedule_retry(product_id, attempt):
+        retried.append((product_id, attempt))
+        return True
+    
+    original_functions = tasks.scrape_with_breaker, tasks.schedule_retry
+    tasks.scrape_with_breaker = lambda URL, product_id: results[product_id]
+    tasks.schedule_retry = mock_schedule_retry
+    try:
+        with app.app_context():
+            for i in range(0, 3):
+                db.session.add(Product(URL=f"https://www.bol.com/nl/nl/p/product-{i}", name=f"Product {i}", ogPrice=10, currentPrice=10))
+            db.session.commit()
+            
+            # A failed retry is recorded and queues the next attempt
+            tasks.retry_rescrape(1, 2)
+            assert retried == [(1, 3)]
+            assert db.session.get(Product, 1).failureCount == 1
+            
+            # A successful retry stores the new price
+            tasks.retry_rescrape(2, 2)
+            assert retried == [(1, 3)]
+            product = db.session.get(Product, 2)
+            assert product.currentPrice == 7
+            assert product.scrapeCount == 1
+            
+            # A retry skipped by the open breaker is not a failed scrape, but it does use up an attempt
+            tasks.retry_rescrape(3, 2)
+            assert retried == [(1, 3), (3, 3)]
+            assert db.session.get(Product, 3).failureCount == 0
+    finally:
+        tasks.scrape_with_breaker, tasks.schedule_retry = original_functions
     
-    print("All retry logic tests passed!")
+    print("All retry rescrape tests passed!")
 
 
 
@@ -151,51 +186,1168 @@ def test_product_check_logic():
      
     
     
-def test_process_product_data():
+def test_rescrape_concurrently():
+    
+    # Track how many scrapes run at the same time per host to check the per-host limit
+    active = {}
+    peak = {}
+    lock = threading.Lock()
+    
+    def mock_scrape(URL, product_id):
+        host = URL.split("/")[2]
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+        time.sleep(0.02)
+        with lock:
+            active[host] -= 1
+        return {"currentPrice": product_id, "ogPrice": product_id}
+    
+    work = [(i, f"https://www.bol.com/nl/nl/p/product-{i}") for i in range(0, 6)]
+    work += [(i, f"https://www.mediamarkt.nl/nl/product/{i}") for i in range(6, 12)]
+    
+    results = list(rescrape_concurrently(work, mock_scrape, max_workers=8, per_host=2))
+    
+    # Every product is scraped exactly once and gets its own response back
+    assert sorted(product_id for product_id, _, _ in results) == list(range(0, 12))
+    for product_id, dict_values, latency in results:
+        assert dict_values["currentPrice"] == product_id
+        assert latency > 0
+    
+    # No host ever had more than 2 requests in flight, but both hosts did run in parallel
+    assert peak["www.bol.com"] == 2
+    assert peak["www.mediamarkt.nl"] == 2
+    
+    print("All concurrent rescrape tests passed!")
+
+
+
+def test_summarise_run():
+    summary = summarise_run([0.4, 0.1, 0.2, 0.3], 1.23456)
+    assert summary["products"] == 4
+    assert summary["wall_time"] == 1.235
+    assert summary["latency_mean"] == 0.25
+    assert summary["latency_p50"] == 0.2
+    assert summary["latency_max"] == 0.4
+    
+    # An empty run should not divide by zero
+    summary = summarise_run([], 0.0)
+    assert summary["products"] == 0
+    assert summary["latency_mean"] == 0.0
+    
+    print("All rescrape summary tests passed!")
+    
+
+
+def test_get_tracked_products():
+    app = make_test_app()
+    
+    with app.app_context():
+        for i in range(0, 3):
+            db.session.add(Product(URL=f"https://www.bol.com/nl/nl/p/product-{i}", name=f"Product {i}", ogPrice=10, currentPrice=5))
+        db.session.commit()
+        
+        # Product 1 is tracked by 3 users, product 2 by 1 user and product 3 by nobody
+        for user_id in range(1, 4):
+            db.session.add(UserProduct(userID=user_id, productID=1))
+        db.session.add(UserProduct(userID=1, productID=2))
+        db.session.commit()
+        
+        products, duplicates_skipped = get_tracked_products()
+        assert sorted(product.id for product in products) == [1, 2]
+        assert duplicates_skipped == 2
+    
+    print("All tracked product tests passed!")
+    
+
+
+def test_price_update_batch():
+    app = make_test_app()
+    
+    with app.app_context():
+        for i in range(0, 5):
+            db.session.add(Product(URL=f"https://www.bol.com/nl/nl/p/product-{i}", name=f"Product {i}", ogPrice=10, currentPrice=10))
+        db.session.commit()
+        
+        # 5 changed products with a chunk size of 2 should be written in 3 commits
+        updates = PriceUpdateBatch(chunk_size=2)
+        for product_id in range(1, 6):
+            updates.add(product_id, 5, 10)
+        updates.flush()
+        
+        assert updates.updated == 5
+        assert updates.commits == 3
+        assert updates.commits_saved == 2
+        assert db.session.query(Product).filter_by(currentPrice=5).count() == 5
+        assert db.session.query(PriceHistory).filter_by(currentPriceCents=500).count() == 5
+        
+        # Flushing an empty batch should not commit
+        updates.flush()
+        assert updates.commits == 3
+        
+        # A commit of unchanged products only saves nothing, the old rescrape did not commit those at all
+        updates.scraped(1)
+        updates.flush()
+        assert updates.commits == 4
+        assert updates.commits_saved == 2
+    
+    print("All price update batch tests passed!")
+
+
+
+def test_rescrape_products():
+    app = make_test_app()
+    
+    # Products with an even id get a new price, odd ids keep their price and product 3 fails to scrape
+    def mock_scrape(URL, product_id):
+        if product_id == 3:
+            return ScrapeError(error="scraping failed")
+        if product_id % 2 == 0:
+            return ScrapeResult(name=f"Product {product_id}", currentPrice=7.0, ogPrice=10.0)
+        return ScrapeResult(name=f"Product {product_id}", currentPrice=10.0, ogPrice=10.0)
+    
+    # Record the retries instead of queueing them on Celery
+    retried = []
+    def mock_schedule_retry(product_id, attempt):
+        retried.append((product_id, attempt))
+        return True
+    
+    original_functions = tasks.scrape_with_breaker, tasks.schedule_retry
+    tasks.scrape_with_breaker = mock_scrape
+    tasks.schedule_retry = mock_schedule_retry
+    try:
+        with app.app_context():
+            for i in range(0, 5):
+                db.session.add(Product(URL=f"https://www.bol.com/nl/nl/p/product-{i}", name=f"Product {i}", ogPrice=10, currentPrice=10))
+            db.session.commit()
+            
+            summary = tasks.rescrape_products(db.session.query(Product).all())
+            
+            assert summary["products"] == 5
+            assert summary["price_updates"] == 2
+            assert summary["commits"] == 1
+            assert summary["commits_saved"] == 1
+            assert summary["retries_scheduled"] == 1
+            assert retried == [(3, 2)]
+            assert sorted(product.id for product in db.session.query(Product).filter_by(currentPrice=7).all()) == [2, 4]
+            
+            # Every scraped product is marked as scraped, only changed products count as a change
+            products = {product.id: product for product in db.session.query(Product).all()}
+            assert [products[i].scrapeCount for i in range(1, 6)] == [1, 1, 0, 1, 1]
+            assert [products[i].changeCount for i in range(1, 6)] == [0, 1, 0, 1, 0]
+            assert products[3].lastScrapedAt is None
+            assert products[1].lastScrapedAt is not None
+            
+            # The failed product still counts as attempted, so the scheduler does not pick it again right away
+            assert [products[i].failureCount for i in range(1, 6)] == [0, 0, 1, 0, 0]
+            assert products[3].lastAttemptAt is not None
+    finally:
+        tasks.scrape_with_breaker, tasks.schedule_retry = original_functions
+    
+    print("All rescrape product tests passed!")
+    
+
+
+def test_scrape_and_store_product():
+    app = make_test_app()
+    URL = "https://www.bol.com/nl/nl/p/new-product"
+    
+    original_functions = tasks.request_API, tasks.store_product
+    try:
+        with app.app_context():
+            # Successful scrape stores the product for the user and returns its data for the front end
+            tasks.request_API = lambda URL: ScrapeResult(name="New product", currentPrice=20.0, ogPrice=25.0)
+            result = tasks.scrape_and_store_product(URL, 7)
+            assert result["success"] == True
+            assert result["product_data"]["URL"] == URL
+            assert result["product_data"]["name"] == "New product"
+            
+            product = db.session.query(Product).filter_by(URL=URL).first()
+            assert result["product_data"]["id"] == product.id
+            assert db.session.query(UserProduct).filter_by(userID=7, productID=product.id).count() == 1
+            
+            # Scraper errors and failed requests are reported back without storing anything
+            tasks.request_API = lambda URL: ScrapeError(error='Failed to find class "promo-price"')
+            result = tasks.scrape_and_store_product("https://www.bol.com/nl/nl/p/broken", 7)
+            assert result["success"] == False
+            
+            tasks.request_API = lambda URL: ScrapeError(error="Connection refused")
+            result = tasks.scrape_and_store_product("https://www.bol.com/nl/nl/p/broken", 7)
+            assert result["success"] == False
+            
+            # A crash while storing the product is reported back as a failure as well
+            def crashing_store_product(result, URL, user_id):
+                raise KeyError("currentPrice")
+            tasks.request_API = lambda URL: ScrapeResult(name="Broken product", currentPrice=20.0, ogPrice=25.0)
+            tasks.store_product = crashing_store_product
+            result = tasks.scrape_and_store_product("https://www.bol.com/nl/nl/p/broken", 7)
+            assert result["success"] == False
+            assert db.session.query(Product).count() == 1
+    finally:
+        tasks.request_API, tasks.store_product = original_functions
+    
+    print("All scrape and store tests passed!")
+    
+
+
+def test_get_user_products():
+    app = make_test_app()
+    
+    with app.app_context():
+        for i in range(0, 3):
+            db.session.add(Product(URL=f"https://www.bol.com/nl/nl/p/product-{i}", name=f"Product {i}", ogPrice=10, currentPrice=5))
+        db.session.commit()
+        
+        # User 1 added product 3 before product 1, user 2 only tracks product 2
+        db.session.add(UserProduct(userID=1, productID=3))
+        db.session.add(UserProduct(userID=1, productID=1))
+        db.session.add(UserProduct(userID=2, productID=2))
+        db.session.commit()
+        
+        products = get_user_products(1)
+        assert [product.id for product in products] == [3, 1]
+        assert products[0].URL == "https://www.bol.com/nl/nl/p/product-2"
+        assert products[0].name == "Product 2"
+        assert products[0].currentPrice == 5
+        assert products[0].ogPrice == 10
+        
+        assert get_user_products(3) == []
     
-    # Test if success case returns correctly
-    mock_response = {
-        "name": "Mock product name",
-        "currentPrice": "49.99",
-        "ogPrice": "64.99"
-        }
-    result, dict_values = mock_process_product_data(mock_response=mock_response)
-    assert result == True
-    assert dict_values["name"] == "Mock product name"
-    assert dict_values["currentPrice"] == "49.99"
-    assert dict_values["ogPrice"] == "64.99"
+    print("All user product listing tests passed!")
     
+
+
+def test_query_plans_use_indexes():
+    app = make_test_app()
     
-    # Test if error response from API call is handled correctly
-    mock_response = {
-        "error": 'Failed to find class "promo-price"'
+    # Every hot lookup should search an index instead of scanning the whole table
+    lookups = {
+        "SELECT id FROM products WHERE URL = 'x'": "uq_products_URL",
+        "SELECT id FROM products WHERE name = 'x'": "ix_products_name",
+        "SELECT id FROM userProducts WHERE userID = 1": "uq_userProducts_userID_productID",
+        "SELECT id FROM userProducts WHERE productID = 1": "ix_userProducts_productID",
+        "SELECT id FROM userProducts WHERE userID = 1 AND productID = 1": "uq_userProducts_userID_productID",
+        "SELECT id FROM users WHERE username = 'x'": "ix_users_username",
     }
-    result, dict_values = mock_process_product_data(mock_response=mock_response)
-    assert result == False
-    assert dict_values == None
     
+    with app.app_context():
+        for query, index in lookups.items():
+            plan = " ".join(str(row[-1]) for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {query}")))
+            assert f"USING INDEX {index}" in plan or f"USING COVERING INDEX {index}" in plan, plan
+    
+    print("All query plan tests passed!")
+
+
+
+def test_unique_constraints():
+    app = make_test_app()
+    URL = "https://www.bol.com/nl/nl/p/product"
+    
+    with app.app_context():
+        # Storing the same URL twice reuses the first product instead of inserting a duplicate
+        first = store_product(ScrapeResult(name="Product", currentPrice=5.0, ogPrice=10.0), URL, 1)
+        second = store_product(ScrapeResult(name="Product", currentPrice=5.0, ogPrice=10.0), URL, 2)
+        assert first.id == second.id
+        assert db.session.query(Product).count() == 1
+        
+        # The database rejects a second link between the same user and product
+        assert check_product_existence(URL, first.id, 1) == True
+        assert check_product_existence(URL, first.id, 3) == False
+        assert db.session.query(UserProduct).count() == 3
+    
+    print("All unique constraint tests passed!")
+
+
+
+def test_run_migrations():
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    
+    with app.app_context():
+        # Recreate the schema from before the first migration: the original tables without indexes, Integer prices and duplicate rows
+        db.session.execute(text('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username VARCHAR(100) NOT NULL, "passwordHash" VARCHAR(200) NOT NULL)'))
+        db.session.execute(text('CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, "URL" VARCHAR(500) NOT NULL, name VARCHAR(300) NOT NULL, "ogPrice" INTEGER NOT NULL, "currentPrice" INTEGER NOT NULL)'))
+        db.session.execute(text('CREATE TABLE "userProducts" (id INTEGER PRIMARY KEY AUTOINCREMENT, "userID" INTEGER NOT NULL, "productID" INTEGER NOT NULL)'))
+        
+        for i in range(0, 3):
+            db.session.execute(text('INSERT INTO products ("URL", name, "ogPrice", "currentPrice") VALUES (:URL, :name, 10, 5)'),
+                               {"URL": "https://www.bol.com/nl/nl/p/product", "name": "Product"})
+        for user_id, product_id in [(1, 1), (1, 2), (2, 3)]:
+            db.session.execute(text('INSERT INTO "userProducts" ("userID", "productID") VALUES (:user_id, :product_id)'),
+                               {"user_id": user_id, "product_id": product_id})
+        db.session.commit()
+        
+        # Migration 1 only creates its own indexes, not the ones on columns that later migrations add
+        migration_001()
+        indexes = {row[0] for row in db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'"))}
+        assert indexes == {"ix_users_username", "uq_products_URL", "ix_products_name", "uq_userProducts_userID_productID", "ix_userProducts_productID"}
+        
+        assert run_migrations() == [1, 2, 3, 4, 5]
+        
+        # Duplicates are merged into product 1, each user keeps a single link to it
+        assert [product.id for product in db.session.query(Product).all()] == [1]
+        assert sorted((row.userID, row.productID) for row in db.session.query(UserProduct).all()) == [(1, 1), (2, 1)]
+        
+        indexes = {row[0] for row in db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+        assert "uq_products_URL" in indexes
+        assert "uq_userProducts_userID_productID" in indexes
+        assert "ix_products_lastScrapedAt" in indexes
+        
+        # The remaining product starts its price history with its current price
+        assert [(row.productID, row.currentPriceCents) for row in db.session.query(PriceHistory).all()] == [(1, 500)]
+        
+        # Applied migrations are not run again
+        assert run_migrations() == []
+    
+    print("All migration tests passed!")
+    
+
+
+def test_log_to_file():
+    log_dir = tempfile.mkdtemp()
+    original_files = helpers.LOG_FILE, helpers.ERROR_LOG_FILE
+    helpers.LOG_FILE = os.path.join(log_dir, "scraper_logs.txt")
+    helpers.ERROR_LOG_FILE = os.path.join(log_dir, "scraper_errors.txt")
+    
+    try:
+        helpers.log_to_file("Regular message", "INFO", 3)
+        helpers.log_to_file("Something broke", "ERROR")
+        assert helpers.flush_logs() == True
+        
+        with open(helpers.LOG_FILE, encoding="utf-8") as file:
+            lines = file.readlines()
+        with open(helpers.ERROR_LOG_FILE, encoding="utf-8") as file:
+            error_lines = file.readlines()
+        
+        # Same line format as before, errors end up in both files
+        assert re.fullmatch(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} - INFO - User ID: 3 -  Regular message\n", lines[0])
+        assert re.fullmatch(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} - ERROR - User ID: None - Something broke\n", lines[1])
+        assert error_lines == [lines[1]]
+    finally:
+        helpers.LOG_FILE, helpers.ERROR_LOG_FILE = original_files
+    
+    print("All logging tests passed!")
+
+
+
+def test_log_rotation():
+    log_dir = tempfile.mkdtemp()
+    original_settings = helpers.LOG_FILE, helpers.LOG_MAX_BYTES, helpers.LOG_BACKUP_COUNT
+    helpers.LOG_FILE = os.path.join(log_dir, "scraper_logs.txt")
+    helpers.LOG_MAX_BYTES = 200
+    helpers.LOG_BACKUP_COUNT = 2
+    
+    try:
+        # Every flush writes one batch, after each batch the file is over the limit and gets rotated
+        for i in range(0, 4):
+            helpers.log_to_file("x" * 200)
+            helpers.flush_logs()
+        
+        assert sorted(name for name in os.listdir(log_dir) if not name.endswith(".lock")) == ["scraper_logs.txt.1", "scraper_logs.txt.2"]
+        
+        # Another process rotates the file, the writer reopens the new file instead of writing to the backup
+        helpers.LOG_MAX_BYTES = 10000
+        helpers.log_to_file("before")
+        helpers.flush_logs()
+        os.replace(helpers.LOG_FILE, helpers.LOG_FILE + ".1")
+        helpers.log_to_file("after")
+        helpers.flush_logs()
+        
+        with open(helpers.LOG_FILE, encoding="utf-8") as file:
+            assert "after" in file.read()
+        with open(helpers.LOG_FILE + ".1", encoding="utf-8") as file:
+            assert "after" not in file.read()
+    finally:
+        helpers.LOG_FILE, helpers.LOG_MAX_BYTES, helpers.LOG_BACKUP_COUNT = original_settings
+    
+    print("All log rotation tests passed!")
+    
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1, ttl=60)
+    cache.set("b", 2, ttl=60)
+    
+    # Reading "a" makes "b" the least recently used entry, so "b" is dropped when "c" is added
+    assert cache.get("a") == 1
+    cache.set("c", 3, ttl=60)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
     
-    # Test TypeError handling
-    result, dict_values = mock_process_product_data(raise_exception=TypeError())
-    assert result == False
-    assert dict_values == None
+    # Expired entries count as missing
+    cache.set("d", 4, ttl=-1)
+    assert cache.get("d") is None
+    
+    print("All LRU cache tests passed!")
+
 
-    # Test KeyError handling  
-    result, dict_values = mock_process_product_data(raise_exception=KeyError())
-    assert result == False
-    assert dict_values == None
 
-    # Test generic Exception handling
-    result, dict_values = mock_process_product_data(raise_exception=Exception())
-    assert result == False
-    assert dict_values == None
+def test_scrape_cache():
+    cache = ScrapeCache(prefix="test-scrape")
+    URL = "https://www.bol.com/nl/nl/p/product"
+    
+    assert cache.get(URL, 60, "user") is None
+    
+    # Errors are never cached, successful scrapes are
+    cache.set(URL, ScrapeError(error="scraping failed"))
+    assert cache.get(URL, 60, "user") is None
+    
+    cache.set(URL, ScrapeResult(name="Product", currentPrice=5.0, ogPrice=10.0))
+    assert cache.get(URL, 60, "user") == ScrapeResult(name="Product", currentPrice=5.0, ogPrice=10.0)
+    
+    # A call path with a stricter max age treats the same entry as too old
+    assert cache.get(URL, -1, "rescrape") is None
+    
+    assert cache.stats() == {"hits": {"user": 1}, "misses": {"user": 2, "rescrape": 1}}
+    
+    # The same counts are on /metrics
+    assert scrape_cache_lookups.get(cache="test-scrape", path="user", outcome="hit") == 1
+    assert scrape_cache_lookups.get(cache="test-scrape", path="user", outcome="miss") == 2
+    assert "scrape_cache_lookups_total" in render_metrics()
+    
+    print("All scrape cache tests passed!")
+    
+
+
+def test_single_flight():
+    single_flight = SingleFlight(prefix="test-inflight", ttl=60)
+    URL = "https://www.bol.com/nl/nl/p/product"
+    
+    # The first request owns the scrape, every request after it attaches to the same task
+    assert single_flight.claim(URL, "task-1") == "task-1"
+    assert single_flight.claim(URL, "task-2") == "task-1"
+    assert single_flight.claim("https://www.bol.com/nl/nl/p/other-product", "task-3") == "task-3"
+    
+    # Only the owner can release the claim, after that the next request owns a new scrape
+    single_flight.release(URL, "task-2")
+    assert single_flight.claim(URL, "task-4") == "task-1"
+    single_flight.release(URL, "task-1")
+    assert single_flight.claim(URL, "task-5") == "task-5"
+    
+    print("All single flight tests passed!")
+    
+
+
+def test_price_history():
+    app = make_test_app()
+    now = datetime.datetime.now()
+    
+    assert to_cents("19.99") == 1999
+    assert to_cents(0.29) == 29
+    assert to_cents(5) == 500
+    
+    with app.app_context():
+        # Product 1 cost 30.00 until 20 days ago, then 25.00 and since 2 days ago 27.50
+        for days_ago, cents in [(40, 3000), (20, 2500), (2, 2750)]:
+            db.session.add(PriceHistory(productID=1, scrapedAt=now - datetime.timedelta(days=days_ago), currentPriceCents=cents, ogPriceCents=3000))
+        db.session.add(PriceHistory(productID=2, scrapedAt=now, currentPriceCents=100, ogPriceCents=100))
+        db.session.commit()
+        
+        history = get_price_history(1, start=now - datetime.timedelta(days=30))
+        assert [price for _, price, _ in history] == [25.0, 27.5]
+        assert history[0][2] == 30.0
+        assert len(get_price_history(1)) == 3
+        
+        # The 25.00 price that was in effect 10 days ago still counts, even though it was set 20 days ago
+        assert get_lowest_price(1, 10) == 25.0
+        assert get_lowest_price(1, 1) == 27.5
+        assert get_lowest_price(1, 60) == 25.0
+        assert get_lowest_price(3, 30) is None
+    
+    print("All price history tests passed!")
+    
+
+
+# Small keep-alive HTTP server that answers 503 on /flaky the first time and 200 afterwards
+class MockScraperHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    flaky_calls = 0
+    
+    def do_GET(self):
+        status = 200
+        if self.path == "/flaky":
+            MockScraperHandler.flaky_calls += 1
+            if MockScraperHandler.flaky_calls == 1:
+                status = 503
+        
+        body = b'{"currentPrice": "5.00"}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+
+def test_http_client():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockScraperHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_URL = f"http://127.0.0.1:{server.server_port}"
+    
+    try:
+        # Fresh session so the stats only count this test
+        http_client._http_session_pid = None
+        
+        for i in range(0, 5):
+            response = http_client.http_get(f"{base_URL}/scrape")
+            assert response.json() == {"currentPrice": "5.00"}
+        
+        # All 5 requests went over the same kept-alive connection
+        stats = http_client.pool_stats()[f"http://127.0.0.1:{server.server_port}"]
+        assert stats["connections"] == 1
+        assert stats["requests"] == 5
+        assert stats["reuse_rate"] == 0.8
+        
+        # A 503 from the scraper is retried
+        response = http_client.http_get(f"{base_URL}/flaky")
+        assert response.status_code == 200
+        assert MockScraperHandler.flaky_calls == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+    
+    print("All HTTP client tests passed!")
+    
+
+
+def test_backoff_delay():
+    # The delay doubles with every attempt, half of it is jitter, and it never goes past the cap
+    for i in range(0, 20):
+        assert 15 <= backoff_delay(1, base=30, cap=900) <= 30
+        assert 60 <= backoff_delay(3, base=30, cap=900) <= 120
+        assert 450 <= backoff_delay(10, base=30, cap=900) <= 900
+    
+    print("All backoff tests passed!")
+
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=0.05)
+    
+    # A success resets the consecutive failure count
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow() == True
+    
+    # The third failure in a row trips the breaker, every scrape after that is short-circuited
+    breaker.record_failure()
+    assert breaker.is_open
+    assert breaker.allow() == False
+    
+    # After the reset timeout only a single trial is let through, a failed trial opens it again
+    time.sleep(0.06)
+    assert breaker.allow() == True
+    assert breaker.allow() == False
+    breaker.record_failure()
+    assert breaker.allow() == False
+    
+    # A successful trial closes the breaker
+    time.sleep(0.06)
+    assert breaker.allow() == True
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow() == True
+    
+    print("All circuit breaker tests passed!")
+    
+
+
+def test_scrape_with_breaker():
+    app = make_test_app()
+    
+    # Product 1 has no price, product 2 is a 404, product 3 a 503 and product 4 never gets a response
+    def mock_http_get(URL, **kwargs):
+        product = int(URL.rsplit("-", 1)[1])
+        if product == 4:
+            raise requests.exceptions.ConnectionError("scraper unreachable")
+        response = requests.Response()
+        response.status_code = {1: 200, 2: 404, 3: 503}[product]
+        response._content = b'{"error": "Failed to find class promo-price"}'
+        return response
+    
+    original_settings = functions.http_get, functions.scraper_breaker
+    functions.http_get = mock_http_get
+    functions.scraper_breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    try:
+        with app.app_context():
+            # Errors about the product itself never trip the breaker, no matter how many there are
+            for _ in range(0, 3):
+                for product in (1, 2):
+                    result = functions.scrape_with_breaker(f"https://www.bol.com/nl/nl/p/product-{product}", product)
+                    assert isinstance(result, ScrapeError) and not result.transport
+            assert not functions.scraper_breaker.is_open
+            
+            # Server errors and unreachable scrapers do
+            assert functions.scrape_with_breaker("https://www.bol.com/nl/nl/p/product-3", 3).transport
+            assert functions.scrape_with_breaker("https://www.bol.com/nl/nl/p/product-4", 4).transport
+            assert functions.scraper_breaker.is_open
+            assert functions.scrape_with_breaker("https://www.bol.com/nl/nl/p/product-1", 1).skipped
+    finally:
+        functions.http_get, functions.scraper_breaker = original_settings
+    
+    print("All scrape with breaker tests passed!")
+    
+
+
+def test_run_rescrape_resumes():
+    app = make_test_app()
+    scraped = []
+    
+    # The first run crashes on product 4, as if the worker got restarted halfway through
+    def crashing_scrape(URL, product_id):
+        if product_id == 4:
+            raise RuntimeError("worker restarted")
+        scraped.append(product_id)
+        return ScrapeResult(name=f"Product {product_id}", currentPrice=10.0, ogPrice=10.0)
+    
+    def mock_scrape(URL, product_id):
+        scraped.append(product_id)
+        return ScrapeResult(name=f"Product {product_id}", currentPrice=10.0, ogPrice=10.0)
+    
+    original_settings = tasks.scrape_with_breaker, tasks.RESCRAPE_CHUNK_SIZE
+    tasks.RESCRAPE_CHUNK_SIZE = 2
+    try:
+        with app.app_context():
+            for i in range(0, 5):
+                db.session.add(Product(URL=f"https://www.bol.com/nl/nl/p/product-{i}", name=f"Product {i}", ogPrice=10, currentPrice=10))
+            db.session.commit()
+            
+            tasks.scrape_with_breaker = crashing_scrape
+            try:
+                tasks.run_rescrape("full", db.session.query(Product))
+                assert False, "the crashing scrape should have stopped the run"
+            except RuntimeError:
+                pass
+            
+            # Only the first chunk was checkpointed
+            run = db.session.query(RescrapeRun).one()
+            assert run.status == "running"
+            assert run.cursor == 2
+            
+            # The next run continues with product 3 instead of starting over
+            scraped.clear()
+            tasks.scrape_with_breaker = mock_scrape
+            summary = tasks.run_rescrape("full", db.session.query(Product))
+            
+            assert sorted(scraped) == [3, 4, 5]
+            assert summary["products"] == 3
+            assert summary["run_id"] == run.id
+            
+            run = db.session.query(RescrapeRun).one()
+            assert run.status == "finished"
+            assert run.cursor == 5
+            assert run.productsDone == 5
+            
+            # A finished run is not resumed, the next run starts from the first product again
+            scraped.clear()
+            tasks.run_rescrape("full", db.session.query(Product))
+            assert sorted(scraped) == [1, 2, 3, 4, 5]
+            assert db.session.query(RescrapeRun).count() == 2
+    finally:
+        tasks.scrape_with_breaker, tasks.RESCRAPE_CHUNK_SIZE = original_settings
+    
+    print("All resumable rescrape tests passed!")
+    
+
+
+def test_priority():
+    now = datetime.datetime.now()
+    day_ago = now - datetime.timedelta(days=1)
+    
+    # Staler, more volatile and more watched products all go first
+    assert priority(now, now - datetime.timedelta(days=2), 10, 2, 1) > priority(now, day_ago, 10, 2, 1)
+    assert priority(now, day_ago, 10, 8, 1) > priority(now, day_ago, 10, 2, 1)
+    assert priority(now, day_ago, 10, 2, 50) > priority(now, day_ago, 10, 2, 1)
+    
+    # Products nobody tracks still get a priority, never scraped products beat recently scraped ones
+    assert priority(now, day_ago, 10, 2, 0) > 0
+    assert priority(now, None, 0, 0, 0) > priority(now, day_ago, 0, 0, 0)
+    
+    # Every failed scrape in a row halves the priority
+    assert priority(now, day_ago, 10, 2, 1, 2) == priority(now, day_ago, 10, 2, 1) / 4
+    
+    print("All priority tests passed!")
+
+
+
+def test_pick_due_products():
+    app = make_test_app()
+    now = datetime.datetime.now()
+    
+    with app.app_context():
+        # Product 1 is volatile, product 2 is stable, product 3 was just scraped and product 4 is stable but popular
+        for i, (last_scraped_hours, scrape_count, change_count) in enumerate([(24, 10, 9), (24, 10, 0), (0.1, 10, 9), (24, 10, 0)]):
+            db.session.add(Product(URL=f"https://www.bol.com/nl/nl/p/product-{i}", name=f"Product {i}", ogPrice=10, currentPrice=10,
+                                   lastScrapedAt=now - datetime.timedelta(hours=last_scraped_hours),
+                                   lastAttemptAt=now - datetime.timedelta(hours=last_scraped_hours),
+                                   scrapeCount=scrape_count, changeCount=change_count))
+        
+        # Product 5 is volatile and stale but its last scrape just failed, product 6 failed 5 times in a row
+        db.session.add(Product(URL="https://www.bol.com/nl/nl/p/product-4", name="Product 4", ogPrice=10, currentPrice=10,
+                               lastScrapedAt=now - datetime.timedelta(hours=48), lastAttemptAt=now - datetime.timedelta(hours=0.1),
+                               scrapeCount=10, changeCount=9, failureCount=1))
+        db.session.add(Product(URL="https://www.bol.com/nl/nl/p/product-5", name="Product 5", ogPrice=10, currentPrice=10,
+                               lastScrapedAt=now - datetime.timedelta(hours=48), lastAttemptAt=now - datetime.timedelta(hours=2),
+                               scrapeCount=10, changeCount=9, failureCount=5))
+        db.session.commit()
+        
+        for user_id in range(1, 31):
+            db.session.add(UserProduct(userID=user_id, productID=4))
+        db.session.commit()
+        
+        assert [product.id for product in pick_due_products(2, now)] == [1, 4]
+        
+        # Recently scraped or attempted products are never picked, even with budget left,
+        # products that keep failing back off behind the ones that scrape fine
+        assert [product.id for product in pick_due_products(10, now)] == [1, 4, 2, 6]
+    
+    print("All due product tests passed!")
+    
+
+
+
+def test_metrics():
+    histogram = Histogram("test_latency_seconds", "Test latency", ("route",), buckets=(0.1, 1))
+    histogram.observe(0.05, route="/")
+    histogram.observe(0.5, route="/")
+    histogram.observe(5, route="/")
+    
+    lines = histogram.render()
+    assert 'test_latency_seconds_bucket{route="/",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{route="/",le="1"} 2' in lines
+    assert 'test_latency_seconds_bucket{route="/",le="+Inf"} 3' in lines
+    assert 'test_latency_seconds_count{route="/"} 3' in lines
+    
+    app = make_test_app()
+    init_metrics(app)
+    
+    @app.route("/products")
+    def products():
+        db.session.query(Product).all()
+        db.session.query(User).all()
+        return "ok"
+    
+    with app.app_context():
+        # Nested scopes add their queries to the scope around them
+        with MetricsScope() as outer:
+            db.session.execute(text("SELECT 1"))
+            with MetricsScope() as inner:
+                db.session.execute(text("SELECT 1"))
+        assert inner.queries == 1
+        assert outer.queries == 2
+    
+    client = app.test_client()
+    assert client.get("/products").data == b"ok"
+    
+    # /metrics is only served with the token
+    original_token = metrics_module.METRICS_TOKEN
+    try:
+        metrics_module.METRICS_TOKEN = ""
+        assert client.get("/metrics").status_code == 404
+        metrics_module.METRICS_TOKEN = "token"
+        assert client.get("/metrics").status_code == 403
+        metrics = client.get("/metrics", headers={"Authorization": "Bearer token"}).data.decode()
+    finally:
+        metrics_module.METRICS_TOKEN = original_token
+    assert 'http_request_duration_seconds_count{route="/products",method="GET",status="200"} 1' in metrics
+    assert 'http_request_db_queries_sum{route="/products"} 2' in metrics
+    
+    # The queue wait comes from the header stamped when the task was published, direct calls have none
+    class Request:
+        published_at = time.time() - 2
+        eta = None
+    assert 1.9 < queue_wait(Request()) < 3
+    assert queue_wait(object()) is None
+    
+    print("All metrics tests passed!")
+    
+
+
+
+def test_init_sessions():
+    for backend in ("cookie", "filesystem"):
+        app = Flask(__name__)
+        app.secret_key = "test"
+        app.config["SESSION_FILE_DIR"] = tempfile.mkdtemp()
+        assert init_sessions(app, backend) == backend
+        
+        @app.route("/set")
+        def set_session():
+            session["user_id"] = 7
+            return "ok"
+        
+        @app.route("/get")
+        def get_session():
+            return str(session.get("user_id"))
+        
+        client = app.test_client()
+        client.get("/set")
+        assert client.get("/get").data == b"7"
+        
+        # Loading and saving the session is timed per backend
+        assert session_latency.count(backend=backend, operation="open") >= 2
+        assert session_latency.count(backend=backend, operation="save") >= 1
+    
+    # Without a Redis URL the redis backend falls back to session files
+    app = Flask(__name__)
+    app.config["SESSION_FILE_DIR"] = tempfile.mkdtemp()
+    assert init_sessions(app, "redis") == "filesystem"
+    
+    # Without SESSION_BACKEND the session files are used, Redis is never asked whether it is there
+    app = Flask(__name__)
+    app.config["SESSION_FILE_DIR"] = tempfile.mkdtemp()
+    assert init_sessions(app) == "filesystem"
+    
+    print("All session tests passed!")
+    
+
+
+
+def test_product_list_cache():
+    cache = ProductListCache(local=True)
+    cache.set(1, [[10, "URL a", "a", 5.0, 6.0], [11, "URL b", "b", 5.0, 6.0]])
+    cache.set(2, [[11, "URL b", "b", 5.0, 6.0]])
+    cache.set(3, [[12, "URL c", "c", 5.0, 6.0]])
+    
+    # A price change of product 11 only drops the lists of the users that track it
+    assert cache.invalidate_products([11]) == 2
+    assert cache.get(1) is None
+    assert cache.get(2) is None
+    assert cache.get(3) == [[12, "URL c", "c", 5.0, 6.0]]
+    
+    cache.invalidate_user(3)
+    assert cache.get(3) is None
+    
+    # Without Redis the shared cache is off by default, a worker could not invalidate the web process
+    assert ProductListCache().get(1) is None
+    
+    app = make_test_app()
+    product_list_cache.local = LRUCache(10)
+    try:
+        with app.app_context():
+            db.session.add_all([Product(URL="URL a", name="a", ogPrice=6, currentPrice=5),
+                                Product(URL="URL b", name="b", ogPrice=6, currentPrice=5)])
+            db.session.commit()
+            check_product_existence("URL a", 1, 1)
+            
+            assert [product.name for product in get_cached_user_products(1)] == ["a"]
+            assert product_list_cache.get(1) is not None
+            
+            # Adding a product invalidates the users list
+            check_product_existence("URL b", 2, 1)
+            assert product_list_cache.get(1) is None
+            assert [product.name for product in get_cached_user_products(1)] == ["a", "b"]
+            
+            # A rescrape price change invalidates it as well
+            updates = PriceUpdateBatch()
+            updates.add(2, 4.0, 6.0)
+            updates.flush()
+            assert product_list_cache.get(1) is None
+            assert get_cached_user_products(1)[1].currentPrice == 4.0
+    finally:
+        product_list_cache.local = None
+        product_list_cache.local_watchers = {}
+    
+    print("All product list cache tests passed!")
+    
+
+
+
+def test_bulk_import():
+    text = "url;note\nbol.com/nl/nl/p/a/1/?bltgh=x;first\nhttps://www.bol.com/nl/nl/p/a/1;again\nexample.com/x;no\n"
+    raw_urls = bulk_import.read_urls(text)
+    assert raw_urls == ["url", "note", "bol.com/nl/nl/p/a/1/?bltgh=x", "first", "https://www.bol.com/nl/nl/p/a/1", "again", "example.com/x", "no"]
+    
+    urls, invalid, duplicates = bulk_import.prepare_urls(raw_urls)
+    assert urls == ["https://www.bol.com/nl/nl/p/a/1"]
+    assert duplicates == 1
+    assert len(invalid) == 6
+    
+    dispatched = []
+    original_group = bulk_import.group
+    bulk_import.group = lambda signatures: type("Group", (), {"apply_async": lambda self: dispatched.extend(signatures)})()
+    
+    app = make_test_app()
+    try:
+        with app.app_context():
+            db.session.add_all([Product(URL="https://www.bol.com/nl/nl/p/known/1", name="known", ogPrice=6, currentPrice=5),
+                                Product(URL="https://www.bol.com/nl/nl/p/tracked/2", name="tracked", ogPrice=6, currentPrice=5)])
+            db.session.add(UserProduct(userID=1, productID=2))
+            db.session.commit()
+            
+            result = bulk_import.import_urls(["bol.com/nl/nl/p/known/1",
+                                              "bol.com/nl/nl/p/tracked/2",
+                                              "bol.com/nl/nl/p/new/3",
+                                              "bol.com/nl/nl/p/new/3",
+                                              "bol.com/nl/nl/p/new/4",
+                                              "bol.com/nl/nl/p/new/5",
+                                              "bol.com/nl/nl/p/new/6"], user_id=1)
+            
+            # Known products are linked right away, only the unknown ones are scraped, up to the product limit of the user
+            assert result["existing"] == ["https://www.bol.com/nl/nl/p/known/1"]
+            assert result["already_tracked"] == ["https://www.bol.com/nl/nl/p/tracked/2"]
+            assert list(result["queued"]) == ["https://www.bol.com/nl/nl/p/new/3", "https://www.bol.com/nl/nl/p/new/4", "https://www.bol.com/nl/nl/p/new/5"]
+            assert result["over_limit"] == ["https://www.bol.com/nl/nl/p/new/6"]
+            assert result["duplicates"] == 1
+            assert [signature.args[0] for signature in dispatched] == list(result["queued"])
+            assert db.session.query(UserProduct).filter_by(userID=1).count() == 2
+            
+            assert bulk_import.import_summary(result) == {"queued": 3, "existing": 1, "already_tracked": 1, "over_limit": 1, "invalid": 0, "duplicates": 1}
+            
+            with pytest.raises(ValueError):
+                bulk_import.import_urls(["bol.com/nl/nl/p/x"] * (bulk_import.BULK_IMPORT_MAX_URLS + 1))
+            
+            # The status of a scrape is read without waiting on it, a scrape started by another user is linked for this user too
+            task_results = {"running": None,
+                            "crashed": RuntimeError("worker lost"),
+                            "done": {"success": True, "product_data": {"URL": "https://www.bol.com/nl/nl/p/known/1", "id": 1}}}
+            class MockAsyncResult:
+                def __init__(self, task_id):
+                    self.result = task_results[task_id]
+                def ready(self):
+                    return self.result is not None
+                def failed(self):
+                    return isinstance(self.result, Exception)
+            
+            original_task = bulk_import.scrape_and_store_product
+            bulk_import.scrape_and_store_product = type("Task", (), {"AsyncResult": MockAsyncResult})
+            try:
+                assert bulk_import.scrape_outcome("running", 2) is None
+                assert bulk_import.scrape_outcome("crashed", 2)["success"] == False
+                assert bulk_import.scrape_outcome("done", 2)["success"] == True
+                assert db.session.query(UserProduct).filter_by(userID=2, productID=1).count() == 1
+            finally:
+                bulk_import.scrape_and_store_product = original_task
+    finally:
+        bulk_import.group = original_group
+        for URL, task_id in result["queued"].items():
+            bulk_import.single_flight.release(URL, task_id)
+    
+    print("All bulk import tests passed!")
+    
+
+
+
+def test_passwords():
+    old_hash = passwords.hash_job("secret", 1000)
+    assert old_hash.startswith("pbkdf2:sha256:1000$")
+    assert not passwords.needs_rehash(old_hash, 1000)
+    assert passwords.needs_rehash(old_hash, 2000)
+    
+    # A wrong password never gets a new hash, a right one gets rehashed when the cost changed
+    assert passwords.verify_job(old_hash, "wrong", 2000) == (False, None)
+    valid, new_hash = passwords.verify_job(old_hash, "secret", 2000)
+    assert valid and new_hash.startswith("pbkdf2:sha256:2000$")
+    assert passwords.verify_job(new_hash, "secret", 2000) == (True, None)
+    
+    original = (passwords.PASSWORD_HASH_WORKERS, passwords.PASSWORD_HASH_ITERATIONS, passwords.PASSWORD_HASH_WAIT, passwords._slots)
+    passwords.PASSWORD_HASH_WORKERS = 1
+    passwords.PASSWORD_HASH_ITERATIONS = 1000
+    passwords.PASSWORD_HASH_WAIT = 0.05
+    passwords._slots = threading.BoundedSemaphore(1)
+    try:
+        # Hashing and verifying go through the process pool
+        pool_hash = passwords.hash_password("secret")
+        assert passwords.verify_password(pool_hash, "secret") == (True, None)
+        
+        # While the only slot is taken the next hash waits PASSWORD_HASH_WAIT seconds for it, then it is turned away
+        passwords._slots.acquire()
+        with pytest.raises(passwords.PasswordHasherBusy):
+            passwords.verify_password(pool_hash, "secret")
+        
+        # A slot that frees up during the wait is used
+        passwords.PASSWORD_HASH_WAIT = 5
+        threading.Timer(0.05, passwords._slots.release).start()
+        assert passwords.verify_password(pool_hash, "secret") == (True, None)
+    finally:
+        passwords.shutdown_pool()
+        passwords.PASSWORD_HASH_WORKERS, passwords.PASSWORD_HASH_ITERATIONS, passwords.PASSWORD_HASH_WAIT, passwords._slots = original
+    
+    print("All password tests passed!")
+    
+
+
+
+def test_turnstile():
+    calls = []
+    def counting_verify(token, secret, remoteip=None):
+        calls.append(token)
+        if token == "good":
+            return {'success': True, 'error-codes': []}
+        if token == "bad":
+            return {'success': False, 'error-codes': ['invalid-input-response']}
+        return {'success': False, 'error-codes': ['internal-error']}
+    
+    original = (turnstile.cloudflare_verify, turnstile.TURNSTILE_VERIFIER)
+    turnstile.cloudflare_verify = counting_verify
+    turnstile.TURNSTILE_VERIFIER = "cloudflare"
+    turnstile.verdict_cache.entries.clear()
+    try:
+        # A missing token is rejected without asking Cloudflare
+        assert not turnstile.validate_turnsrtile(None, "secret")['success']
+        assert calls == []
+        
+        # A rejected token is cached, submitting it again does not verify it again
+        assert not turnstile.validate_turnsrtile("bad", "secret")['success']
+        assert not turnstile.validate_turnsrtile("bad", "secret")['success']
+        assert calls == ["bad"]
+        
+        # An accepted token is never cached, Cloudflare decides whether it can be used again
+        assert turnstile.validate_turnsrtile("good", "secret")['success']
+        assert turnstile.validate_turnsrtile("good", "secret")['success']
+        assert calls == ["bad", "good", "good"]
+        
+        # Errors on our side are not cached
+        turnstile.validate_turnsrtile("error", "secret")
+        turnstile.validate_turnsrtile("error", "secret")
+        assert calls == ["bad", "good", "good", "error", "error"]
+        
+        # The local stand-in never calls Cloudflare
+        turnstile.TURNSTILE_VERIFIER = "local"
+        assert turnstile.validate_turnsrtile("anything", "secret")['success']
+        assert not turnstile.validate_turnsrtile("fail-token", "secret")['success']
+        assert calls == ["bad", "good", "good", "error", "error"]
+    finally:
+        turnstile.cloudflare_verify, turnstile.TURNSTILE_VERIFIER = original
+        turnstile.verdict_cache.entries.clear()
+    
+    print("All Turnstile tests passed!")
+    
+
+
+def call_asgi(asgi_app, method, path, body=b"", headers=()):
+    # Run one request through an ASGI app, returns (status, headers, body)
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"", "headers": list(headers)}
+    messages = []
+    
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+    
+    async def send(message):
+        messages.append(message)
+    
+    asyncio.run(asgi_app(scope, receive, send))
+    return messages[0]["status"], messages[0]["headers"], b"".join(message.get("body", b"") for message in messages[1:])
+
+
+
+def test_asgi_app():
+    app = Flask(__name__)
+    app.secret_key = "test"
+    
+    @app.route("/add_product", methods=["POST"])
+    def add_product():
+        session["pending_tasks"] = ["task-1"]
+        return {"success": True, "pending": True, "task_id": "task-1"}
+    
+    @app.route("/add_product/status/<task_id>")
+    def add_product_status(task_id):
+        if task_id not in session.get("pending_tasks", []):
+            return {"success": False}
+        return {"success": True, "product_data": {"name": "Product"}}
+    
+    @app.route("/echo", methods=["POST"])
+    def echo():
+        return request.script_root + request.path + ":" + request.get_data(as_text=True)
+    
+    checks = []
+    def is_ready(task_id):
+        # The blocking result backend check never runs on the event loop
+        checks.append(threading.current_thread().name.startswith("asgi-status") and task_id)
+        return len(checks) >= 3
+    
+    original = (asgi.ASYNC_PRODUCT_POLL_INTERVAL, asgi.ASYNC_PRODUCT_WAIT_TIMEOUT)
+    asgi.ASYNC_PRODUCT_POLL_INTERVAL = 0.01
+    asgi_app = asgi.AsyncApp(app, url_prefix="/prefix", threads=2, is_ready=is_ready)
+    try:
+        # Other routes run as they are, with the prefix moved to the script root like Waitress does
+        status, headers, body = call_asgi(asgi_app, "POST", "/prefix/echo", b"data")
+        assert (status, body) == (200, b"/prefix/echo:data")
+        assert call_asgi(asgi_app, "GET", "/elsewhere")[0] == 404
+        
+        # /add_product waits for the scrape and answers with the status route, which sees the session of the first response
+        status, headers, body = call_asgi(asgi_app, "POST", "/prefix/add_product")
+        assert status == 200
+        assert json.loads(body) == {"success": True, "product_data": {"name": "Product"}}
+        assert checks == ["task-1"] * 3
+        assert any(name == b"set-cookie" for name, value in headers)
+        
+        # A scrape that takes too long returns the pending response, the client polls
+        asgi.ASYNC_PRODUCT_WAIT_TIMEOUT = 0.05
+        asgi_app.is_ready = lambda task_id: False
+        status, headers, body = call_asgi(asgi_app, "POST", "/prefix/add_product")
+        assert json.loads(body)["pending"]
+    finally:
+        asgi.ASYNC_PRODUCT_POLL_INTERVAL, asgi.ASYNC_PRODUCT_WAIT_TIMEOUT = original
+        asgi_app.executor.shutdown()
+        asgi_app.status_executor.shutdown()
+    
+    print("All ASGI tests passed!")
+    
+
+
+def test_decode_scrape():
+    # Prices come from the scraper as strings and are validated into floats
+    result = decode_scrape(b'{"name": "Product", "currentPrice": "5.49", "ogPrice": "10", "url": "ignored"}')
+    assert result == ScrapeResult(name="Product", currentPrice=5.49, ogPrice=10.0)
+    
+    # Errors of the scraper and responses that do not validate both become a ScrapeError
+    assert decode_scrape(b'{"error": "Failed to find class \\"promo-price\\""}') == ScrapeError(error='Failed to find class "promo-price"')
+    # A price of 0 is a valid scrape of a product that is out of stock, a negative price is not
+    assert decode_scrape(b'{"name": "Product", "currentPrice": "0", "ogPrice": "0"}') == ScrapeResult(name="Product", currentPrice=0.0, ogPrice=0.0)
+    assert isinstance(decode_scrape(b'{"name": "Product", "currentPrice": "-1", "ogPrice": "10"}'), ScrapeError)
+    assert isinstance(decode_scrape(b'{"name": "Product", "currentPrice": "n/a", "ogPrice": "10"}'), ScrapeError)
+    assert isinstance(decode_scrape(b'<html>Bad gateway</html>'), ScrapeError)
+    
+    # Both types survive the JSON serializer of the Celery task payloads
+    payload = kombu_loads(kombu_dumps([result, ScrapeError(error="down", skipped=True)]))
+    assert payload == [result, ScrapeError(error="down", skipped=True)]
     
-    print("All process product data tests passed!")
+    print("All scrape result tests passed!")
     
 
 
 if __name__ == "__main__":
     test_validate_URL()
-    test_retry_scrape()
+    test_schedule_retry()
+    test_retry_rescrape()
     test_product_check_logic()
-    test_process_product_data()
\ No newline at end of file
+    test_rescrape_concurrently()
+    test_summarise_run()
+    test_get_tracked_products()
+    test_price_update_batch()
+    test_rescrape_products()
+    test_scrape_and_store_product()
+    test_get_user_products()
+    test_query_plans_use_indexes()
+    test_unique_constraints()
+    test_run_migrations()
+    test_log_to_file()
+    test_log_rotation()
+    test_lru_cache()
+    test_scrape_cache()
+    test_single_flight()
+    test_price_history()
+    test_http_client()
+    test_backoff_delay()
+    test_circuit_breaker()
+    test_scrape_with_breaker()
+    test_run_rescrape_resumes()
+    test_priority()
+    test_pick_due_products()
+    test_metrics()
+    test_init_sessions()
+    test_product_list_cache()
+    test_bulk_import()
+    test_passwords()
+    test_turnstile()
+    test_asgi_app()
+    test_decode_scrape()